@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 
+import argparse
+import fnmatch
 import json
+import math
+import os
 import re
+import shlex
 import subprocess
 import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 ##############################################################################
 # 1) Desired Partitions
@@ -38,7 +47,7 @@ DESIRED_PARTITIONS = {
         "partition_location": "system"
     },
     "swap": {
-        "size":  "64GiB",
+        "size":  "auto",  # from RAM and the swap policy, see swap_size
         "type":  "linuxswap",
         "encrypt": True,
         "file_system_type": "mkswap",
@@ -89,138 +98,214 @@ def run_cmd(cmd):
     return result.stdout.strip()
 
 ##############################################################################
-# 3) List all block devices (TYPE='disk') with lsblk
+# 3) Device inventory: /sys/class/block + one lsblk call
 ##############################################################################
 
-def list_all_block_devices():
+SYS_CLASS_BLOCK = "/sys/class/block"
+
+def read_sysfs(path, default=None):
     """
-    Uses lsblk to retrieve *all* block devices (disks, partitions, loops, etc.)
-    with columns: NAME, MAJ:MIN, RM, SIZE, RO, TYPE, MOUNTPOINTS.
+    Returns the stripped content of a sysfs attribute, or default if it can't be read.
+    """
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return default
 
-    Prints them in a table for the user, then returns a list of device paths
-    whose TYPE is 'disk' (e.g., /dev/sda, /dev/nvme0n1).
+def read_sysfs_block(name):
+    """
+    Reads what the kernel exports for one block device in /sys/class/block.
+    Partitions inherit rotational, removable and sector sizes from their disk.
+    Device-mapper nodes (dm-0, ...) are typed from dm/uuid, e.g. CRYPT-LUKS2-... => crypt,
+    and hang off their first slave, so they are never mistaken for disks.
     """
-    columns = ["NAME","MAJ:MIN","RM","SIZE","RO","TYPE","MOUNTPOINTS"]
-    cmd = f"lsblk -rno {','.join(columns)}"
-    output = run_cmd(cmd)
+    base = f"{SYS_CLASS_BLOCK}/{name}"
+    partn = read_sysfs(f"{base}/partition")
+    disk = base
+    parent = None
+    if partn is not None:
+        disk = os.path.dirname(os.path.realpath(base))
+        parent = os.path.basename(disk)
+        kind = "part"
+    elif os.path.isdir(f"{base}/dm"):
+        prefix = read_sysfs(f"{base}/dm/uuid", "").split("-", 1)[0]
+        kind = {"CRYPT": "crypt", "LVM": "lvm", "mpath": "mpath"}.get(prefix, "dm")
+        try:
+            slaves = sorted(os.listdir(f"{base}/slaves"))
+        except OSError:
+            slaves = []
+        parent = slaves[0] if slaves else None
+    else:
+        kind = "loop" if os.path.isdir(f"{base}/loop") else "disk"
+    return {
+        "name": name,
+        "path": f"/dev/{name}",
+        "maj:min": read_sysfs(f"{base}/dev", ""),
+        "type": kind,
+        "pkname": parent,
+        "partn": int(partn) if partn is not None else None,
+        "size": int(read_sysfs(f"{base}/size", "0")) * 512,
+        "ro": read_sysfs(f"{base}/ro") == "1",
+        "rm": read_sysfs(f"{disk}/removable") == "1",
+        "rota": read_sysfs(f"{disk}/queue/rotational") == "1",
+        "log-sec": int(read_sysfs(f"{disk}/queue/logical_block_size", "512")),
+        "phy-sec": int(read_sysfs(f"{disk}/queue/physical_block_size", "512")),
+    }
 
-    rows = []
-    for line in output.splitlines():
-        # Because MOUNTPOINTS might contain spaces if multiple mountpoints,
-        # split into at most 6 columns + 1 remainder for MOUNTPOINTS
-        parts = line.split(None, 6)
-        if len(parts) < 6:
-            continue
+def flatten_lsblk(blockdevices, index, parent=None):
+    """
+    Adds every lsblk entry, children included, to index by kernel name, which is
+    what /sys/class/block uses (dm-0, not the mapper name cryptroot).
+    Older lsblk has no PARTN column, so partition numbers fall back to the name suffix.
+    """
+    for device in blockdevices:
+        name = device.get("kname") or device.get("name")
+        if parent and not device.get("pkname"):
+            device["pkname"] = parent
+        if device.get("type") == "part" and device.get("partn") is None and parent:
+            match = re.match(rf"^{re.escape(parent)}p?(\d+)$", name or "")
+            if match:
+                device["partn"] = int(match.group(1))
+        index.setdefault(name, device)
+        flatten_lsblk(device.get("children") or [], index, name)
 
-        name       = parts[0]
-        maj_min    = parts[1]
-        rm         = parts[2]
-        size       = parts[3]
-        ro         = parts[4]
-        typ        = parts[5]
-        mountpoint = parts[6] if len(parts) == 7 else ""
+def load_inventory():
+    """
+    Builds a name-indexed inventory of every block device from /sys/class/block
+    and a single 'lsblk -J -b -O' call (sizes in bytes, all columns), e.g.:
+    {
+      "nvme0n1":   {"path": "/dev/nvme0n1", "type": "disk", "size": 1000204886016,
+                    "model": ..., "serial": ..., "rota": False, "children": ["nvme0n1p1", ...]},
+      "nvme0n1p1": {"path": "/dev/nvme0n1p1", "type": "part", "partn": 1, "pkname": "nvme0n1",
+                    "fstype": "vfat", "label": "EFI", "uuid": ..., "mountpoints": [...]},
+    }
+    Nothing here opens the devices, so slow USB and optical drives cost nothing.
+    """
+    inventory = {}
+    try:
+        names = sorted(os.listdir(SYS_CLASS_BLOCK))
+    except OSError:
+        names = []
+    for name in names:
+        inventory[name] = read_sysfs_block(name)
+
+    lsblk_index = {}
+    try:
+        flatten_lsblk(json.loads(run_cmd("lsblk -J -b -O")).get("blockdevices", []), lsblk_index)
+    except (SystemExit, ValueError) as e:
+        print(f"lsblk failed ({e}), using /sys/class/block only.", file=sys.stderr)
+    for name, entry in lsblk_index.items():
+        merged = inventory.setdefault(name, {})
+        merged.update({key: value for key, value in entry.items() if key != "children" and value is not None})
 
-        rows.append([name, maj_min, rm, size, ro, typ, mountpoint])
+    for entry in inventory.values():
+        entry.setdefault("children", [])
+    for name, entry in inventory.items():
+        parent = inventory.get(entry.get("pkname") or "")
+        if parent is not None and name not in parent["children"]:
+            parent["children"].append(name)
+    return inventory
 
-    # Print a table header
+def format_size(size):
+    """
+    1000204886016 => '931.5G', like lsblk's human-readable sizes.
+    """
+    size = float(size or 0)
+    for unit in ["B", "K", "M", "G", "T", "P"]:
+        if size < 1024 or unit == "P":
+            return f"{size:.0f}{unit}" if size == int(size) else f"{size:.1f}{unit}"
+        size /= 1024
+
+def list_all_block_devices(inventory):
+    """
+    Prints all block devices (disks, partitions, loops, etc.) in the inventory
+    with columns: NAME, MAJ:MIN, RM, SIZE, RO, TYPE, MOUNTPOINTS.
+
+    Devices without media (size 0, e.g. unused loop devices or an empty card
+    reader) are left out, as lsblk does.
+
+    Returns a list of device paths whose TYPE is 'disk' (e.g., /dev/sda, /dev/nvme0n1).
+    """
     header = ["NAME","MAJ:MIN","RM","SIZE","RO","TYPE","MOUNTPOINTS"]
-    print("\n=== All Block Devices (lsblk) ===")
+    print("\n=== All Block Devices ===")
     print("-"*75)
     print("{:<10} {:<7} {:<2} {:>7} {:>2} {:<6} {}".format(*header))
     print("-"*75)
-    for r in rows:
-        print("{:<10} {:<7} {:<2} {:>7} {:>2} {:<6} {}".format(*r))
-
-    # Extract only those devices that are TYPE="disk"
     disks = []
-    for row in rows:
-        (name, maj_min, rm, size, ro, typ, mountpoint) = row
-        if typ == "disk":
-            disk_path = f"/dev/{name}"
-            disks.append(disk_path)
-
+    for name, entry in inventory.items():
+        if not entry.get("size"):
+            continue
+        mountpoints = " ".join(m for m in entry.get("mountpoints") or [] if m)
+        print("{:<10} {:<7} {:<2} {:>7} {:>2} {:<6} {}".format(
+            name, entry.get("maj:min", ""), int(bool(entry.get("rm"))), format_size(entry.get("size")),
+            int(bool(entry.get("ro"))), entry.get("type", ""), mountpoints
+        ))
+        if entry.get("type") == "disk":
+            disks.append(entry.get("path", f"/dev/{name}"))
     return sorted(disks)
 
 ##############################################################################
-# 4) Merge parted -j -l + lsblk -f -J
+# 4) parted on the selected disks, merged with the inventory
 ##############################################################################
 
-def get_parted_json():
+def get_parted_json(disk_path):
     """
-    Runs 'sudo parted -j -l' to get JSON output for all disks.
-    parted may return multiple JSON objects (one per disk).
+    Runs 'sudo parted -j -s <disk> unit B print' for one disk and returns its
+    JSON object. Start, end and size are in bytes ('1048576B').
     """
-    cmd = "sudo parted -j -l"
-    output = run_cmd(cmd)
-    import re
-    chunks = re.split(r'(?<=\})\s*\n(?=\{)', output.strip())
-    parted_entries = []
-    for chunk in chunks:
-        chunk = chunk.strip()
-        if chunk:
-            parted_entries.append(json.loads(chunk))
-    return parted_entries
-
-def get_lsblk_json():
-    """
-    Runs 'lsblk -f -J' => returns a dict with "blockdevices": [...]
-    """
-    cmd = "lsblk -f -J"
-    output = run_cmd(cmd)
+    output = run_cmd(f"sudo parted -j -s {disk_path} unit B print")
     return json.loads(output)
 
 def build_partition_devpath(disk_path, part_num):
     """
     /dev/nvme0n1 + 1 => /dev/nvme0n1p1
+    /dev/loop0 + 1 => /dev/loop0p1
     /dev/sda + 1 => /dev/sda1
+    The kernel adds the 'p' when the disk name ends in a digit.
     """
-    if "nvme" in disk_path:
+    if disk_path[-1].isdigit():
         return f"{disk_path}p{part_num}"
     else:
         return f"{disk_path}{part_num}"
 
-def find_lsblk_entry_by_name(blockdevices, dev_name):
+def merge_parted_and_lsblk(disk_paths, inventory):
     """
-    Recursively search blockdevices for an entry with "name" = dev_name.
-    Return that entry or None.
+    1) Runs parted only on the given (selected) disks.
+    2) For each parted partition, looks up the inventory entry of the disk's child
+       with that partition number => attaches its fields.
+    Returns a list of parted disk objects with extra "lsblk-*" fields in partitions.
     """
-    for device in blockdevices:
-        if device.get("name") == dev_name:
-            return device
-        if "children" in device and device["children"]:
-            found = find_lsblk_entry_by_name(device["children"], dev_name)
-            if found:
-                return found
-    return None
-
-def merge_parted_and_lsblk():
-    """
-    1) parted_data = get_parted_json()
-    2) lsblk_data = get_lsblk_json()
-    3) For each parted disk's partition, find matching lsblk entry => attach fields.
-    Returns parted_data with extra "lsblk-*" fields in partitions.
-    """
-    parted_data = get_parted_json()
-    lsblk_data  = get_lsblk_json()
-
-    blockdevices = lsblk_data.get("blockdevices", [])
-    if not blockdevices:
-        return parted_data
-
-    for pdisk in parted_data:
-        disk_info = pdisk.get("disk", {})
-        disk_path = disk_info.get("path", "")
-        parts     = disk_info.get("partitions", [])
-
-        for part in parts:
-            pnum = part["number"]
-            part_dev = build_partition_devpath(disk_path, pnum)
-            dev_basename = part_dev.replace("/dev/", "")
-            match = find_lsblk_entry_by_name(blockdevices, dev_basename)
+    parted_data = []
+    for disk_path in disk_paths:
+        disk_entry = inventory.get(os.path.basename(disk_path), {})
+        try:
+            pdisk = get_parted_json(disk_path)
+        except (SystemExit, ValueError):
+            # No partition table yet: describe an empty disk from the inventory
+            print(f"No partition table on {disk_path}, treating it as empty.")
+            pdisk = {"disk": {
+                "path": disk_path, "size": f"{disk_entry.get('size', 0)}B", "label": "unknown",
+                "logical-sector-size": disk_entry.get("log-sec", 512),
+                "physical-sector-size": disk_entry.get("phy-sec", 512), "partitions": [],
+            }}
+        pdisk["disk"]["rotational"] = bool(disk_entry.get("rota"))
+        parted_data.append(pdisk)
+
+        by_number = {}
+        for child in disk_entry.get("children", []):
+            child_entry = inventory.get(child, {})
+            if child_entry.get("partn") is not None:
+                by_number[int(child_entry["partn"])] = child_entry
+
+        for part in pdisk.get("disk", {}).get("partitions", []):
+            match = by_number.get(part["number"])
             if match:
+                part["lsblk-path"]        = match.get("path", "")
                 part["lsblk-fstype"]      = match.get("fstype", "")
                 part["lsblk-label"]       = match.get("label", "")
                 part["lsblk-uuid"]        = match.get("uuid", "")
+                part["lsblk-partuuid"]    = match.get("partuuid", "")
                 part["lsblk-mountpoints"] = match.get("mountpoints", [])
                 part["lsblk-fsavail"]     = match.get("fsavail", "")
                 part["lsblk-fsuse%"]      = match.get("fsuse%", "")
@@ -302,10 +387,504 @@ def prompt_device_usage(all_disks):
     return devices_dict
 
 ##############################################################################
-# 6) Assign Partitions Based on partition_location
+# 6) Layout file => devices_dict and partitions, without prompts
 ##############################################################################
 
-def assign_partitions(devices_dict, merged_data):
+SIZE_UNITS = {
+    "": 1, "B": 1,
+    "K": 1024, "KIB": 1024, "M": 1024**2, "MIB": 1024**2, "G": 1024**3, "GIB": 1024**3,
+    "T": 1024**4, "TIB": 1024**4, "P": 1024**5, "PIB": 1024**5,
+    "KB": 1000, "MB": 1000**2, "GB": 1000**3, "TB": 1000**4, "PB": 1000**5,
+}
+
+def parse_size(size):
+    """
+    '512MiB' => 536870912, '2TB' => 2000000000000, 1048576 => 1048576.
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.match(r"^\s*([0-9.]+)\s*([A-Za-z]*)\s*$", str(size))
+    if not match or match.group(2).upper() not in SIZE_UNITS:
+        raise SystemExit(f"Invalid size: {size}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+def load_layout(layout_path):
+    """
+    Loads a layout file (YAML, or JSON if it ends in .json), e.g.:
+
+    mount_prefix: /mnt
+    partitions:            # optional, replaces DESIRED_PARTITIONS
+      root: {size: 64GiB, type: ext4, format: true, file_system_type: mkfs.ext4,
+             mount: /, partition_location: system}
+    devices:               # checked in order, each rule claims matching disks
+      - partition_location: system
+        match: {device_type: nvme, min_size: 256GiB}
+      - partition_location: home
+        match: {rotational: true, model: "WDC*"}
+        count: all         # default: 1
+    """
+    with open(layout_path, "r") as f:
+        if layout_path.endswith(".json"):
+            layout = json.load(f)
+        else:
+            import yaml
+            layout = yaml.safe_load(f)
+    if not isinstance(layout, dict) or not isinstance(layout.get("devices"), list):
+        raise SystemExit(f"Layout file {layout_path} needs a 'devices' list.")
+    return layout
+
+def disk_matches(entry, disk_path, match):
+    """
+    Checks one inventory entry against a rule's match keys: model and serial
+    (shell-style patterns, case-insensitive), min_size/max_size, rotational,
+    removable, device_type ('sd', 'nvme', 'other', see guess_device_type) and
+    name (pattern on the device path).
+    """
+    for key, pattern in (("model", match.get("model")), ("serial", match.get("serial"))):
+        if pattern is not None and not fnmatch.fnmatch((entry.get(key) or "").strip().lower(), str(pattern).lower()):
+            return False
+    if "name" in match and not fnmatch.fnmatch(disk_path, match["name"]):
+        return False
+    size = int(entry.get("size") or 0)
+    if "min_size" in match and size < parse_size(match["min_size"]):
+        return False
+    if "max_size" in match and size > parse_size(match["max_size"]):
+        return False
+    if "rotational" in match and bool(entry.get("rota")) != bool(match["rotational"]):
+        return False
+    if "removable" in match and bool(entry.get("rm")) != bool(match["removable"]):
+        return False
+    if "device_type" in match and guess_device_type(disk_path) != match["device_type"]:
+        return False
+    return True
+
+def match_device_usage(all_disks, inventory, layout):
+    """
+    Builds the same devices_dict as prompt_device_usage from the layout's
+    'devices' rules. Rules are applied in order, a disk is claimed by the first
+    rule that matches it, and disks no rule claims are not used.
+    """
+    claimed = {}
+    for rule in layout["devices"]:
+        count = rule.get("count", 1)
+        matched = 0
+        for disk in all_disks:
+            if disk in claimed or (count != "all" and matched >= int(count)):
+                continue
+            if disk_matches(inventory.get(os.path.basename(disk), {}), disk, rule.get("match") or {}):
+                claimed[disk] = rule.get("partition_location", "none")
+                matched += 1
+        if not matched and rule.get("required", True):
+            raise SystemExit(f"No disk matches layout rule: {rule}")
+
+    devices_dict = []
+    for disk in all_disks:
+        devices_dict.append({
+            "use_device": disk in claimed,
+            "partition_location": claimed.get(disk),
+            "device": disk,
+            "device_type": guess_device_type(disk)
+        })
+        if disk in claimed:
+            print(f"Layout: {disk} => {claimed[disk]}")
+    return devices_dict
+
+##############################################################################
+# 6b) Swap sizing from RAM and a swap policy
+##############################################################################
+
+# none:      no swap at all
+# zram:      compressed swap in RAM only (a 'zram' task in 999-artix-setup.py), no partition
+# zram+disk: zram first, plus a disk partition of half the RAM (1-16 GiB) for overflow
+# hibernate: a partition that holds all of RAM: RAM + sqrt(RAM), as hibernation needs
+SWAP_POLICIES = ["none", "zram", "zram+disk", "hibernate"]
+DEFAULT_SWAP_POLICY = "zram+disk"
+
+GIB = 1024**3
+
+def read_mem_total(meminfo_path="/proc/meminfo"):
+    """
+    MemTotal from /proc/meminfo, in bytes.
+    """
+    with open(meminfo_path, "r") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    raise SystemExit(f"No MemTotal in {meminfo_path}")
+
+def swap_size(policy, mem_bytes):
+    """
+    Size of the swap partition in bytes (rounded up to whole GiB) for a
+    policy, 0 when there should be none.
+    """
+    if policy not in SWAP_POLICIES:
+        raise SystemExit(f"Unknown swap policy: {policy} (one of {', '.join(SWAP_POLICIES)})")
+    if policy in ("none", "zram"):
+        return 0
+    if policy == "zram+disk":
+        size = min(max(mem_bytes // 2, GIB), 16 * GIB)
+    else:
+        size = mem_bytes + int(math.sqrt(mem_bytes / GIB) * GIB)
+    return -(-size // GIB) * GIB
+
+def apply_swap_policy(desired_partitions, policy, mem_bytes=None):
+    """
+    Returns desired_partitions with every 'size: auto' swap partition sized by
+    swap_size, or left out when the policy wants no swap partition.
+    """
+    resolved = {}
+    for label, config in desired_partitions.items():
+        if config.get("size") == "auto":
+            size = swap_size(policy, read_mem_total() if mem_bytes is None else mem_bytes)
+            if not size:
+                print(f"Swap policy '{policy}': no '{label}' partition.")
+                continue
+            print(f"Swap policy '{policy}': '{label}' partition of {format_size(size)}.")
+            config = dict(config, size=size)
+        resolved[label] = config
+    if policy.startswith("zram"):
+        print("Set up the zram part with a 'zram' task in 999-artix-setup.py (see 021-artix-setup-init.yaml).")
+    return resolved
+
+##############################################################################
+# 7) Layout engine: exact, 1 MiB-aligned partitions applied with one sfdisk call
+##############################################################################
+
+MIB = 1024**2
+
+# sfdisk type aliases (GPT and MBR) for the partition types used in DESIRED_PARTITIONS
+SFDISK_TYPES = {"fat32": "U", "efi": "U", "linuxswap": "S", "swap": "S"}
+
+def align_up(value, alignment=MIB):
+    return -(-value // alignment) * alignment
+
+def align_down(value, alignment=MIB):
+    return value // alignment * alignment
+
+def free_extents(disk_size, used):
+    """
+    Returns the free (start, end) byte ranges of a disk, end exclusive, aligned
+    to 1 MiB. The first MiB and the last MiB (GPT backup header) are kept free.
+    used is a list of (start, end) byte ranges, end exclusive.
+    """
+    extents = []
+    position = MIB
+    limit = align_down(disk_size - MIB)
+    for start, end in sorted(used):
+        if align_down(start) > position:
+            extents.append((position, min(align_down(start), limit)))
+        position = max(position, align_up(end))
+    if limit > position:
+        extents.append((position, limit))
+    return [(start, end) for start, end in extents if end > start]
+
+def layout_partitions(pdisk, wanted):
+    """
+    Places the wanted partitions into the free space of a parted disk object
+    (sizes in bytes, see get_parted_json).
+
+    wanted is a list of (label, config). Partitions with a 'size' go, in order,
+    into the first free extent they fit in. Partitions without one share what is
+    left of the largest remaining extent equally (a single one grows to the end).
+    Partition numbers are the lowest numbers not used by the existing table.
+
+    Returns a list of {"label", "config", "number", "start", "size", "partuuid"},
+    start and size in bytes.
+    Raises SystemExit if the partitions don't fit.
+    """
+    disk = pdisk["disk"]
+    disk_size = parse_size(disk.get("size", 0))
+    used = [(parse_size(p["start"]), parse_size(p["end"]) + 1) for p in disk.get("partitions", [])]
+    extents = free_extents(disk_size, used)
+    taken = {p["number"] for p in disk.get("partitions", [])}
+
+    placed = []
+    def next_number():
+        number = 1
+        while number in taken:
+            number += 1
+        taken.add(number)
+        return number
+
+    rest = []
+    for label, config in wanted:
+        if "size" not in config:
+            rest.append((label, config))
+            continue
+        size = align_up(parse_size(config["size"]))
+        for index, (start, end) in enumerate(extents):
+            if end - start >= size:
+                placed.append({"label": label, "config": config, "start": start, "size": size})
+                extents[index] = (start + size, end)
+                break
+        else:
+            raise SystemExit(f"{disk['path']}: no room for '{label}' ({config['size']}).")
+
+    if rest:
+        start, end = max(extents, key=lambda extent: extent[1] - extent[0], default=(0, 0))
+        share = align_down((end - start) // len(rest))
+        if share < MIB:
+            raise SystemExit(f"{disk['path']}: no room left for {', '.join(label for label, _ in rest)}.")
+        for index, (label, config) in enumerate(rest):
+            size = share if index < len(rest) - 1 else end - start - share * index
+            placed.append({"label": label, "config": config, "start": start + share * index, "size": size})
+
+    placed.sort(key=lambda part: part["start"])
+    for part in placed:
+        part["number"] = next_number()
+        part["partuuid"] = str(uuid.uuid4())
+    return placed
+
+def sfdisk_command(pdisk, placed):
+    """
+    Builds the single sfdisk call that writes every new partition of a disk.
+    The partitions are appended to an existing table, or written as a new GPT.
+    Starts and sizes are given in sectors; each line names its device so the
+    numbering is the one computed by layout_partitions.
+    """
+    disk = pdisk["disk"]
+    sector = int(disk.get("logical-sector-size", 512))
+    lines = [] if disk.get("label") in ("gpt", "msdos") else ["label: gpt"]
+    for part in sorted(placed, key=lambda part: part["number"]):
+        config = part["config"]
+        line = (f"{build_partition_devpath(disk['path'], part['number'])} : "
+                f"start={part['start'] // sector}, size={part['size'] // sector}, "
+                f"type={SFDISK_TYPES.get(config.get('type'), 'L')}")
+        if disk.get("label") != "msdos":
+            line += f', name="{part["label"]}", uuid={part["partuuid"]}'
+        lines.append(line)
+    append = " --append" if disk.get("label") in ("gpt", "msdos") else ""
+    return f"printf '%s\\n' {' '.join(shlex.quote(line) for line in lines)} | sfdisk{append} {disk['path']}"
+
+##############################################################################
+# 8) Encryption stage: benchmarked cipher, LUKS2 volumes, random-key swap
+##############################################################################
+
+CIPHER_BENCHMARK_CACHE = os.path.expanduser("~/.cache/artix-setup/cryptsetup-benchmark.json")
+
+# Used when 'cryptsetup benchmark' can't run (cryptsetup's own default)
+DEFAULT_CIPHER = {"cipher": "aes-xts-plain64", "key_size": 512}
+
+cipher_choice = None
+
+def cpu_model():
+    """
+    The CPU model name from /proc/cpuinfo, which decides the fastest cipher.
+    """
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return "unknown"
+
+def parse_cryptsetup_benchmark(output):
+    """
+    Reads the cipher lines of 'cryptsetup benchmark':
+    '        aes-xts        512b      2345.6 MiB/s      2401.2 MiB/s'
+    => [{"cipher": "aes-xts", "key_size": 512, "encrypt": 2345.6, "decrypt": 2401.2}]
+    Only XTS modes are kept, as those are the ones meant for disks.
+    """
+    results = []
+    for line in output.splitlines():
+        match = re.match(r"^\s*(\S+-xts)\s+(\d+)b\s+([0-9.]+)\s+MiB/s\s+([0-9.]+)\s+MiB/s", line)
+        if match:
+            results.append({
+                "cipher": match.group(1), "key_size": int(match.group(2)),
+                "encrypt": float(match.group(3)), "decrypt": float(match.group(4)),
+            })
+    return results
+
+def pick_cipher(results):
+    """
+    Picks the XTS cipher with the best of min(encrypt, decrypt). A larger key
+    wins unless the smaller one is more than 10% faster.
+    """
+    if not results:
+        return dict(DEFAULT_CIPHER)
+    speed = lambda result: min(result["encrypt"], result["decrypt"])
+    fastest = max(speed(result) for result in results)
+    candidates = [result for result in results if speed(result) >= fastest / 1.1]
+    best = max(candidates, key=lambda result: (result["key_size"], speed(result)))
+    return {"cipher": f"{best['cipher']}-plain64", "key_size": best["key_size"]}
+
+def choose_cipher():
+    """
+    Runs 'cryptsetup benchmark' once per CPU model and caches the pick in
+    CIPHER_BENCHMARK_CACHE; later runs on the same CPU reuse it.
+    """
+    global cipher_choice
+    if cipher_choice is not None:
+        return cipher_choice
+
+    model = cpu_model()
+    try:
+        with open(CIPHER_BENCHMARK_CACHE, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if model in cache:
+        cipher_choice = cache[model]
+        return cipher_choice
+
+    print("Benchmarking ciphers with 'cryptsetup benchmark'...")
+    result = subprocess.run("cryptsetup benchmark", shell=True, capture_output=True, text=True)
+    results = parse_cryptsetup_benchmark(result.stdout)
+    cipher_choice = pick_cipher(results)
+    print(f"Using {cipher_choice['cipher']} with a {cipher_choice['key_size']}-bit key.")
+    if results:
+        cache[model] = cipher_choice
+        try:
+            os.makedirs(os.path.dirname(CIPHER_BENCHMARK_CACHE), exist_ok=True)
+            with open(CIPHER_BENCHMARK_CACHE, "w") as f:
+                json.dump(cache, f, indent=2)
+        except OSError as e:
+            print(f"Could not cache the cipher benchmark: {e}", file=sys.stderr)
+    return cipher_choice
+
+def encryption_steps(part_label, partition_dev_path, pdisk, device_type, is_luks, key_file=None, luks_uuid=None,
+                     random_key_swap=True):
+    """
+    The steps that put a dm-crypt volume named after the partition on
+    partition_dev_path, and the mapper device to format and mount instead.
+
+    Swap gets a plain dm-crypt mapping keyed from /dev/urandom: no header and
+    no KDF, and a new key on every boot. That loses a hibernation image, so
+    without random_key_swap swap is treated like the rest. Everything else gets a LUKS2 volume
+    with the benchmarked cipher (luksFormat is skipped when is_luks, the
+    partition already holds one, and given luks_uuid as its UUID otherwise).
+    4K sectors are used on NVMe and on disks with 4K sectors, and NVMe volumes
+    skip the dm-crypt work queues.
+    """
+    choice = choose_cipher()
+    disk = pdisk["disk"]
+    four_k = device_type == "nvme" or max(int(disk.get("logical-sector-size", 512)),
+                                          int(disk.get("physical-sector-size", 512))) >= 4096
+    perf = " --perf-no_read_workqueue --perf-no_write_workqueue" if device_type == "nvme" else ""
+    sector = " --sector-size 4096" if four_k else ""
+    key = f" --key-file {key_file}" if key_file else ""
+    mapper = f"/dev/mapper/{part_label}"
+
+    def step(command, **fields):
+        result = plan_step("encrypt", part_label, partition_dev_path, command)
+        result.update(fields, mapper=mapper)
+        return result
+
+    if part_label.lower() == "swap" and random_key_swap:
+        options = f"--cipher {choice['cipher']} --key-size {choice['key_size']}{sector}"
+        return mapper, [step(f"cryptsetup open --type plain {options} --key-file /dev/urandom{perf} "
+                             f"{partition_dev_path} {part_label}", swap=True,
+                             cipher=choice["cipher"], key_size=choice["key_size"], sector_size=4096 if four_k else 512)]
+
+    steps = []
+    if not is_luks:
+        uuid_option = f" --uuid {luks_uuid}" if luks_uuid else ""
+        steps.append(step(f"cryptsetup luksFormat --batch-mode --type luks2 --cipher {choice['cipher']} "
+                          f"--key-size {choice['key_size']}{sector}{uuid_option}{key} {partition_dev_path}"))
+    persistent = " --persistent" if perf else ""
+    steps.append(step(f"cryptsetup open{key}{perf}{persistent} {partition_dev_path} {part_label}", swap=False))
+    return mapper, steps
+
+##############################################################################
+# 9) fstab and crypttab, by UUID, with options per device class
+##############################################################################
+
+# Filesystem type in fstab for the partition types used in DESIRED_PARTITIONS
+FSTAB_TYPES = {"fat32": "vfat", "linuxswap": "swap"}
+
+# Mount options per filesystem and device class. Flash keeps the default
+# journal commit interval shorter than spinning disks, which batch more.
+# ext4 and vfat on flash are trimmed periodically (fstrim) rather than with
+# synchronous online discard; btrfs gets its asynchronous discard.
+MOUNT_OPTIONS = {
+    "ext4": {"nvme": "defaults,noatime,commit=30", "ssd": "defaults,noatime,commit=30", "hdd": "defaults,noatime,commit=60"},
+    "btrfs": {"nvme": "defaults,noatime,ssd,discard=async", "ssd": "defaults,noatime,ssd,discard=async", "hdd": "defaults,noatime,autodefrag"},
+    "vfat": {"nvme": "defaults,noatime,umask=0077", "ssd": "defaults,noatime,umask=0077", "hdd": "defaults,noatime,umask=0077"},
+}
+
+# Faster devices get swapped to first
+SWAP_PRIORITY = {"nvme": 100, "ssd": 50, "hdd": 10}
+
+def device_class(device_type, rotational):
+    """
+    'nvme', 'ssd' or 'hdd', from guess_device_type and the rotational flag.
+    """
+    if device_type == "nvme":
+        return "nvme"
+    return "hdd" if rotational else "ssd"
+
+def format_command(fs_type, target_dev_path, fs_uuid):
+    """
+    The format command with a filesystem UUID chosen now, so fstab can name it
+    before it exists. Returns (command, fstab source); tools we don't know how
+    to give a UUID to keep their defaults and fstab uses the device path.
+    """
+    tool = fs_type.split()[0]
+    if tool in ("mkfs.ext2", "mkfs.ext3", "mkfs.ext4", "mkfs.btrfs", "mkswap"):
+        return f"{fs_type} -U {fs_uuid} {target_dev_path}", f"UUID={fs_uuid}"
+    if tool in ("mkfs.fat", "mkfs.vfat"):
+        volume_id = fs_uuid.replace("-", "")[:8].upper()
+        return f"{fs_type} -i {volume_id} {target_dev_path}", f"UUID={volume_id[:4]}-{volume_id[4:]}"
+    return f"{fs_type} {target_dev_path}", target_dev_path
+
+def fstab_entry(source, mount_point, fstype, dev_class):
+    """
+    One fstab line as a dict. Swap gets a priority by device class and discard
+    on flash; / is checked first, other filesystems after it.
+    """
+    if fstype == "swap":
+        options = f"defaults,pri={SWAP_PRIORITY[dev_class]}" + (",discard" if dev_class != "hdd" else "")
+        return {"source": source, "target": "none", "fstype": "swap", "options": options, "dump": 0, "pass": 0}
+    options = MOUNT_OPTIONS.get(fstype, {}).get(dev_class, "defaults,noatime")
+    return {"source": source, "target": mount_point, "fstype": fstype, "options": options,
+            "dump": 0, "pass": 1 if mount_point == "/" else 2}
+
+def crypttab_entry(step, source, key_file, dev_class):
+    """
+    One crypttab line as a dict for an encryption step of encryption_steps.
+    """
+    name = os.path.basename(step["mapper"])
+    if step.get("swap"):
+        options = f"swap,cipher={step['cipher']},size={step['key_size']}"
+        if step.get("sector_size", 512) != 512:
+            options += f",sector-size={step['sector_size']}"
+        return {"name": name, "source": source, "key": "/dev/urandom", "options": options}
+    options = "luks" + (",discard" if dev_class != "hdd" else "")
+    return {"name": name, "source": source, "key": key_file or "none", "options": options}
+
+def write_fstab(plan, path):
+    """
+    Writes plan["fstab"] as an fstab file, parents before children.
+    """
+    entries = sorted(plan["fstab"], key=lambda entry: (entry["target"] == "none", entry["target"].count("/"), entry["target"]))
+    lines = ["# Generated by 002-setup-partitions.py", "# <source> <target> <type> <options> <dump> <pass>"]
+    if plan.get("fstrim"):
+        lines.append(f"# Flash-backed: {', '.join(plan['fstrim'])}. Run fstrim periodically (e.g. 'fstrim -av' weekly).")
+    lines.extend(f"{e['source']}\t{e['target']}\t{e['fstype']}\t{e['options']}\t{e['dump']}\t{e['pass']}" for e in entries)
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def write_crypttab(plan, path):
+    """
+    Writes plan["crypttab"] as a crypttab file.
+    """
+    lines = ["# Generated by 002-setup-partitions.py", "# <name> <device> <password> <options>"]
+    lines.extend(f"{e['name']}\t{e['source']}\t{e['key']}\t{e['options']}" for e in plan["crypttab"])
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def verify_fstab_command(path):
+    return f"findmnt --verify --tab-file {shlex.quote(os.path.abspath(path))}"
+
+##############################################################################
+# 10) Assign Partitions Based on partition_location
+##############################################################################
+
+def assign_partitions(devices_dict, merged_data, mount_point_prefix=None, desired_partitions=None,
+                      script_path="partition_script.sh", luks_key_file=None,
+                      fstab_path="fstab", crypttab_path="crypttab", swap_policy=DEFAULT_SWAP_POLICY):
     """
     For each disk the user wants to use, find all DESIRED_PARTITIONS entries
     that match the same 'partition_location'. If a partition label in DESIRED_PARTITIONS
@@ -331,11 +910,42 @@ def assign_partitions(devices_dict, merged_data):
       ...
     ]
 
-    Additionally, exports a shell script to partition, format, and mount.
+    Returns the plan, with one queue of create/encrypt/format/mount steps per disk:
+    {
+      "mount_prefix": "/mnt",
+      "disks": [
+        {"device": "/dev/sda", "usage": "system", "steps": [
+          {"kind": "create", "partition": None, "device": "/dev/sda", "command": "printf ... | sfdisk /dev/sda"},
+          {"kind": "encrypt", "partition": "opt", "device": "/dev/sda5", "mapper": "/dev/mapper/opt", ...},
+          {"kind": "format", "partition": "opt", "device": "/dev/mapper/opt", "command": "mkfs.ext4 /dev/mapper/opt"},
+          ...
+        ]},
+      ]
+    }
+    and exports it as a shell script to partition, encrypt, format, and mount.
+    mount_point_prefix is prompted for when None, and desired_partitions
+    defaults to DESIRED_PARTITIONS. Partitions with 'size: auto' (swap) are
+    sized by swap_policy, see apply_swap_policy. Partitions with 'encrypt' go through
+    encryption_steps, unlocked with luks_key_file if given. Otherwise cryptsetup
+    asks for passphrases and the plan is marked "interactive": its encryption
+    steps then run one at a time in the foreground, see disk_stages.
+    Under the 'hibernate' policy swap is LUKS2 rather than random-key, and the
+    plan's "resume" holds the kernel resume= hint.
+
+    The plan also gets "fstab" and "crypttab" entries, by UUID (chosen now for
+    what gets formatted, 'lsblk-uuid' otherwise), which are written to
+    fstab_path and crypttab_path. The script checks the fstab with
+    'findmnt --verify' once everything is mounted.
     """
+    if desired_partitions is None:
+        desired_partitions = DESIRED_PARTITIONS
+    desired_partitions = apply_swap_policy(desired_partitions, swap_policy)
+    # Hibernation resumes from swap, so its key has to survive a reboot
+    random_key_swap = swap_policy != "hibernate"
 
     # Prompt for a mount_point prefix
-    mount_point_prefix = input("Enter a mount point prefix (or leave empty for no prefix): ").strip()
+    if mount_point_prefix is None:
+        mount_point_prefix = input("Enter a mount point prefix (or leave empty for no prefix): ").strip()
     if not mount_point_prefix:
         mount_point_prefix = ""
 
@@ -346,112 +956,392 @@ def assign_partitions(devices_dict, merged_data):
         parted_map[disk_path] = dobj
 
     # Check if home is allocated
-    home_allocated = any(dev_info["partition_location"].lower() == "home" for dev_info in devices_dict)
+    home_allocated = any((dev_info["partition_location"] or "").lower() == "home" for dev_info in devices_dict)
 
     if not home_allocated:
         print("No disk allocated to home. Allocating home to system disk.")
         for dev_info in devices_dict:
-            if dev_info["partition_location"].lower() == "system":
+            if (dev_info["partition_location"] or "").lower() == "system":
                 dev_info["partition_location"] = "system+home"
                 break
 
-    # Open the shell script file for writing
-    with open("partition_script.sh", "w") as script_file:
-        script_file.write("#!/bin/bash\n\n")
+    plan = {"mount_prefix": mount_point_prefix, "disks": [], "fstab": [], "crypttab": [], "fstrim": [],
+            "fstab_path": fstab_path}
 
-        # For each device the user wants to use, find partitions to create
-        for dev_info in devices_dict:
-            if not dev_info["use_device"]:
-                print(f"\nSkipping {dev_info['device']} (user chose not to use).")
-                continue
+    # For each device the user wants to use, find partitions to create
+    for dev_info in devices_dict:
+        if not dev_info["use_device"]:
+            print(f"\nSkipping {dev_info['device']} (user chose not to use).")
+            continue
 
-            disk_path = dev_info["device"]
-            usage = dev_info["partition_location"]
+        disk_path = dev_info["device"]
+        usage = dev_info["partition_location"]
 
-            parted_obj = parted_map.get(disk_path)
-            if not parted_obj:
-                print(f"\nNo parted info for {disk_path}. Possibly parted didn't see it. Skipping.")
-                continue
+        parted_obj = parted_map.get(disk_path)
+        if not parted_obj:
+            print(f"\nNo parted info for {disk_path}. Possibly parted didn't see it. Skipping.")
+            continue
 
-            print(f"\nAssigning partitions for device: {disk_path} (usage={usage})")
+        print(f"\nAssigning partitions for device: {disk_path} (usage={usage})")
+        steps = []
+        plan["disks"].append({"device": disk_path, "usage": usage, "steps": steps})
 
-            # Get existing filesystem labels from the merged parted+lsblk data
-            existing_labels = set()
-            for p in parted_obj["disk"].get("partitions", []):
-                fslabel = p.get("lsblk-label", "")
+        # Existing partitions by filesystem label or GPT partition name
+        existing = {}
+        for p in parted_obj["disk"].get("partitions", []):
+            for fslabel in (p.get("lsblk-label"), p.get("name")):
                 if fslabel:
-                    existing_labels.add(fslabel.lower())
-
-            partition_number = 1
-            # For each partition in DESIRED_PARTITIONS, check if it matches usage
-            for part_label, config in DESIRED_PARTITIONS.items():
-                desired_use = config.get("partition_location", "none")
-                if desired_use.lower() not in usage.lower():
-                    # Not for this device usage
-                    continue
-
-                partition_dev_path = build_partition_devpath(disk_path, partition_number)
-
-                # Check if a partition with that label already exists (case-insensitive match)
-                if part_label.lower() in existing_labels:
-                    print(f"  - Partition '{part_label}' already present on {disk_path}.")
-                    if config.get("format", False):
-                        fs_type = config['file_system_type']
-                        script_file.write(f"{fs_type} {partition_dev_path}\n")
-                    if "mount" in config:
-                        mount_point = config['mount']
-                        script_file.write(f"mkdir -p {mount_point_prefix}{mount_point}\n")
-                        script_file.write(f"mount {partition_dev_path} {mount_point_prefix}{mount_point}\n")
+                    existing.setdefault(fslabel.lower(), p["number"])
+
+        # For each partition in DESIRED_PARTITIONS, check if it matches usage
+        wanted = [(part_label, config) for part_label, config in desired_partitions.items()
+                  if config.get("partition_location", "none").lower() in usage.lower()]
+        to_create = [(part_label, config) for part_label, config in wanted if part_label.lower() not in existing]
+        placed = layout_partitions(parted_obj, to_create)
+        numbers = dict(existing)
+        numbers.update({part["label"].lower(): part["number"] for part in placed})
+        if placed:
+            steps.append(plan_step("create", None, disk_path, sfdisk_command(parted_obj, placed)))
+        starts = {part["label"]: part for part in placed}
+
+        by_number = {p["number"]: p for p in parted_obj["disk"].get("partitions", [])}
+        fstypes = {number: p.get("lsblk-fstype") for number, p in by_number.items()}
+        dev_class = device_class(dev_info.get("device_type"), parted_obj["disk"].get("rotational"))
+
+        for part_label, config in wanted:
+            number = numbers[part_label.lower()]
+            partition_dev_path = build_partition_devpath(disk_path, number)
+            fs_type = config['file_system_type']
+            mount_point = config.get('mount', None)
+            created = part_label in starts
+            is_luks = not created and fstypes.get(number) == "crypto_LUKS"
+            is_swap = part_label.lower() == "swap"
+            format_it = created or config.get("format", False) or (is_swap and config.get("encrypt", False))
+
+            # Placed by the layout engine, or already present (case-insensitive match)
+            if created:
+                part = starts[part_label]
+                print(f"  - Partition '{part_label}' does NOT exist on {disk_path}.")
+                print(f"    Will create {partition_dev_path}: start={part['start']}B size={part['size']}B "
+                      f"({format_size(part['size'])}) type={config['type']}")
+                print(f"    Then format with: {fs_type}")
+                if mount_point:
+                    print(f"    Then mount at: {mount_point}")
+            else:
+                print(f"  - Partition '{part_label}' already present on {disk_path} ({partition_dev_path}).")
+
+            existing_part = by_number.get(number, {})
+            partuuid = starts[part_label]["partuuid"] if created else existing_part.get("lsblk-partuuid")
+            target_dev_path = partition_dev_path
+            random_swap = False
+            fstab_source = f"UUID={existing_part['lsblk-uuid']}" if existing_part.get("lsblk-uuid") else partition_dev_path
+            if config.get("encrypt", False):
+                if is_luks or format_it:
+                    luks_uuid = existing_part.get("lsblk-uuid") if is_luks else str(uuid.uuid4())
+                    target_dev_path, encrypt = encryption_steps(part_label, partition_dev_path, parted_obj,
+                                                                dev_info.get("device_type"), is_luks, luks_key_file,
+                                                                luks_uuid, random_key_swap)
+                    steps.extend(encrypt)
+                    print(f"    Encrypted as {target_dev_path}")
+                    random_swap = encrypt[-1].get("swap", False)
+                    if random_swap:
+                        crypt_source = f"PARTUUID={partuuid}" if partuuid else partition_dev_path
+                    else:
+                        crypt_source = f"UUID={luks_uuid}" if luks_uuid else partition_dev_path
+                    plan["crypttab"].append(crypttab_entry(encrypt[-1], crypt_source, luks_key_file, dev_class))
+                    fstab_source = target_dev_path
                 else:
-                    # Create + format it here
-                    size = config.get('size', 'remaining')
-                    ptype = config['type']
-                    fs_type = config['file_system_type']
-                    mount_point = config.get('mount', None)
-
-                    print(f"  - Partition '{part_label}' does NOT exist on {disk_path}.")
-                    print(f"    Would create: size={size} type={ptype}")
-                    print(f"    Then format with: {fs_type}")
-                    if mount_point:
-                        print(f"    Then mount at: {mount_point}")
-
-                    # Write the commands to the shell script
-                    script_file.write(f"parted -s {disk_path} mkpart primary {ptype} {size} name {partition_number} {part_label}\n")
-                    script_file.write(f"{fs_type} {partition_dev_path}\n")
-                    if mount_point and part_label.lower() != "swap":
-                        script_file.write(f"mkdir -p {mount_point_prefix}{mount_point}\n")
-                        script_file.write(f"mount {partition_dev_path} {mount_point_prefix}{mount_point}\n")
-                
-                partition_number += 1
-
-    print("\nShell script 'partition_script.sh' has been created with the partitioning, formatting, and mounting commands.")
-    
+                    print(f"    Not encrypting {partition_dev_path}: it holds data and is not to be formatted.")
+
+            if format_it and not (is_luks and not config.get("format", False)):
+                command, fs_source = format_command(fs_type, target_dev_path, str(uuid.uuid4()))
+                steps.append(plan_step("format", part_label, target_dev_path, command))
+                # Random-key swap is recreated on every boot, with a new UUID
+                if not random_swap:
+                    fstab_source = fs_source
+
+            if is_swap and swap_policy == "hibernate":
+                plan["resume"] = f"resume={fstab_source}"
+
+            fstype = "swap" if is_swap else FSTAB_TYPES.get(config["type"], config["type"])
+            if mount_point or is_swap:
+                plan["fstab"].append(fstab_entry(fstab_source, mount_point, fstype, dev_class))
+                if dev_class != "hdd" and fstype != "swap" and fstype != "btrfs":
+                    plan["fstrim"].append(mount_point)
+
+            if mount_point and not is_swap:
+                target = f"{mount_point_prefix}{mount_point}"
+                step = plan_step("mount", part_label, target_dev_path, f"mkdir -p {target} && mount {target_dev_path} {target}")
+                step["mount_point"] = target
+                steps.append(step)
+
+    # Without a key file cryptsetup asks for each LUKS passphrase on the terminal
+    plan["interactive"] = not luks_key_file and any(
+        step["kind"] == "encrypt" and not step.get("swap") for disk in plan["disks"] for step in disk["steps"])
+
+    if swap_policy == "hibernate":
+        if plan.get("resume"):
+            print(f"\nHibernation: add {plan['resume']} to the kernel command line; an encrypted swap "
+                  f"must also be unlocked by the initramfs before it resumes.")
+        else:
+            print("\nHibernation needs resume=<swap device> on the kernel command line.")
+
+    write_fstab(plan, fstab_path)
+    write_crypttab(plan, crypttab_path)
+    print(f"\nWrote '{fstab_path}' ({len(plan['fstab'])} entries) and '{crypttab_path}' ({len(plan['crypttab'])} entries).")
+    write_partition_script(plan, script_path)
+    print(f"\nShell script '{script_path}' has been created with the partitioning, formatting, and mounting commands.")
+    return plan
+
+##############################################################################
+# 11) Partition plan => shell script, or executed per disk in parallel
+##############################################################################
+
+def plan_step(kind, partition, device, command):
+    """
+    One step of a disk's queue: kind is 'create', 'format' or 'mount'.
+    """
+    return {"kind": kind, "partition": partition, "device": device, "command": command}
+
+def disk_stages(disk):
+    """
+    The steps of one disk in three stages: the partition table write and a
+    single 'udevadm settle' so the new partition nodes exist, then the
+    encryption steps, then every format. Interactive plans run the middle
+    stage of every disk serially, so passphrase prompts don't interleave.
+    """
+    creates = [step for step in disk["steps"] if step["kind"] == "create"]
+    encrypts = [step for step in disk["steps"] if step["kind"] == "encrypt"]
+    formats = [step for step in disk["steps"] if step["kind"] == "format"]
+    if creates:
+        creates.append(plan_step("settle", None, disk["device"], "udevadm settle"))
+    return creates, encrypts, formats
+
+def disk_queue(disk):
+    """
+    The steps of one disk, in order.
+    """
+    creates, encrypts, formats = disk_stages(disk)
+    return creates + encrypts + formats
+
+def mount_steps(plan):
+    """
+    The mount steps of every disk, parents first (/ before /boot before /boot/efi),
+    since a mount point on one disk can live on a filesystem of another.
+    """
+    mounts = [step for disk in plan["disks"] for step in disk["steps"] if step["kind"] == "mount"]
+    return sorted(mounts, key=lambda step: os.path.normpath(step["mount_point"]).rstrip("/").count("/"))
+
+def disk_function_name(disk_path):
+    """
+    /dev/nvme0n1 => disk_nvme0n1
+    """
+    return "disk_" + re.sub(r"[^A-Za-z0-9_]", "_", disk_path.replace("/dev/", ""))
+
+def parallel_script(queues, suffix=""):
+    """
+    Script lines defining one function per disk queue, starting them all in the
+    background and waiting for every one. queues is a list of (disk, steps).
+    """
+    lines = []
+    for disk, steps in queues:
+        lines.append(f"{disk_function_name(disk['device'])}{suffix}() {{")
+        lines.extend(f"    {step['command']}" for step in steps)
+        lines.extend(["    :", "}", ""])
+
+    lines.append("pids=()")
+    for disk, _ in queues:
+        lines.append(f"{disk_function_name(disk['device'])}{suffix} &")
+        lines.append("pids+=($!)")
+    lines.append('for pid in "${pids[@]}"; do wait "$pid"; done')
+    lines.append("")
+    return lines
+
+def write_partition_script(plan, script_path):
+    """
+    Writes the plan as a bash script: one function per disk, all started in the
+    background and waited for, then the mounts in order and the fstab check.
+    An interactive plan partitions in parallel, encrypts in the foreground one
+    volume at a time, then formats in parallel.
+    """
+    lines = ["#!/bin/bash", "set -e", ""]
+    if plan.get("interactive"):
+        stages = [(disk, disk_stages(disk)) for disk in plan["disks"]]
+        lines += parallel_script([(disk, creates) for disk, (creates, _, _) in stages], "_prepare")
+        lines.extend(step["command"] for _, (_, encrypts, _) in stages for step in encrypts)
+        lines.append("")
+        lines += parallel_script([(disk, formats) for disk, (_, _, formats) in stages], "_format")
+    else:
+        lines += parallel_script([(disk, disk_queue(disk)) for disk in plan["disks"]])
+
+    lines.extend(step["command"] for step in mount_steps(plan))
+    if plan.get("fstab_path"):
+        lines.extend(["", verify_fstab_command(plan["fstab_path"])])
+    with open(script_path, "w") as script_file:
+        script_file.write("\n".join(lines) + "\n")
+    os.chmod(script_path, 0o755)
+
+def root_command(command):
+    """
+    Prefixes a command with sudo unless we already run as root.
+    """
+    return command if os.geteuid() == 0 else f"sudo sh -c {shlex.quote(command)}"
+
+def run_step(label, index, total, step, print_lock, interactive=False):
+    """
+    Runs one step and reports its outcome and duration. Returns the step with
+    'returncode' and 'duration' added. An interactive step keeps the terminal,
+    so cryptsetup can ask for a passphrase.
+    """
+    start = time.monotonic()
+    if interactive:
+        print(f"[{label}] {index}/{total} {step['kind']:<6} {step['command']}")
+    result = subprocess.run(root_command(step["command"]), shell=True, capture_output=not interactive, text=True)
+    duration = time.monotonic() - start
+    with print_lock:
+        status = "ok" if result.returncode == 0 else f"failed ({result.returncode})"
+        print(f"[{label}] {index}/{total} {step['kind']:<6} {step['command']} => {status} in {duration:.1f}s")
+        if result.returncode != 0 and result.stderr:
+            print(result.stderr.strip(), file=sys.stderr)
+    return dict(step, returncode=result.returncode, duration=round(duration, 3))
+
+def run_disk_queue(disk, print_lock, steps=None):
+    """
+    Runs one disk's steps (default: its whole queue) in order and stops at the
+    first failure.
+    """
+    label = os.path.basename(disk["device"])
+    steps = disk_queue(disk) if steps is None else steps
+    results = []
+    for index, step in enumerate(steps, start=1):
+        results.append(run_step(label, index, len(steps), step, print_lock))
+        if results[-1]["returncode"] != 0:
+            break
+    return results
+
+def execute_plan(plan, jobs=None):
+    """
+    Runs the queues of different disks concurrently (each disk stays serial),
+    then the mounts in order once every disk is done, and checks the generated
+    fstab. The mounts are skipped when a disk failed. Returns (success, step results).
+    An interactive plan runs in three phases instead: partitioning in parallel,
+    encryption one step at a time in the foreground, formatting in parallel.
+    """
+    print_lock = threading.Lock()
+    results = []
+    start = time.monotonic()
+    workers = jobs or max(1, len(plan["disks"]))
+
+    def run_parallel(queues):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for disk_results in executor.map(lambda queue: run_disk_queue(queue[0], print_lock, queue[1]), queues):
+                results.extend(disk_results)
+        return all(result["returncode"] == 0 for result in results)
+
+    if plan.get("interactive"):
+        stages = [(disk, disk_stages(disk)) for disk in plan["disks"]]
+        success = run_parallel([(disk, creates) for disk, (creates, _, _) in stages])
+        encrypts = [step for _, (_, steps, _) in stages for step in steps] if success else []
+        for index, step in enumerate(encrypts, start=1):
+            results.append(run_step("encrypt", index, len(encrypts), step, print_lock, interactive=True))
+            if results[-1]["returncode"] != 0:
+                success = False
+                break
+        if success:
+            success = run_parallel([(disk, formats) for disk, (_, _, formats) in stages])
+    else:
+        success = run_parallel([(disk, disk_queue(disk)) for disk in plan["disks"]])
+
+    if success:
+        mounts = mount_steps(plan)
+        for index, step in enumerate(mounts, start=1):
+            results.append(run_step("mount", index, len(mounts), step, print_lock))
+            if results[-1]["returncode"] != 0:
+                success = False
+                break
+        if success and plan.get("fstab_path"):
+            verify = plan_step("verify", None, plan["fstab_path"], verify_fstab_command(plan["fstab_path"]))
+            results.append(run_step("fstab", 1, 1, verify, print_lock))
+            success = results[-1]["returncode"] == 0
+    else:
+        print("A disk failed, not mounting anything.", file=sys.stderr)
+
+    print(f"\nPlan {'completed' if success else 'FAILED'} in {time.monotonic() - start:.1f}s")
+    for result in sorted(results, key=lambda result: result["duration"], reverse=True)[:5]:
+        print(f"  {result['duration']:>8.1f}s  {result['command']}")
+    return success, results
+
 ##############################################################################
 # MAIN
 ##############################################################################
 
-def main():
+def parse_arguments(argv=None):
+    """
+    Parses the command line.
+    """
+    parser = argparse.ArgumentParser(
+        description="Plan partitions on the selected disks and write a shell script that creates, formats and mounts them."
+    )
+    parser.add_argument("--layout", metavar="FILE", help="YAML/JSON layout file that picks disks and partitions without prompting")
+    parser.add_argument("--mount-prefix", help="Mount point prefix (default: the layout's mount_prefix, or prompt)")
+    parser.add_argument("--output", default="partition_script.sh", metavar="SCRIPT", help="Path of the generated script (default: partition_script.sh)")
+    parser.add_argument("--device", action="append", default=[], metavar="PATH", help="Also offer this device as a disk, e.g. a loop device over a test image (repeatable)")
+    parser.add_argument("--luks-key-file", metavar="PATH", help="Key file for the LUKS volumes (default: the layout's luks_key_file, or cryptsetup asks)")
+    parser.add_argument("--fstab", default="fstab", metavar="PATH", help="Path of the generated fstab (default: fstab)")
+    parser.add_argument("--crypttab", default="crypttab", metavar="PATH", help="Path of the generated crypttab (default: crypttab)")
+    parser.add_argument("--swap-policy", choices=SWAP_POLICIES, help=f"How swap is sized from RAM (default: the layout's swap_policy, or {DEFAULT_SWAP_POLICY})")
+    parser.add_argument("--plan-json", metavar="PATH", help="Also write the plan (per-disk queues of steps) as JSON")
+    parser.add_argument("--execute", action="store_true", help="Run the plan now, disks in parallel, instead of only writing the script")
+    parser.add_argument("--jobs", type=int, metavar="N", help="Number of disks to work on at once with --execute (default: all)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    layout = load_layout(args.layout) if args.layout else None
+
     # 1) Show all block devices & pick which to use
-    all_disks = list_all_block_devices()
+    inventory = load_inventory()
+    all_disks = list_all_block_devices(inventory)
+    all_disks += [device for device in args.device if device not in all_disks]
     if not all_disks:
         print("\nNo disk-type devices found on system!")
         sys.exit(1)
 
-    devices_dict = prompt_device_usage(all_disks)
+    if layout:
+        devices_dict = match_device_usage(all_disks, inventory, layout)
+    else:
+        devices_dict = prompt_device_usage(all_disks)
 
-    # 2) Merge parted + lsblk once
-    merged_data = merge_parted_and_lsblk()
+    # 2) Run parted on the selected disks only and merge with the inventory
+    selected = [d["device"] for d in devices_dict if d["use_device"]]
+    merged_data = merge_parted_and_lsblk(selected, inventory)
     if not merged_data:
         print("No parted or lsblk data found. Exiting.")
         sys.exit(1)
 
     # 3) Assign partitions based on usage
-    assign_partitions(devices_dict, merged_data)
+    mount_point_prefix = args.mount_prefix
+    if mount_point_prefix is None and layout:
+        mount_point_prefix = layout.get("mount_prefix", "")
+    swap_policy = args.swap_policy or (layout.get("swap_policy") if layout else None) or DEFAULT_SWAP_POLICY
+    luks_key_file = args.luks_key_file or (layout.get("luks_key_file") if layout else None)
+    plan = assign_partitions(devices_dict, merged_data, mount_point_prefix,
+                             layout.get("partitions") if layout else None, args.output, luks_key_file,
+                             args.fstab, args.crypttab, swap_policy)
+    if args.plan_json:
+        with open(args.plan_json, "w") as plan_file:
+            json.dump(plan, plan_file, indent=2)
 
     # 4) Show final choices
     print("\n=== Final devices_dict ===")
     for d in devices_dict:
         print(d)
 
+    # 5) Optionally run the plan
+    if args.execute:
+        success, _ = execute_plan(plan, args.jobs)
+        if not success:
+            sys.exit(1)
+
 if __name__ == "__main__":
     main()
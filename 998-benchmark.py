@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the orchestration overhead of 999-artix-setup.py and
+002-setup-partitions.py.
+
+Fake yay, pacman, sudo, sv, dinitctl, parted and lsblk executables with a
+configurable latency are put first on PATH, and every file the runner writes
+goes under a temporary root. The runner is then driven with generated YAML
+plans and disk layouts of increasing size. For each size the wall time, the
+number of spawned tools and the overhead per step (wall time minus the time
+spent in the fake tools) are reported, so regressions in process-spawn count
+or wall time show up before deployment.
+
+Usage:
+    ./998-benchmark.py
+    ./998-benchmark.py --packages 10 100 1000 5000 --disks 1 8 64 --latency 0.005
+    ./998-benchmark.py --json bench_output.json
+"""
+
+import argparse
+import builtins
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+##############################################################################
+# 1) Fake tools
+##############################################################################
+
+STUB_TOOLS = ["yay", "pacman", "sudo", "sv", "dinitctl", "parted", "lsblk"]
+
+# Every fake tool logs its invocation and sleeps for $STUB_LATENCY seconds.
+# sudo runs its command; parted and lsblk print pre-generated output.
+STUB_TEMPLATE = """#!/bin/sh
+echo "{name} $*" >> "$STUB_LOG"
+sleep "$STUB_LATENCY"
+{body}
+"""
+
+STUB_BODIES = {
+    "sudo": 'while [ "${1#-}" != "$1" ]; do shift; done\nexec env "$@"',
+    "pacman": 'case "$1" in -Qq|-Slq) exit 0;; esac\nexit 0',
+    "parted": 'for arg in "$@"; do case "$arg" in /dev/*) cat "$STUB_DATA/parted-${arg#/dev/}.json";; esac; done',
+    "lsblk": 'cat "$STUB_DATA/lsblk.json"',
+}
+
+def install_stub_tools(bin_dir):
+    """
+    Writes the fake tools into bin_dir.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    for name in STUB_TOOLS:
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as stub:
+            stub.write(STUB_TEMPLATE.format(name=name, body=STUB_BODIES.get(name, "exit 0")))
+        os.chmod(path, 0o755)
+
+def count_spawns(log_path):
+    """
+    Returns the number of fake tool invocations logged so far, and truncates the log.
+    """
+    try:
+        with open(log_path, "r") as log:
+            count = sum(1 for _ in log)
+    except FileNotFoundError:
+        count = 0
+    open(log_path, "w").close()
+    return count
+
+##############################################################################
+# 2) Loading the scripts under test
+##############################################################################
+
+def load_script(filename):
+    """
+    Imports one of the numbered scripts as a module.
+    """
+    spec = importlib.util.spec_from_file_location(filename.replace("-", "_").replace(".py", ""), os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+##############################################################################
+# 3) Generated workloads
+##############################################################################
+
+def generate_plan(package_count, root, batch=False):
+    """
+    Generates a plan with package_count packages spread over tasks of up to 50
+    packages, plus one file write and one runit service per task.
+    """
+    plan = {
+        "service_paths": {
+            "service_path": os.path.join(root, "run/runit/service/"),
+            "sv_path": os.path.join(root, "etc/runit/sv/"),
+        }
+    }
+    os.makedirs(plan["service_paths"]["service_path"], exist_ok=True)
+    for task_index, start in enumerate(range(0, package_count, 50)):
+        packages = [f"world/bench-package-{index}" for index in range(start, min(start + 50, package_count))]
+        plan[f"task_{task_index}"] = {
+            "packages": {"command": "yay -S {package} --needed --noconfirm", "package": packages, "batch": batch},
+            "file": {"name": os.path.join(root, f"etc/bench/task_{task_index}.conf"), "content": f"task = {task_index}\n"},
+        }
+        plan[f"service_{task_index}"] = {
+            "setup_service": {
+                "path_init": True,
+                "run_file": {"content": "#!/bin/sh\nexec sleep infinity\n"},
+                "log_file": {"content": "#!/bin/sh\nexec svlogd -tt /var/log/bench\n"},
+                "service_init": True,
+            }
+        }
+    return plan
+
+def generate_disks(disk_count, data_dir):
+    """
+    Writes per-disk parted output and 'lsblk -J -b -O' output describing disk_count
+    disks with three labelled partitions each, and returns the devices_dict
+    assign_partitions expects.
+    """
+    parted = {}
+    lsblk = {"blockdevices": []}
+    devices_dict = []
+    for index in range(disk_count):
+        name = f"nvme{index}n1"
+        path = f"/dev/{name}"
+        partitions = []
+        children = []
+        for number, label in enumerate(["efi", "boot", "root"], start=1):
+            start = number * 2**20
+            partitions.append({"number": number, "start": f"{start}B", "end": f"{start + 2**20 - 1}B", "type": "primary"})
+            children.append({
+                "name": f"{name}p{number}", "path": f"{path}p{number}", "type": "part", "size": 2**30,
+                "fstype": "ext4", "label": label, "uuid": f"{index:04x}-{number}", "mountpoints": [None],
+            })
+        parted[name] = {"disk": {"path": path, "size": f"{1000 * 2**30}B", "partitions": partitions}}
+        lsblk["blockdevices"].append({
+            "name": name, "path": path, "type": "disk", "size": 1000 * 2**30, "rota": False, "fstype": None, "children": children,
+        })
+        devices_dict.append({
+            "use_device": True,
+            "partition_location": "system" if index == 0 else "home",
+            "device": path,
+            "device_type": "nvme",
+        })
+
+    os.makedirs(data_dir, exist_ok=True)
+    for name, entry in parted.items():
+        with open(os.path.join(data_dir, f"parted-{name}.json"), "w") as parted_file:
+            json.dump(entry, parted_file, indent=2)
+    with open(os.path.join(data_dir, "lsblk.json"), "w") as lsblk_file:
+        json.dump(lsblk, lsblk_file)
+    return devices_dict
+
+##############################################################################
+# 4) Benchmarks
+##############################################################################
+
+def result_row(name, size, wall, spawns, steps, latency):
+    """
+    Builds one result: wall time, spawns, and overhead per step excluding fake tool latency.
+    """
+    overhead = max(0.0, wall - spawns * latency)
+    return {
+        "benchmark": name,
+        "size": size,
+        "wall_s": round(wall, 4),
+        "spawns": spawns,
+        "steps": steps,
+        "overhead_s": round(overhead, 4),
+        "overhead_per_step_ms": round(overhead / steps * 1000, 3) if steps else 0.0,
+    }
+
+def bench_setup(sizes, work_dir, latency, batch):
+    """
+    Runs parse_and_execute over generated plans of increasing package counts.
+    """
+    setup = load_script("999-artix-setup.py")
+    setup.logger.setLevel(logging.WARNING)
+    setup.COMMAND_HISTORY_PATH = os.path.join(work_dir, "command-durations.json")
+    setup.aur_cache_max_bytes = 0  # The generated packages aren't in the AUR
+    setup.SERVICE_READY_TIMEOUT = 0  # The fake sv never brings services up
+    log_path = os.environ["STUB_LOG"]
+
+    results = []
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix=f"setup-{size}.", dir=work_dir)
+        plan = generate_plan(size, root, batch=batch)
+        steps = size + 2 * (len(plan) - 1)
+        setup.load_installed_packages(os.path.join(root, "empty-pacman-db"))
+        count_spawns(log_path)
+        start = time.perf_counter()
+        setup.parse_and_execute(plan, batch=batch)
+        wall = time.perf_counter() - start
+        results.append(result_row("setup-batch" if batch else "setup", size, wall, count_spawns(log_path), steps, latency))
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+def bench_partitions(sizes, work_dir, latency):
+    """
+    Runs load_inventory, merge_parted_and_lsblk and assign_partitions over
+    generated disk layouts.
+    """
+    partitions = load_script("002-setup-partitions.py")
+    partitions.SYS_CLASS_BLOCK = os.path.join(work_dir, "empty-sys-class-block")  # Only the fake lsblk is seen
+    partitions.cipher_choice = dict(partitions.DEFAULT_CIPHER)  # Don't time 'cryptsetup benchmark'
+    log_path = os.environ["STUB_LOG"]
+    saved_input, saved_cwd, saved_stdout = builtins.input, os.getcwd(), sys.stdout
+
+    results = []
+    try:
+        builtins.input = lambda prompt="": ""
+        for size in sizes:
+            root = tempfile.mkdtemp(prefix=f"disks-{size}.", dir=work_dir)
+            devices_dict = generate_disks(size, os.environ["STUB_DATA"])
+            os.chdir(root)
+            count_spawns(log_path)
+            sys.stdout = open(os.devnull, "w")
+            start = time.perf_counter()
+            inventory = partitions.load_inventory()
+            merged = partitions.merge_parted_and_lsblk([d["device"] for d in devices_dict], inventory)
+            partitions.assign_partitions(devices_dict, merged)
+            wall = time.perf_counter() - start
+            sys.stdout.close()
+            sys.stdout = saved_stdout
+            results.append(result_row("partitions", size, wall, count_spawns(log_path), size, latency))
+            os.chdir(saved_cwd)
+            shutil.rmtree(root, ignore_errors=True)
+    finally:
+        builtins.input = saved_input
+        sys.stdout = saved_stdout
+        os.chdir(saved_cwd)
+    return results
+
+def print_results(results):
+    """
+    Prints the results as a table, one scaling curve per benchmark.
+    """
+    header = ["benchmark", "size", "wall_s", "spawns", "steps", "overhead_s", "overhead_per_step_ms"]
+    print("-" * 95)
+    print("{:<14} {:>6} {:>10} {:>8} {:>8} {:>12} {:>22}".format(*header))
+    print("-" * 95)
+    for row in results:
+        print("{:<14} {:>6} {:>10} {:>8} {:>8} {:>12} {:>22}".format(*(row[key] for key in header)))
+
+##############################################################################
+# MAIN
+##############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the orchestration overhead of the setup and partition scripts.")
+    parser.add_argument("--packages", type=int, nargs="+", default=[10, 100, 1000, 5000], help="Package counts to benchmark")
+    parser.add_argument("--disks", type=int, nargs="+", default=[1, 4, 16, 64], help="Disk counts to benchmark")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each fake tool sleeps (default: 0)")
+    parser.add_argument("--json", metavar="PATH", help="Also write the results as JSON")
+    parser.add_argument("--skip-setup", action="store_true", help="Skip the 999-artix-setup.py benchmark")
+    parser.add_argument("--skip-partitions", action="store_true", help="Skip the 002-setup-partitions.py benchmark")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="artix-bench.")
+    bin_dir = os.path.join(work_dir, "bin")
+    install_stub_tools(bin_dir)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ["STUB_LOG"] = os.path.join(work_dir, "spawns.log")
+    os.environ["STUB_DATA"] = os.path.join(work_dir, "data")
+    os.environ["STUB_LATENCY"] = str(args.latency)
+    os.environ["HOME"] = os.path.join(work_dir, "home")
+    os.makedirs(os.environ["HOME"], exist_ok=True)
+
+    results = []
+    try:
+        if not args.skip_setup:
+            results += bench_setup(args.packages, work_dir, args.latency, batch=False)
+            results += bench_setup(args.packages, work_dir, args.latency, batch=True)
+        if not args.skip_partitions:
+            results += bench_partitions(args.disks, work_dir, args.latency)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+if __name__ == "__main__":
+    main()
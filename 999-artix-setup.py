@@ -1,5 +1,4 @@
 import subprocess
-import yaml
 import os
 import sys
 import shutil
@@ -8,221 +7,2471 @@ from datetime import datetime
 import logging
 import argparse  # Import argparse for command-line arguments
 
-# Set up argument parser
-parser = argparse.ArgumentParser(
-    description="Artix setup script. This script requires a YAML configuration file to execute the specified tasks.",
-    epilog="Use the --debug flag to enable verbose logging for debugging purposes."
+# PyYAML is imported only when a plan has to be parsed (see load_yaml_documents),
+# so importing this module and cached runs don't pay for it.
+
+logger = logging.getLogger(__name__)
+
+import time  # Import the time module
+import re
+import hashlib
+import stat
+from contextlib import contextmanager
+import shlex
+import signal
+import json
+import random
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+PACMAN_LOCAL_DB = "/var/lib/pacman/local"
+
+# Anything that takes the pacman database lock runs under this lock, so tasks can
+# run concurrently without pacman/yay failing on /var/lib/pacman/db.lck.
+pacman_lock = threading.RLock()
+PACMAN_COMMAND_PATTERN = re.compile(r"\b(pacman|yay|paru|makepkg)\b")
+
+# Serialises interactive prompts when tasks run concurrently.
+prompt_lock = threading.Lock()
+
+def uses_pacman_lock(command):
+    """
+    Returns True if a shell command is likely to take the pacman database lock.
+    """
+    return bool(PACMAN_COMMAND_PATTERN.search(command)) and "pacman-key" not in command
+
+# Names of installed packages, loaded once by load_installed_packages().
+# None means the index is disabled and every package is passed to the installer.
+installed_packages = None
+
+def load_installed_packages(db_path=PACMAN_LOCAL_DB):
+    """
+    Reads the local pacman database once into a set of installed package names.
+    Each entry in the database directory is named <name>-<pkgver>-<pkgrel>, so the
+    name is recovered without spawning pacman. Falls back to 'pacman -Qq' if the
+    directory can't be read.
+    :param db_path: Path to the pacman local database.
+    :return: Set of installed package names.
+    """
+    global installed_packages
+    try:
+        names = set()
+        for entry in os.listdir(db_path):
+            if os.path.isdir(os.path.join(db_path, entry)):
+                names.add(entry.rsplit("-", 2)[0])
+    except OSError as e:
+        logger.debug(f"Could not read {db_path}: {e}. Falling back to pacman -Qq")
+        try:
+            result = subprocess.run(["pacman", "-Qq"], capture_output=True, text=True, check=True)
+            names = set(result.stdout.split())
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Could not build installed package index: {e}")
+            names = set()
+    logger.info(f"Loaded {len(names)} installed packages into the index")
+    installed_packages = names
+    return names
+
+def package_name(package):
+    """
+    Strips the repository prefix from a package spec ('world/git' -> 'git').
+    """
+    return package.rsplit("/", 1)[-1]
+
+def filter_installed_packages(packages):
+    """
+    Drops packages that are already installed according to the package index.
+    :param packages: List of package specs, optionally 'repo/name' prefixed.
+    :return: List of packages that still need installing.
+    """
+    if installed_packages is None:
+        return list(packages)
+    missing = [package for package in packages if package_name(package) not in installed_packages]
+    skipped = len(packages) - len(missing)
+    if skipped:
+        logger.info(f"Skipping {skipped} already installed package(s)")
+    return missing
+
+def mark_installed(packages):
+    """
+    Records packages as installed so later tasks skip them.
+    """
+    if installed_packages is not None:
+        installed_packages.update(package_name(package) for package in packages)
+
+PACMAN_CONF = "/etc/pacman.conf"
+PACMAN_SYNC_DB = "/var/lib/pacman/sync"
+PACMAN_CACHE_DIR = "/var/cache/pacman/pkg"
+
+# Package name -> threading.Event set once the background prefetch has finished
+# (successfully or not) with the group containing that package.
+prefetch_events = {}
+
+def collect_packages(yaml_content):
+    """
+    Collects the packages named by every task, in task order.
+    :param yaml_content: Parsed YAML dictionary.
+    :return: List of (task name, list of package specs) tuples.
+    """
+    groups = []
+    for task_name, task_config in yaml_content.items():
+        if task_name == "service_paths" or not isinstance(task_config, dict):
+            continue
+        packages = []
+        sections = [task_config.get("packages")]
+        sections += [service_config.get("packages") for _, service_config in task_services(task_name, task_config)]
+        for section in sections:
+            if isinstance(section, dict):
+                packages.extend(section.get("package", []) or [])
+        if packages:
+            groups.append((task_name, packages))
+    return groups
+
+def list_sync_packages():
+    """
+    Returns the names of all packages available in the sync repositories.
+    AUR packages aren't in this set and are left to yay.
+    """
+    try:
+        result = subprocess.run(["pacman", "-Slq"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f"Could not list sync packages: {e}")
+        return set()
+    return set(result.stdout.split())
+
+def prepare_prefetch_root(parallel_downloads):
+    """
+    Creates a private database path and pacman.conf for download-only runs.
+    The database path links to the real local and sync databases, so pacman
+    resolves against the same state without taking /var/lib/pacman/db.lck and
+    can run while other tasks install packages.
+    :param parallel_downloads: Value for ParallelDownloads in the generated pacman.conf.
+    :return: Tuple of (temporary directory, dbpath, config path).
+    """
+    root = tempfile.mkdtemp(prefix="artix-prefetch.")
+    db_path = os.path.join(root, "db")
+    os.makedirs(db_path)
+    os.symlink(PACMAN_LOCAL_DB, os.path.join(db_path, "local"))
+    os.symlink(PACMAN_SYNC_DB, os.path.join(db_path, "sync"))
+
+    config_path = os.path.join(root, "pacman.conf")
+    with open(PACMAN_CONF, "r") as source, open(config_path, "w") as config:
+        for line in source:
+            if re.match(r"^\s*#?\s*ParallelDownloads\s*=", line):
+                continue
+            config.write(line)
+            if line.strip() == "[options]":
+                config.write(f"ParallelDownloads = {parallel_downloads}\n")
+    return root, db_path, config_path
+
+def prefetch_packages(groups, parallel_downloads=5):
+    """
+    Downloads packages into the pacman cache without installing them, one task's
+    package list at a time in task order, so later installs hit a warm cache.
+    Every package's event in prefetch_events is set when its group is done.
+    :param groups: List of (task name, list of package specs) tuples.
+    :param parallel_downloads: Number of parallel downloads pacman uses.
+    """
+    root = None
+    try:
+        sync_packages = sync_package_names()
+        root, db_path, config_path = prepare_prefetch_root(parallel_downloads)
+        for task_name, packages in groups:
+            targets = [package for package in filter_installed_packages(packages) if package_name(package) in sync_packages]
+            if targets:
+                warm_cache_from_fleet(targets)
+                logger.info(f"Prefetching {len(targets)} package(s) for task: {task_name}")
+                command = shlex.join([
+                    "pacman", "-Sw", "--noconfirm", "--needed",
+                    "--config", config_path, "--dbpath", db_path, "--cachedir", PACMAN_CACHE_DIR,
+                    *targets
+                ]) + " > /dev/null"
+                if privileged_available():
+                    result = privileged_call("run", command=command)
+                else:
+                    # Never prompt for a password from this background thread
+                    result = run_command("sudo -n " + command, stdin=subprocess.DEVNULL)
+                if result["returncode"] != 0:
+                    logger.warning(f"Prefetch failed for task {task_name}: {result['stderr'].strip()}")
+            for package in packages:
+                prefetch_events[package_name(package)].set()
+    except Exception as e:
+        logger.warning(f"Package prefetch stopped: {e}")
+    finally:
+        for event in prefetch_events.values():
+            event.set()
+        if root:
+            shutil.rmtree(root, ignore_errors=True)
+
+def start_prefetch(yaml_content, parallel_downloads=5):
+    """
+    Starts prefetching every package named in the YAML file on a background thread.
+    :param yaml_content: Parsed YAML dictionary.
+    :param parallel_downloads: Number of parallel downloads pacman uses.
+    :return: The started thread.
+    """
+    groups = collect_packages(yaml_content)
+    for _, packages in groups:
+        for package in packages:
+            prefetch_events.setdefault(package_name(package), threading.Event())
+    thread = threading.Thread(target=prefetch_packages, args=(groups, parallel_downloads), daemon=True)
+    thread.start()
+    return thread
+
+def wait_for_prefetch(packages):
+    """
+    Blocks until the background prefetch has finished with the given packages.
+    """
+    for package in packages:
+        event = prefetch_events.get(package_name(package))
+        if event is not None and not event.is_set():
+            logger.debug(f"Waiting for prefetch of {package}")
+            event.wait()
+
+# Timing spans of every task and command, exported by export_trace_jsonl(),
+# export_chrome_trace() and summarised by log_slowest_steps()
+trace_spans = []
+trace_lock = threading.Lock()
+TRACE_EPOCH = time.perf_counter()
+TRACE_WALL_EPOCH = time.time()
+
+@contextmanager
+def trace_span(category, name, **fields):
+    """
+    Times the enclosed block and records it as a span. The yielded dictionary can
+    be filled with extra fields such as exit_code, retries or output_bytes.
+    :param category: Kind of step ('task', 'shell', 'python', 'packages', 'file', 'service').
+    :param name: Name of the step (task name, command, path...).
+    """
+    span = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        end = time.perf_counter()
+        thread = threading.current_thread()
+        with trace_lock:
+            trace_spans.append({
+                "category": category,
+                "name": name,
+                "start": TRACE_WALL_EPOCH + (start - TRACE_EPOCH),
+                "end": TRACE_WALL_EPOCH + (end - TRACE_EPOCH),
+                "duration": end - start,
+                "thread": thread.name,
+                "tid": thread.ident,
+                **span,
+            })
+
+def export_trace_jsonl(path):
+    """
+    Writes every recorded span as one JSON object per line.
+    """
+    with trace_lock, open(path, "w") as trace_file:
+        for span in trace_spans:
+            trace_file.write(json.dumps(span, default=str) + "\n")
+    logger.info(f"Wrote {len(trace_spans)} spans to {path}")
+
+def export_chrome_trace(path):
+    """
+    Writes the recorded spans in the Chrome trace event format, which can be
+    opened in chrome://tracing or https://ui.perfetto.dev.
+    """
+    pid = os.getpid()
+    events = []
+    threads = {}
+    with trace_lock:
+        for span in trace_spans:
+            threads[span["tid"]] = span["thread"]
+            args = {key: value for key, value in span.items() if key not in ("category", "name", "start", "end", "duration", "thread", "tid")}
+            events.append({
+                "name": span["name"],
+                "cat": span["category"],
+                "ph": "X",
+                "ts": round((span["start"] - TRACE_WALL_EPOCH) * 1e6),
+                "dur": round(span["duration"] * 1e6),
+                "pid": pid,
+                "tid": span["tid"],
+                "args": args,
+            })
+    for tid, thread_name in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_name}})
+    with open(path, "w") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file, default=str)
+    logger.info(f"Wrote Chrome trace to {path}")
+
+def log_slowest_steps(count=10):
+    """
+    Logs the slowest recorded steps, excluding whole tasks.
+    """
+    with trace_lock:
+        steps = sorted((span for span in trace_spans if span["category"] != "task"), key=lambda span: span["duration"], reverse=True)
+        tasks = [span for span in trace_spans if span["category"] == "task"]
+    if not steps and not tasks:
+        return
+    logger.info(f"Slowest {min(count, len(steps))} step(s):")
+    for span in steps[:count]:
+        details = ", ".join(f"{key}={span[key]}" for key in ("exit_code", "retries", "output_bytes") if key in span)
+        logger.info(f"  {span['duration']:8.2f}s  {span['category']:<8} {span['name']}" + (f"  ({details})" if details else ""))
+    for span in tasks:
+        logger.debug(f"Task {span['name']} took {span['duration']:.2f}s")
+
+# Failure classification for execute_shell. Transient failures are retried with
+# exponential backoff; permanent and unknown ones fail straight away.
+TRANSIENT_ERROR_PATTERNS = re.compile(
+    r"could not resolve host|temporary failure in name resolution|failed retrieving file|"
+    r"failed to synchronize|connection (timed out|reset|refused)|operation too slow|"
+    r"network is unreachable|could not connect|unable to lock database|db\.lck|"
+    r"http/2 stream|error 50[234]|the requested url returned error: 5\d\d",
+    re.IGNORECASE
 )
-parser.add_argument("yaml_file", help="Path to the YAML configuration file")
-parser.add_argument("--debug", action="store_true", help="Enable verbose logging")
-args = parser.parse_args()
+PERMANENT_ERROR_PATTERNS = re.compile(
+    r"target not found|no aur package found|could not find all required packages|"
+    r"command not found|invalid option|unrecognized option|conflicting files|"
+    r"permission denied|no such file or directory|syntax error|are in conflict|"
+    r"conflicting dependencies|could not satisfy dependencies",
+    re.IGNORECASE
+)
+# 126: found but not executable, 127: command not found, 2: shell misuse
+PERMANENT_EXIT_CODES = {2, 126, 127}
+MAX_RETRY_DELAY = 60
+
+# Commands with no recorded duration get this timeout; package installs and builds
+# get none, since a large AUR build can legitimately take a long time.
+DEFAULT_COMMAND_TIMEOUT = 120
+# With history, the timeout is this multiple of the longest recorded run.
+TIMEOUT_FACTOR = 3
+COMMAND_HISTORY_PATH = os.path.expanduser("~/.cache/artix-setup/command-durations.json")
+COMMAND_HISTORY_SIZE = 5
+
+command_history = None
+command_history_lock = threading.Lock()
+STDERR_TAIL_BYTES = 8192
+
+# Seconds a timed-out command gets to exit after SIGTERM before SIGKILL
+KILL_GRACE_PERIOD = 5
+
+def signal_process_group(process, signum):
+    try:
+        os.killpg(process.pid, signum)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def kill_process_group(process, graceful=False):
+    """
+    Kills a command started by run_command together with everything it spawned.
+    With graceful (sudo-wrapped commands, whose children we may not signal
+    directly), SIGTERM is sent first so sudo can pass it on, then SIGKILL.
+    """
+    if graceful:
+        signal_process_group(process, signal.SIGTERM)
+        try:
+            process.wait(timeout=KILL_GRACE_PERIOD)
+        except subprocess.TimeoutExpired:
+            pass
+    signal_process_group(process, signal.SIGKILL)
+    process.wait()
+
+def run_command(command, timeout=None, env=None, stdin=None):
+    """
+    Runs a shell command, passing its output through while counting it and keeping
+    the tail of stderr for failure classification.
+    :param command: Shell command string.
+    :param timeout: Seconds before the command is killed, or None.
+    :param env: Environment for the command, or None to inherit.
+    :param stdin: stdin for the command (e.g. subprocess.DEVNULL), or None to inherit.
+    :return: Dictionary with returncode (None on timeout), timed_out, stderr,
+             output_bytes and duration.
+    """
+    start = time.monotonic()
+    # A session of its own, so a timeout can kill the whole pipeline, not just the shell
+    process = subprocess.Popen(command, shell=True, env=env, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               start_new_session=True)
+    tail = bytearray()
+    output_bytes = [0, 0]
+
+    def pump(stream, destination, index):
+        for chunk in iter(lambda: stream.read1(4096), b""):
+            destination.buffer.write(chunk)
+            destination.flush()
+            output_bytes[index] += len(chunk)
+            if index == 1:
+                tail.extend(chunk)
+                del tail[:-STDERR_TAIL_BYTES]
+
+    readers = [
+        threading.Thread(target=pump, args=(process.stdout, sys.stdout, 0), daemon=True),
+        threading.Thread(target=pump, args=(process.stderr, sys.stderr, 1), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    timed_out = False
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        kill_process_group(process, graceful=command.lstrip().startswith("sudo "))
+    for reader in readers:
+        # Anything that escaped the process group could still hold the pipes open
+        reader.join(timeout=KILL_GRACE_PERIOD if timed_out else None)
+    return {
+        "returncode": None if timed_out else process.returncode,
+        "timed_out": timed_out,
+        "stderr": tail.decode(errors="replace"),
+        "output_bytes": sum(output_bytes),
+        "duration": time.monotonic() - start,
+    }
+
+def classify_failure(returncode, stderr, timed_out=False):
+    """
+    Classifies a failed command as 'transient' (worth retrying after a pause),
+    'permanent' (retrying won't help) or 'unknown'.
+    """
+    if timed_out:
+        return "transient"
+    if PERMANENT_ERROR_PATTERNS.search(stderr):
+        return "permanent"
+    if TRANSIENT_ERROR_PATTERNS.search(stderr):
+        return "transient"
+    if returncode in PERMANENT_EXIT_CODES:
+        return "permanent"
+    return "unknown"
+
+def retry_delay(attempt, delay):
+    """
+    Exponential backoff with jitter: delay, 2*delay, 4*delay... plus up to one delay
+    of random jitter, capped at MAX_RETRY_DELAY.
+    """
+    return min(MAX_RETRY_DELAY, delay * 2 ** (attempt - 1) + random.uniform(0, delay))
+
+def load_command_history():
+    """
+    Loads the recorded command durations, once per run.
+    """
+    global command_history
+    with command_history_lock:
+        if command_history is None:
+            try:
+                with open(COMMAND_HISTORY_PATH, "r") as history_file:
+                    command_history = json.load(history_file)
+            except (OSError, ValueError):
+                command_history = {}
+        return command_history
+
+def record_command_duration(command, duration):
+    """
+    Records how long a successful command took.
+    """
+    history = load_command_history()
+    with command_history_lock:
+        durations = history.setdefault(command, [])
+        durations.append(round(duration, 2))
+        del durations[:-COMMAND_HISTORY_SIZE]
+
+def save_command_history():
+    """
+    Writes the recorded command durations back to disk.
+    """
+    if command_history is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(COMMAND_HISTORY_PATH), exist_ok=True)
+        with command_history_lock, open(COMMAND_HISTORY_PATH, "w") as history_file:
+            json.dump(command_history, history_file)
+    except OSError as e:
+        logger.warning(f"Could not save command history: {e}")
+
+def command_timeout(command):
+    """
+    Picks a timeout for a command from its recorded durations.
+    :return: Timeout in seconds, or None for no timeout.
+    """
+    durations = load_command_history().get(command)
+    if durations:
+        return max(DEFAULT_COMMAND_TIMEOUT, TIMEOUT_FACTOR * max(durations))
+    if uses_pacman_lock(command):
+        return None
+    return DEFAULT_COMMAND_TIMEOUT
+
+# Environment the privileged worker's shell expands a 'sudo ...' command with, so
+# '~' and $USER expand the same way they would in the calling user's shell. The
+# command itself gets root's values, as it would under sudo (see root_command).
+PRIVILEGED_WORKER_ENV = ("HOME", "USER", "LOGNAME")
+# Characters that make a command more than one simple command
+SHELL_OPERATOR_CHARS = set("();<>|&")
+
+def apply_chmod(path, mode):
+    """
+    Applies a chmod-style mode: '+x' or an octal string/int.
+    """
+    if mode == "+x":
+        current = os.stat(path).st_mode
+        os.chmod(path, current | ((current & 0o444) >> 2))
+    else:
+        os.chmod(path, int(mode, 8) if isinstance(mode, str) else mode)
+
+def make_directories(path, owner=None):
+    """
+    Creates a directory and its missing parents, handing the created ones to
+    owner ((uid, gid) tuple) when given.
+    """
+    missing = []
+    while path and not os.path.isdir(path):
+        missing.append(path)
+        path = os.path.dirname(path)
+    for directory in reversed(missing):
+        os.makedirs(directory, exist_ok=True)
+        if owner is not None:
+            os.chown(directory, *owner)
+
+def write_file_atomically(path, content, mode=None, backup=False, owner=None):
+    """
+    Writes a file through a temporary file, creating its directory and optionally a
+    timestamped backup. Does nothing when the file already has this content.
+    An existing file keeps its owner and mode; a new one gets owner ((uid, gid)
+    tuple), if given, like the directories created for it.
+    :return: True if the file was written.
+    """
+    if file_hash(path) == content_hash(content):
+        if mode is not None:
+            apply_chmod(path, mode)
+        return False
+    make_directories(os.path.dirname(path) or "/", owner)
+    existing = os.stat(path) if os.path.exists(path) else None
+    if existing is not None:
+        owner = (existing.st_uid, existing.st_gid)
+    if backup and existing is not None:
+        backup_path = f"{path}.{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        shutil.copy2(path, backup_path)
+        if os.geteuid() == 0:
+            os.chown(backup_path, *owner)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", dir=os.path.dirname(path) or "/")
+    with os.fdopen(fd, "w") as temp_file:
+        temp_file.write(content)
+    os.chmod(temp_path, stat.S_IMODE(existing.st_mode) if existing is not None else 0o644)
+    if owner is not None and os.geteuid() == 0:
+        os.chown(temp_path, *owner)
+    if mode is not None:
+        apply_chmod(temp_path, mode)
+    os.replace(temp_path, path)
+    return True
+
+def handle_privileged_operation(operation):
+    """
+    Performs one file system or command operation for the privileged worker.
+    :param operation: Dictionary with an 'op' key and its parameters.
+    :return: Dictionary with the result of the operation.
+    """
+    kind = operation["op"]
+    path = operation.get("path")
+    if kind == "mkdir":
+        os.makedirs(path, exist_ok=True)
+    elif kind == "chmod":
+        apply_chmod(path, operation["mode"])
+    elif kind == "remove":
+        if os.path.islink(path) or os.path.isfile(path):
+            os.remove(path)
+    elif kind == "copy":
+        shutil.copy2(path, operation["destination"])
+    elif kind == "move":
+        shutil.move(path, operation["destination"])
+    elif kind == "symlink":
+        link = operation["link"]
+        if os.path.isdir(link) and not os.path.islink(link):
+            link = os.path.join(link, os.path.basename(os.path.normpath(path)))
+        if os.path.islink(link) and os.readlink(link) == path:
+            return {"created": False}
+        os.symlink(path, link)
+        return {"created": True}
+    elif kind == "write_file":
+        owner = tuple(operation["owner"]) if operation.get("owner") else None
+        written = write_file_atomically(path, operation["content"], operation.get("mode"), operation.get("backup", False), owner)
+        return {"written": written}
+    elif kind == "run":
+        # The worker's stdin is the request pipe: commands must not read from it
+        env = dict(os.environ, **operation.get("env", {}))
+        return run_command(operation["command"], timeout=operation.get("timeout"), env=env, stdin=subprocess.DEVNULL)
+    elif kind == "wait_ready":
+        return wait_for_services(operation["services"])
+    elif kind == "batch":
+        # Stops at the first failure, like the 'set -e' script used without the worker
+        results = []
+        for child in operation["operations"]:
+            try:
+                results.append(handle_privileged_operation(child))
+            except Exception as e:
+                results.append({"error": f"{child['op']} {child.get('path', '')}: {e}"})
+            if "error" in results[-1] or results[-1].get("returncode", 0) != 0:
+                break
+        return {"results": results}
+    else:
+        raise ValueError(f"Unknown privileged operation: {kind}")
+    return {}
+
+def serve_privileged_requests():
+    """
+    Main loop of the privileged worker. Reads one JSON request per line from stdin
+    and answers each with one JSON line on the original stdout. Requests are handled
+    on their own threads so concurrent tasks don't queue behind each other. Output
+    of commands it runs goes to stderr, keeping stdout for the protocol.
+    """
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    write_lock = threading.Lock()
+
+    def respond(response):
+        with write_lock:
+            protocol.write(json.dumps(response) + "\n")
+            protocol.flush()
+
+    def handle(request):
+        try:
+            respond({"id": request["id"], "ok": True, "result": handle_privileged_operation(request["operation"])})
+        except Exception as e:
+            respond({"id": request["id"], "ok": False, "error": str(e)})
+
+    respond({"id": 0, "ok": True, "result": {"ready": True}})
+    for line in sys.stdin:
+        if line.strip():
+            threading.Thread(target=handle, args=(json.loads(line),), daemon=True).start()
+
+class PrivilegedWorker:
+    """
+    Client for a long-lived root helper started once with sudo. File writes,
+    mkdir, chmod, symlinks and 'sudo ...' commands are sent to it over a pipe
+    instead of spawning a shell and sudo per operation.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 1
+
+    def start(self):
+        """
+        Starts the helper and waits for it to report ready.
+        :return: True if the helper is running.
+        """
+        command = ["sudo", sys.executable, os.path.abspath(__file__), "--privileged-worker"]
+        logger.info("Starting privileged worker")
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+        except OSError as e:
+            logger.warning(f"Could not start privileged worker: {e}")
+            return False
+        ready = self.process.stdout.readline()
+        if not ready:
+            logger.warning("Privileged worker exited before it was ready. Falling back to sudo per command.")
+            self.process = None
+            return False
+        threading.Thread(target=self.read_responses, daemon=True).start()
+        return True
+
+    def read_responses(self):
+        for line in self.process.stdout:
+            response = json.loads(line)
+            with self.lock:
+                waiter = self.pending.pop(response["id"], None)
+            if waiter:
+                waiter[1] = response
+                waiter[0].set()
+        # The worker went away: release everyone still waiting
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for waiter in pending.values():
+            waiter[1] = {"ok": False, "error": "privileged worker exited"}
+            waiter[0].set()
+
+    def call(self, operation):
+        """
+        Sends one operation and waits for its result.
+        :raises RuntimeError: If the operation failed.
+        """
+        waiter = [threading.Event(), None]
+        with self.lock:
+            request_id = self.next_id
+            self.next_id += 1
+            self.pending[request_id] = waiter
+            self.process.stdin.write(json.dumps({"id": request_id, "operation": operation}) + "\n")
+            self.process.stdin.flush()
+        waiter[0].wait()
+        response = waiter[1]
+        if not response["ok"]:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def stop(self):
+        if self.process:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+privileged_worker = None
+
+def start_privileged_worker():
+    """
+    Starts the shared privileged worker unless already running as root, in which
+    case operations are performed in-process.
+    """
+    global privileged_worker
+    if os.geteuid() == 0:
+        return
+    worker = PrivilegedWorker()
+    if worker.start():
+        privileged_worker = worker
+
+def privileged_available():
+    """
+    Returns True if privileged operations can be done without spawning sudo.
+    """
+    return privileged_worker is not None or os.geteuid() == 0
+
+def privileged_call(op, **params):
+    """
+    Performs a privileged operation through the worker, or directly when running as root.
+    :param op: Operation name ('mkdir', 'chmod', 'remove', 'copy', 'move', 'symlink',
+               'write_file', 'run', 'wait_ready' or 'batch').
+    :param params: Parameters of the operation.
+    :return: Dictionary with the result of the operation.
+    """
+    operation = dict(params, op=op)
+    if privileged_worker is not None:
+        return privileged_worker.call(operation)
+    return handle_privileged_operation(operation)
+
+def strip_sudo(command):
+    """
+    Returns the command without its leading 'sudo ' prefixes, or None if it has none,
+    uses sudo options, or has shell operators: in 'sudo a && b' only a runs as root.
+    """
+    if not command.startswith("sudo "):
+        return None
+    while command.startswith("sudo "):
+        command = command[len("sudo "):].lstrip()
+    if command.startswith("-"):
+        return None
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        tokens = list(lexer)
+    except ValueError:
+        return None
+    if "`" in command or "$(" in command or "\n" in command or any(set(token) <= SHELL_OPERATOR_CHARS for token in tokens):
+        return None
+    return command
+
+def root_command(command):
+    """
+    Prefixes a command stripped of sudo with root's HOME, USER and LOGNAME. The shell
+    still expands the words with the caller's values, like the caller's shell would
+    before sudo, but the command runs with root's environment, as under sudo.
+    """
+    import pwd
+    root = pwd.getpwuid(0)
+    return f"HOME={shlex.quote(root.pw_dir)} USER={root.pw_name} LOGNAME={root.pw_name} {command}"
+
+def execute_shell(commands, sudo=False, retries=3, delay=5, prompt=True, outcome=None):
+    """
+    Executes shell commands. Failures are classified from the exit code and stderr:
+    transient ones (network, database lock, timeouts) are retried with exponential
+    backoff. Everything else, permanent (unknown package, missing command) or not
+    recognised (e.g. a failed build), fails immediately.
+    Timeouts come from the recorded duration of earlier runs of the same command
+    and are doubled after a timeout.
+    :param commands: List of shell command strings to execute in order.
+    :param sudo: Whether to prefix each command with sudo.
+    :param retries: Maximum number of attempts per command.
+    :param delay: Base delay in seconds for the backoff between attempts.
+    :param prompt: Whether to ask the user to continue once a command has failed.
+    :param outcome: Optional dictionary; the class of the last failure is stored under 'failure'.
+    :return: True if every command succeeded, False otherwise.
+    """
+    logger.debug(f"Starting execute_shell with commands: {commands}, sudo: {sudo}, retries: {retries}, delay: {delay}")
+    success = True
+    for command in commands:
+        attempt = 0
+        if sudo:
+            command = f"sudo {command}"
+        timeout = command_timeout(command)
+
+        with trace_span("shell", command) as span:
+            while attempt < retries:
+                logger.info(f"Executing: {command}")
+                stripped = strip_sudo(command) if privileged_available() else None
+                if stripped is not None:
+                    env = {key: os.environ[key] for key in PRIVILEGED_WORKER_ENV if key in os.environ}
+                    result = privileged_call("run", command=root_command(stripped), env=env, timeout=timeout)
+                else:
+                    result = run_command(command, timeout=timeout)
+                span["exit_code"] = result["returncode"]
+                span["retries"] = attempt
+                span["output_bytes"] = span.get("output_bytes", 0) + result.get("output_bytes", 0)
+
+                if result["returncode"] == 0:
+                    record_command_duration(command, result["duration"])
+                    break
+
+                attempt += 1
+                failure = classify_failure(result["returncode"], result["stderr"], result["timed_out"])
+                if result["timed_out"]:
+                    logger.error(f"Command timed out after {timeout}s: {command}")
+                    timeout = timeout * 2
+                else:
+                    logger.error(f"Error executing command ({failure} failure, exit code {result['returncode']}): {command}")
+
+                if attempt == retries or failure != "transient":
+                    logger.error(f"Command failed after {attempt} attempt(s): {command}")
+                    if outcome is not None:
+                        outcome["failure"] = failure
+                    success = False
+                    if not prompt:
+                        return False
+                    with prompt_lock:
+                        user_input = input(f"Command failed after {attempt} attempt(s): {command}. Do you want to continue? (yes/no): ")
+                    if user_input.lower() == "yes":
+                        logger.info("User chose to continue.")
+                        break
+                    else:
+                        logger.info("User chose to stop execution.")
+                        return False
+                wait_time = retry_delay(attempt, delay)
+                logger.info(f"Retrying ({attempt}/{retries}) in {wait_time:.1f}s: {command}")
+                time.sleep(wait_time)  # Back off before retrying
+    return success
+
+def execute_python(script, *args, sudo=False):
+    """
+    Executes a Python script with optional arguments.
+    :param script: Path to the Python script to execute.
+    :param args: Arguments to pass to the script.
+    :param sudo: Whether to run the command with sudo.
+    :return: True if the script succeeded.
+    """
+    logger.debug(f"Starting execute_python with script: {script}, args: {args}, sudo: {sudo}")
+    command = "python3"
+    if sudo:
+        command = f"sudo {command}"
+    try:
+        full_command = f"{command} {script} {' '.join(args)}"
+        logger.info(f"Executing Python script: {full_command}")
+        with trace_span("python", full_command) as span:
+            result = subprocess.run(full_command, shell=True)
+            span["exit_code"] = result.returncode
+        result.check_returncode()
+        return True
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Error executing Python script: {full_command}")
+        logger.error(e)
+        return False
+
+def install_packages(packages, command_template, sudo=False, batch=False):
+    """
+    Installs packages using the given command template.
+    :param packages: List of package names.
+    :param command_template: Command with a {package} placeholder.
+    :param sudo: Whether to run the command with sudo.
+    :param batch: Install the whole list in a single transaction instead of one command per package.
+    :return: True if every package was installed.
+    """
+    logger.debug(f"Starting install_packages with packages: {packages}, command_template: {command_template}, sudo: {sudo}, batch: {batch}")
+    with trace_span("packages", command_template, packages=len(packages)):
+        wait_for_prefetch(packages)
+        packages = filter_installed_packages(packages)
+        # Network I/O first: the pacman lock is only held while pacman or yay runs
+        fetched = fetch_from_fleet(packages)
+        hits, keys = {}, {}
+        if aur_cache_max_bytes and AUR_HELPER_PATTERN.search(command_template):
+            hits, keys = lookup_aur_cache([package for package in packages if package not in fetched])
+        with pacman_lock:
+            packages = install_fleet_files(filter_installed_packages(packages), fetched)
+            packages, built = install_from_aur_cache(packages, hits, keys)
+            if batch:
+                success = install_package_batch(packages, command_template, sudo)
+            else:
+                success = True
+                for package in packages:
+                    command = command_template.format(package=package)
+                    if execute_shell([command], sudo):
+                        mark_installed([package])
+                    else:
+                        success = False
+        store_aur_artifacts(built)
+        return success
+
+def install_package_batch(packages, command_template, sudo=False):
+    """
+    Installs a list of packages in one transaction. Transient failures (network,
+    database lock) are retried on the whole batch. Any other failure, e.g. a
+    missing or conflicting package or a failed AUR build, splits the list in half
+    and each half is retried, so a single bad package only costs a few extra
+    transactions instead of undoing the batching.
+    :param packages: List of package names.
+    :param command_template: Command with a {package} placeholder.
+    :param sudo: Whether to run the command with sudo.
+    :return: True if every package was installed.
+    """
+    if not packages:
+        return True
+
+    if len(packages) == 1:
+        # Down to a single package: fall back to the normal retry/prompt behaviour
+        if execute_shell([command_template.format(package=packages[0])], sudo):
+            mark_installed(packages)
+            return True
+        return False
+
+    command = command_template.format(package=" ".join(packages))
+    logger.info(f"Installing {len(packages)} packages in one transaction")
+    outcome = {}
+    if execute_shell([command], sudo, retries=3, prompt=False, outcome=outcome):
+        mark_installed(packages)
+        return True
+    if outcome.get("failure") == "transient":
+        # Still failing after the retries, and not down to a package: splitting won't help
+        logger.error(f"Batch install of {len(packages)} packages failed ({outcome.get('failure')} failure)")
+        return False
+
+    middle = len(packages) // 2
+    logger.warning(f"Batch install failed, splitting into {middle} + {len(packages) - middle} packages")
+    first_ok = install_package_batch(packages[:middle], command_template, sudo)
+    second_ok = install_package_batch(packages[middle:], command_template, sudo)
+    return first_ok and second_ok
+
+AUR_CACHE_DIR = os.path.expanduser("~/.cache/artix-setup/aur")
+FLEET_REPO_NAME = "artix-fleet"
+FLEET_DOWNLOAD_WORKERS = 4
+# Where yay and paru leave the packages they build
+AUR_BUILD_DIRS = [os.path.expanduser("~/.cache/yay"), os.path.expanduser("~/.cache/paru/clone")]
+PACKAGE_FILE_PATTERN = re.compile(r"^(.+)\.pkg\.tar(\.\w+)?$")
+
+# URL or directory of the fleet repository set by --fleet-repo, and the
+# package name -> file name index read from its database
+fleet_repo = None
+fleet_packages = {}
+
+# Names of the packages in the sync repositories, loaded on first use
+sync_packages = None
+sync_packages_lock = threading.Lock()
+
+def sync_package_names():
+    global sync_packages
+    with sync_packages_lock:
+        if sync_packages is None:
+            sync_packages = list_sync_packages()
+        return sync_packages
+
+def read_desc(text):
+    """
+    Parses a pacman 'desc' file into a dictionary of %FIELD% -> list of values.
+    """
+    fields = {}
+    current = None
+    for line in text.splitlines():
+        if line.startswith("%") and line.endswith("%"):
+            current = fields.setdefault(line.strip("%"), [])
+        elif line and current is not None:
+            current.append(line)
+    return fields
+
+def installed_package_stems(db_path=PACMAN_LOCAL_DB):
+    """
+    Returns 'name-version-arch' for every installed package, the file name of its
+    package without the .pkg.tar.* suffix.
+    """
+    stems = []
+    for entry in os.scandir(db_path):
+        try:
+            with open(os.path.join(entry.path, "desc"), "r") as desc_file:
+                desc = read_desc(desc_file.read())
+        except OSError:
+            continue
+        if desc.get("NAME") and desc.get("VERSION") and desc.get("ARCH"):
+            stems.append(f"{desc['NAME'][0]}-{desc['VERSION'][0]}-{desc['ARCH'][0]}")
+    return stems
+
+def find_package_files(directories):
+    """
+    Finds package files in the given directories and their immediate subdirectories.
+    :return: Dictionary of 'name-version-arch' -> path.
+    """
+    files = {}
+    for directory in directories:
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            candidates = [entry]
+            if entry.is_dir(follow_symlinks=False):
+                try:
+                    candidates = list(os.scandir(entry.path))
+                except OSError:
+                    continue
+            for candidate in candidates:
+                match = PACKAGE_FILE_PATTERN.match(candidate.name)
+                if match and candidate.is_file():
+                    files.setdefault(match.group(1), candidate.path)
+    return files
+
+def export_fleet_repo(directory):
+    """
+    Copies the package file of every installed package found in the pacman cache
+    or an AUR build directory into directory, and adds them to its repository
+    database with repo-add, so other machines can install from it.
+    :param directory: Repository directory, created if needed.
+    :return: True if the repository database was updated.
+    """
+    with trace_span("fleet", "export", directory=directory):
+        installed = installed_package_stems()
+        files = find_package_files([PACMAN_CACHE_DIR, *AUR_BUILD_DIRS, AUR_CACHE_DIR])
+        os.makedirs(directory, exist_ok=True)
+        added = []
+        missing = 0
+        for stem in installed:
+            source = files.get(stem)
+            if source is None:
+                missing += 1
+                continue
+            for path in (source, f"{source}.sig"):
+                target = os.path.join(directory, os.path.basename(path))
+                if not os.path.exists(path) or os.path.exists(target):
+                    continue
+                try:
+                    os.link(path, target)
+                except OSError:
+                    shutil.copy2(path, target)
+            added.append(os.path.join(directory, os.path.basename(source)))
+
+        logger.info(f"Exporting {len(added)} package(s) to {directory}; {missing} installed package(s) have no package file")
+        if not added:
+            return False
+        database = os.path.join(directory, f"{FLEET_REPO_NAME}.db.tar.gz")
+        result = subprocess.run(["repo-add", "--new", "--remove", "--quiet", database, *added], stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            logger.error(f"repo-add failed: {result.stderr.strip()}")
+            return False
+        return True
+
+def serve_fleet_repo(directory, port):
+    """
+    Serves a fleet repository directory over HTTP until interrupted.
+    """
+    import functools
+    import socket
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+    handler = functools.partial(SimpleHTTPRequestHandler, directory=directory)
+    server = ThreadingHTTPServer(("", port), handler)
+    logger.info(f"Serving {directory} as http://{socket.gethostname()}:{port}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def read_fleet_file(name):
+    """
+    Returns the content of a file in the fleet repository.
+    """
+    if re.match(r"^[a-z]+://", fleet_repo):
+        import urllib.request
+        with urllib.request.urlopen(f"{fleet_repo.rstrip('/')}/{name}", timeout=30) as response:
+            return response.read()
+    with open(os.path.join(fleet_repo, name), "rb") as repo_file:
+        return repo_file.read()
+
+def load_fleet_index(source):
+    """
+    Reads the package index of a fleet repository. Later installs fetch matching
+    packages from it before falling back to the configured mirrors and AUR.
+    :param source: URL or directory of a repository written by export_fleet_repo().
+    """
+    import io
+    import tarfile
+    global fleet_repo
+    fleet_repo = source
+    fleet_packages.clear()
+    try:
+        data = read_fleet_file(f"{FLEET_REPO_NAME}.db")
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as database:
+            for member in database:
+                if member.name.endswith("/desc"):
+                    desc = read_desc(database.extractfile(member).read().decode())
+                    fleet_packages[desc["NAME"][0]] = desc["FILENAME"][0]
+    except (OSError, tarfile.TarError, KeyError, IndexError) as e:
+        logger.warning(f"Fleet repository {source} is not usable, installing from the mirrors: {e}")
+        fleet_packages.clear()
+        return
+    logger.info(f"Fleet repository {source} has {len(fleet_packages)} package(s)")
+
+def fetch_fleet_package(filename):
+    """
+    Puts a package file from the fleet repository into the pacman cache.
+    :return: Path of the package in the pacman cache, or None if it could not be fetched.
+    """
+    destination = os.path.join(PACMAN_CACHE_DIR, filename)
+    if os.path.exists(destination):
+        return destination
+    fd, temp_path = tempfile.mkstemp(prefix=f"{filename}.")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(read_fleet_file(filename))
+        os.chmod(temp_path, 0o644)
+        if privileged_available():
+            privileged_call("move", path=temp_path, destination=destination)
+        elif not execute_shell([f"sudo mv {shlex.quote(temp_path)} {shlex.quote(destination)}"], retries=1, prompt=False):
+            return None
+        return destination
+    except (OSError, RuntimeError) as e:
+        logger.warning(f"Could not fetch {filename} from the fleet repository: {e}")
+        return None
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def fetch_fleet_packages(filenames):
+    """
+    Fetches several package files from the fleet repository concurrently.
+    :return: Dictionary of file name -> path in the pacman cache for those fetched.
+    """
+    with trace_span("fleet", "fetch", packages=len(filenames)):
+        with ThreadPoolExecutor(max_workers=FLEET_DOWNLOAD_WORKERS) as executor:
+            paths = dict(zip(filenames, executor.map(fetch_fleet_package, filenames)))
+    return {filename: path for filename, path in paths.items() if path}
+
+def warm_cache_from_fleet(packages):
+    """
+    Copies the exact package files pacman would download for packages (dependencies
+    included) from the fleet repository into the pacman cache. pacman then uses them
+    instead of downloading, and still checks them against the sync database signatures.
+    """
+    targets = [package for package in packages if package_name(package) in sync_package_names()]
+    if not fleet_packages or not targets:
+        return
+    result = subprocess.run(["pacman", "-Sp", "--needed", *targets], capture_output=True, text=True)
+    if result.returncode != 0:
+        logger.debug(f"pacman -Sp failed, not using the fleet repository: {result.stderr.strip()}")
+        return
+    available = set(fleet_packages.values())
+    wanted = [filename for filename in (url.rsplit("/", 1)[-1] for url in result.stdout.split()) if filename in available]
+    if wanted:
+        fetched = fetch_fleet_packages(wanted)
+        logger.info(f"Fetched {len(fetched)} of {len(wanted)} package(s) from the fleet repository")
+
+def fetch_from_fleet(packages):
+    """
+    Downloads what the fleet repository has for packages, without taking the pacman
+    lock: packages from the sync repositories get their files put in the pacman
+    cache, and AUR packages are fetched to be installed by install_fleet_files().
+    :param packages: List of package names.
+    :return: Dictionary of AUR package -> path of its fetched package file.
+    """
+    if not fleet_packages or not packages:
+        return {}
+    warm_cache_from_fleet(packages)
+    aur = [package for package in packages
+           if package_name(package) not in sync_package_names() and package_name(package) in fleet_packages]
+    if not aur:
+        return {}
+    fetched = fetch_fleet_packages([fleet_packages[package_name(package)] for package in aur])
+    return {package: fetched[fleet_packages[package_name(package)]] for package in aur
+            if fleet_packages[package_name(package)] in fetched}
+
+def install_fleet_files(packages, fetched):
+    """
+    Installs the AUR packages fetched by fetch_from_fleet() directly with pacman -U
+    instead of building them. Called with the pacman lock held.
+    :param packages: List of package names.
+    :param fetched: Dictionary of package -> package file, from fetch_from_fleet().
+    :return: The packages still to be installed with the task's own command.
+    """
+    aur = [package for package in packages if package in fetched]
+    if not aur:
+        return packages
+    paths = " ".join(shlex.quote(fetched[package]) for package in aur)
+    logger.info(f"Installing {len(aur)} AUR package(s) from the fleet repository")
+    if execute_shell([f"sudo pacman -U --needed --noconfirm {paths}"], retries=1, prompt=False):
+        mark_installed(aur)
+        return [package for package in packages if package not in aur]
+    logger.warning("Installing from the fleet repository failed, building instead")
+    return packages
+
+def install_from_fleet(packages):
+    """
+    Installs packages from the fleet repository where it can, see fetch_from_fleet().
+    :param packages: List of package names.
+    :return: The packages still to be installed with the task's own command.
+    """
+    return install_fleet_files(packages, fetch_from_fleet(packages))
+
+AUR_RPC_URL = "https://aur.archlinux.org/rpc/v5/info"
+AUR_GIT_URL = "https://aur.archlinux.org/{base}.git"
+AUR_SRCINFO_URL = "https://aur.archlinux.org/cgit/aur.git/plain/.SRCINFO?h={base}"
+AUR_HELPER_PATTERN = re.compile(r"\b(yay|paru)\b")
+AUR_CACHE_INDEX = os.path.join(AUR_CACHE_DIR, "index.json")
+# Size limit of the AUR build cache, set by --aur-cache-size. 0 disables the cache.
+aur_cache_max_bytes = 10 * 1024 ** 3
+aur_cache_lock = threading.Lock()
+
+def aur_package_info(names):
+    """
+    Looks up packages in the AUR in a single RPC request.
+    :return: Dictionary of package name -> RPC result for the names found in the AUR.
+    """
+    import urllib.parse
+    import urllib.request
+    query = urllib.parse.urlencode([("arg[]", name) for name in names])
+    with urllib.request.urlopen(f"{AUR_RPC_URL}?{query}", timeout=15) as response:
+        results = json.load(response).get("results", [])
+    return {result["Name"]: result for result in results}
+
+def git_head(url, ref="HEAD"):
+    """
+    Returns the commit a remote git ref points to, without cloning.
+    """
+    result = subprocess.run(["git", "ls-remote", url, ref], capture_output=True, text=True, timeout=30)
+    commit = result.stdout.split()[:1]
+    if result.returncode != 0 or not commit:
+        raise OSError(f"git ls-remote {url} {ref} failed: {result.stderr.strip()}")
+    return commit[0]
+
+def vcs_source_commits(base):
+    """
+    Returns the current upstream commit of every unpinned git source of an AUR
+    package, so -git packages are rebuilt when upstream moves even though their
+    PKGBUILD didn't change.
+    """
+    import urllib.request
+    with urllib.request.urlopen(AUR_SRCINFO_URL.format(base=base), timeout=15) as response:
+        srcinfo = response.read().decode("utf-8", errors="replace")
+    commits = []
+    for match in re.finditer(r"^\s*source(?:_\w+)?\s*=\s*(?:[^:\s]+::)?git\+(\S+)$", srcinfo, re.MULTILINE):
+        url, _, fragment = match.group(1).partition("#")
+        url = url.split("?")[0]
+        kind, _, value = fragment.partition("=")
+        if kind in ("commit", "tag"):
+            continue  # Pinned in the PKGBUILD, covered by its commit
+        commits.append(git_head(url, value if kind == "branch" else "HEAD"))
+    return commits
+
+def aur_cache_key(name, info):
+    """
+    Content address of a built AUR package: its name, the commit of its PKGBUILD
+    repository, the commits of its unpinned git sources and the architecture.
+    """
+    import platform
+    base = info.get("PackageBase", name)
+    fields = [name, git_head(AUR_GIT_URL.format(base=base)), vcs_source_commits(base), platform.machine()]
+    return content_hash(json.dumps(fields))
+
+def load_aur_cache_index():
+    try:
+        with open(AUR_CACHE_INDEX, "r") as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+def save_aur_cache_index(index):
+    os.makedirs(AUR_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=AUR_CACHE_DIR)
+    with os.fdopen(fd, "w") as index_file:
+        json.dump(index, index_file)
+    os.replace(temp_path, AUR_CACHE_INDEX)
+
+def evict_aur_cache(index):
+    """
+    Removes the least recently used packages until the cache fits aur_cache_max_bytes.
+    """
+    total = sum(entry["size"] for entry in index.values())
+    for key, entry in sorted(index.items(), key=lambda item: item[1]["last_used"]):
+        if total <= aur_cache_max_bytes:
+            break
+        logger.info(f"Evicting {entry['file']} from the AUR build cache")
+        shutil.rmtree(os.path.join(AUR_CACHE_DIR, key), ignore_errors=True)
+        total -= entry["size"]
+        del index[key]
+
+def lookup_aur_cache(packages):
+    """
+    Works out the build cache keys of the AUR packages among packages (AUR RPC,
+    git ls-remote and .SRCINFO requests) and finds the ones already built. Does no
+    installing, so it runs without the pacman lock.
+    :param packages: List of package names.
+    :return: Tuple of ({package name: cached package file}, {package name: cache key}).
+    """
+    candidates = [package for package in packages if package_name(package) not in sync_package_names()]
+    if not candidates:
+        return {}, {}
+    try:
+        info = aur_package_info([package_name(package) for package in candidates])
+        with ThreadPoolExecutor(max_workers=FLEET_DOWNLOAD_WORKERS) as executor:
+            names = [name for name in map(package_name, candidates) if name in info]
+            keys = dict(zip(names, executor.map(lambda name: aur_cache_key(name, info[name]), names)))
+    except (OSError, ValueError, subprocess.SubprocessError) as e:
+        logger.warning(f"AUR build cache unavailable: {e}")
+        return {}, {}
+
+    with aur_cache_lock:
+        index = load_aur_cache_index()
+    hits = {}
+    for name, key in keys.items():
+        entry = index.get(key)
+        path = os.path.join(AUR_CACHE_DIR, key, entry["file"]) if entry else None
+        if path and os.path.exists(path):
+            hits[name] = path
+    return hits, keys
+
+def install_from_aur_cache(packages, hits, keys):
+    """
+    Installs AUR packages whose current PKGBUILD and sources were built before
+    straight from the build cache with pacman -U, skipping clone and compile.
+    Called with the pacman lock held.
+    :param packages: List of package names.
+    :param hits: Cached package files found by lookup_aur_cache().
+    :param keys: Cache keys from lookup_aur_cache().
+    :return: Tuple of (packages still to be installed, {package name: cache key}
+             for the AUR packages that will be built and should be stored).
+    """
+    names = {package_name(package) for package in packages}
+    hits = {name: path for name, path in hits.items() if name in names}
+    keys = {name: key for name, key in keys.items() if name in names}
+    built = {name: key for name, key in keys.items() if name not in hits}
+    if not hits:
+        return packages, built
+
+    logger.info(f"Installing {len(hits)} AUR package(s) from the build cache")
+    paths = " ".join(shlex.quote(path) for path in hits.values())
+    if not execute_shell([f"sudo pacman -U --needed --noconfirm {paths}"], retries=1, prompt=False):
+        logger.warning("Installing from the AUR build cache failed, building instead")
+        return packages, keys
+    installed = [package for package in packages if package_name(package) in hits]
+    mark_installed(installed)
+    with aur_cache_lock:
+        index = load_aur_cache_index()
+        for name in hits:
+            if keys[name] in index:
+                index[keys[name]]["last_used"] = time.time()
+        save_aur_cache_index(index)
+    return [package for package in packages if package not in installed], built
+
+def installed_package_stem(name, db_path=PACMAN_LOCAL_DB):
+    """
+    Returns 'name-version-arch' of an installed package, or None if it isn't installed.
+    """
+    for entry in os.scandir(db_path):
+        if not entry.name.startswith(f"{name}-"):
+            continue
+        try:
+            with open(os.path.join(entry.path, "desc"), "r") as desc_file:
+                desc = read_desc(desc_file.read())
+        except OSError:
+            continue
+        if desc.get("NAME", [None])[0] == name:
+            return f"{name}-{desc['VERSION'][0]}-{desc['ARCH'][0]}"
+    return None
+
+def store_aur_artifacts(keys):
+    """
+    Copies the packages an AUR helper just built into the build cache under their keys.
+    :param keys: Dictionary of package name -> cache key from install_from_aur_cache().
+    """
+    if not keys:
+        return
+    files = find_package_files(AUR_BUILD_DIRS)
+    with aur_cache_lock:
+        index = load_aur_cache_index()
+        for name, key in keys.items():
+            source = files.get(installed_package_stem(name) or "")
+            if source is None:
+                continue
+            os.makedirs(os.path.join(AUR_CACHE_DIR, key), exist_ok=True)
+            shutil.copy2(source, os.path.join(AUR_CACHE_DIR, key, os.path.basename(source)))
+            index[key] = {
+                "name": name,
+                "file": os.path.basename(source),
+                "size": os.path.getsize(source),
+                "last_used": time.time(),
+            }
+            logger.info(f"Stored {os.path.basename(source)} in the AUR build cache")
+        evict_aur_cache(index)
+        save_aur_cache_index(index)
+
+# Per-run counts of files written vs. left alone because they already matched
+file_write_stats = {"written": 0, "unchanged": 0}
+file_write_stats_lock = threading.Lock()
+
+def content_hash(data):
+    """
+    Returns the SHA-256 hex digest of text or bytes.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+def file_hash(filepath, sudo=False):
+    """
+    Returns the SHA-256 hex digest of an existing file, or None if it doesn't exist
+    or can't be read.
+    """
+    try:
+        with open(filepath, "rb") as existing:
+            return content_hash(existing.read())
+    except FileNotFoundError:
+        return None
+    except PermissionError:
+        if not sudo:
+            return None
+        result = subprocess.run(["sudo", "cat", filepath], capture_output=True)
+        return content_hash(result.stdout) if result.returncode == 0 else None
+    except OSError:
+        return None
+
+def count_file_write(outcome):
+    """
+    Increments the 'written' or 'unchanged' counter in file_write_stats.
+    """
+    with file_write_stats_lock:
+        file_write_stats[outcome] += 1
+
+def caller_owner(path):
+    """
+    Returns (uid, gid) of the calling user for paths under their home directory,
+    so files the root helper creates there stay the user's, or None.
+    """
+    home = os.path.realpath(os.path.expanduser("~"))
+    if os.geteuid() == 0 or os.path.commonpath([home, os.path.realpath(path)]) != home:
+        return None
+    return (os.getuid(), os.getgid())
+
+def write_to_file(filepath, content, sudo=False, backup=False):
+    """
+    Writes content to a file, optionally backing up the existing file first.
+    Nothing is done (no backup, no sudo) when the file already has exactly this content.
+    :param filepath: Path of the file to write.
+    :param content: Text to write.
+    :param sudo: Whether to create the directory and move the file into place with sudo.
+    :param backup: Whether to keep a timestamped copy of an existing file.
+    :return: True if the file was written, False if it was already up to date, None if the write failed.
+    """
+    logger.debug(f"Starting write_to_file with filepath: {filepath}, sudo: {sudo}, backup: {backup}")
+    # Expanded here as the calling user, the same way the sudo shell would
+    filepath = os.path.expandvars(os.path.expanduser(filepath))
+    with trace_span("file", filepath, output_bytes=len(content.encode())):
+        try:
+            if file_hash(filepath, sudo and not privileged_available()) == content_hash(content):
+                logger.info(f"File is already up to date: {filepath}")
+                count_file_write("unchanged")
+                return False
+
+            logger.info(f"Preparing to write to file: {filepath}")
+            if sudo and privileged_available():
+                written = privileged_call("write_file", path=filepath, content=content, backup=backup,
+                                          owner=caller_owner(filepath))["written"]
+                count_file_write("written" if written else "unchanged")
+                logger.info(f"Successfully wrote to file: {filepath}" if written else f"File is already up to date: {filepath}")
+                return written
+
+            dir_path = os.path.dirname(filepath)
+            if sudo:
+                execute_shell([f"sudo mkdir -p {dir_path}"])
+            else:
+                os.makedirs(dir_path, exist_ok=True)
+
+            # Check if the file exists
+            if os.path.exists(filepath) and backup:
+                # Create a backup
+                timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+                backup_filepath = f"{filepath}.{timestamp}"
+                logger.info(f"File exists. Creating backup: {backup_filepath}")
+                if sudo:
+                    execute_shell([f"sudo cp {filepath} {backup_filepath}"])
+                else:
+                    shutil.copy(filepath, backup_filepath)
+
+            # Write to a temporary file in /tmp if sudo is required. The name is unique
+            # so concurrent tasks writing files with the same basename don't collide.
+            fd, temp_path = tempfile.mkstemp(prefix=f"{os.path.basename(filepath)}.")
+            with os.fdopen(fd, "w") as temp_file:
+                temp_file.write(content)
+            os.chmod(temp_path, 0o644)
+
+            # Move the temporary file to the final location
+            if sudo:
+                execute_shell([f"sudo mv {temp_path} {filepath}"])
+            else:
+                os.replace(temp_path, filepath)
+
+            logger.info(f"Successfully wrote to file: {filepath}")
+            count_file_write("written")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error writing to file: {filepath}")
+            logger.error(e)
+            return None
+
+def detect_init_system():
+    """
+    Returns 'dinit' or 'runit' depending on which init system is running as PID 1.
+    """
+    try:
+        with open("/proc/1/comm", "r") as comm:
+            if comm.read().strip() == "dinit":
+                return "dinit"
+    except OSError:
+        pass
+    return "runit"
+
+class ServiceBackend(ABC):
+    """
+    Turns a 'setup_service' configuration into privileged operations for one init
+    system. The operations are plain file system calls plus the commands that
+    start the service, so any number of services can be provisioned in one batch.
+    """
+    name = None
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    @abstractmethod
+    def operations(self, service_name, service_config):
+        """
+        :return: List of privileged operations provisioning and starting the service.
+        """
+
+    def ready_spec(self, service_name, service_config):
+        """
+        Describes how to tell that a started service is up, for wait_for_services().
+        Services are waited for when they are started with service_init or have a
+        'ready' key with optional 'timeout', 'socket' and 'command' probes.
+        :return: Readiness spec, or None if the service isn't waited for.
+        """
+        ready = service_config.get("ready", {})
+        if ready is False or not (service_config.get("service_init", False) or ready):
+            return None
+        ready = ready if isinstance(ready, dict) else {}
+        timeout = ready.get("timeout", SERVICE_READY_TIMEOUT)
+        if not timeout:
+            return None
+        spec = {"name": service_name, "timeout": timeout}
+        spec.update({key: ready[key] for key in ("socket", "command") if key in ready})
+        spec.update(self.status_check(service_name))
+        return spec
+
+    @abstractmethod
+    def status_check(self, service_name):
+        """
+        :return: Readiness spec fields checking the init system's view of the service.
+        """
+
+class RunitBackend(ServiceBackend):
+    """
+    Service directories in sv_path with run and log/run scripts, enabled by linking
+    them into service_path. runsvdir starts a linked service on its next scan of
+    service_path (within about 5 s); there is no 'sv start', which fails until
+    then, and the readiness wait tells whether the service came up.
+    """
+    name = "runit"
+
+    def __init__(self, paths):
+        super().__init__(paths)
+        self.service_path = paths.get("service_path", "/run/runit/service/")
+        self.sv_path = paths.get("sv_path", "/etc/runit/sv/")
+
+    def operations(self, service_name, service_config):
+        service_dir = f"{self.sv_path}{service_name}"
+        operations = []
+        if service_config.get("path_init", False):
+            operations.append({"op": "remove", "path": f"{self.service_path}{service_name}"})
+            operations.append({"op": "mkdir", "path": f"{service_dir}/log/main"})
+        for file_type, file_name in [("run_file", "run"), ("log_file", "log/run")]:
+            if file_type in service_config:
+                operations.append({
+                    "op": "write_file",
+                    "path": f"{service_dir}/{file_name}",
+                    "content": service_config[file_type]["content"],
+                    "mode": "+x",
+                })
+        if service_config.get("service_init", False):
+            operations.append({"op": "chmod", "path": f"{service_dir}/run", "mode": "+x"})
+            if "log_file" in service_config:
+                operations.append({"op": "chmod", "path": f"{service_dir}/log/run", "mode": "+x"})
+            operations.append({"op": "symlink", "path": service_dir, "link": self.service_path})
+        return operations
+
+    def status_check(self, service_name):
+        # runsv rewrites supervise/stat with 'run' once the service is running
+        return {"stat": f"{self.sv_path}{service_name}/supervise/stat"}
+
+class DinitBackend(ServiceBackend):
+    """
+    Service descriptions in dinit_path, enabled and started with dinitctl. A
+    'service_file' is used as the description as-is; otherwise a runit-style
+    'run_file' is installed as a script and wrapped in a process service, so the
+    same YAML works on both init systems. A runit 'log_file' has no dinit
+    equivalent: the wrapped service logs to /var/log/<name>.log instead.
+    """
+    name = "dinit"
+
+    def __init__(self, paths):
+        super().__init__(paths)
+        self.dinit_path = paths.get("dinit_path", "/etc/dinit.d/")
+
+    def operations(self, service_name, service_config):
+        service_file = f"{self.dinit_path}{service_name}"
+        operations = []
+        if service_config.get("path_init", False):
+            operations.append({"op": "mkdir", "path": f"{self.dinit_path}scripts"})
+        if "service_file" in service_config:
+            if "log_file" in service_config:
+                logger.warning(f"Service {service_name}: dinit ignores 'log_file', set 'logfile' in the service_file instead")
+            operations.append({"op": "write_file", "path": service_file, "content": service_config["service_file"]["content"]})
+        elif "run_file" in service_config:
+            if "log_file" in service_config:
+                logger.warning(f"Service {service_name}: dinit ignores 'log_file', output goes to /var/log/{service_name}.log")
+            script = f"{self.dinit_path}scripts/{service_name}"
+            operations.append({"op": "write_file", "path": script, "content": service_config["run_file"]["content"], "mode": "+x"})
+            operations.append({
+                "op": "write_file",
+                "path": service_file,
+                "content": f"type = process\ncommand = {script}\nlogfile = /var/log/{service_name}.log\n",
+            })
+        if service_config.get("service_init", False):
+            name = shlex.quote(service_name)
+            operations.append({"op": "run", "command": f"dinitctl enable {name}", "timeout": 120})
+            operations.append({"op": "run", "command": f"dinitctl start {name}", "timeout": 120})
+        return operations
+
+    def status_check(self, service_name):
+        return {"dinit": True}
+
+SERVICE_BACKENDS = {backend.name: backend for backend in (RunitBackend, DinitBackend)}
+
+def service_backend(paths, service_config):
+    """
+    Returns the backend for a service: its own 'init' key, then the 'init' key of
+    service_paths, then the running init system.
+    """
+    init = service_config.get("init") or paths.get("init") or detect_init_system()
+    if init not in SERVICE_BACKENDS:
+        raise ValueError(f"Unsupported init system: {init}")
+    return SERVICE_BACKENDS[init](paths)
+
+def operations_script(operations):
+    """
+    Lowers privileged operations to root shell lines, for running them without the
+    privileged worker and for compiled scripts.
+    """
+    lines = []
+    for operation in operations:
+        kind = operation["op"]
+        path = shell_path(operation["path"]) if "path" in operation else None
+        if kind == "mkdir":
+            lines.append(f"mkdir -p {path}")
+        elif kind == "remove":
+            lines.append(f"[ -d {path} ] && [ ! -L {path} ] || rm -f {path}")
+        elif kind == "write_file":
+            lines += compile_file(operation["path"], operation["content"], mode=operation.get("mode"))
+        elif kind == "chmod":
+            lines.append(f"chmod {operation['mode']} {path}")
+        elif kind == "symlink":
+            link = shell_path(os.path.join(operation["link"], os.path.basename(os.path.normpath(operation["path"]))))
+            lines.append(f"[ -L {link} ] || ln -s {path} {shell_path(operation['link'])}")
+        elif kind == "run":
+            lines.append(operation["command"])
+        else:
+            raise ValueError(f"Cannot lower privileged operation: {kind}")
+    return lines
+
+def setup_service(service_name, service_config, paths, batch=False):
+    """
+    Dynamically handles the 'setup_service' section from the YAML file.
+    :param service_name: Name of the service (e.g., 'bluetoothd').
+    :param service_config: Dictionary containing the service configuration.
+    :param paths: Dictionary containing path placeholders (e.g., service_path, sv_path).
+    :param batch: Install the service packages in a single transaction.
+    :return: True if every step succeeded.
+    """
+    return setup_services([(service_name, service_config)], paths, batch)
+
+def setup_services(services, paths, batch=False):
+    """
+    Installs the packages of several services, then provisions and starts all of
+    them in a single privileged batch: one worker round-trip, or one sudo shell
+    without the worker.
+    :param services: List of (service name, service configuration) tuples.
+    :param paths: Dictionary containing path placeholders (e.g., service_path, sv_path).
+    :param batch: Install the service packages in a single transaction.
+    :return: True if every step succeeded.
+    """
+    names = [service_name for service_name, _ in services]
+    logger.debug(f"Starting setup_services with services: {services}, paths: {paths}")
+    with trace_span("service", ", ".join(names)):
+        success = True
+
+        # Handle packages installation
+        for service_name, service_config in services:
+            if "packages" in service_config:
+                packages = service_config["packages"]
+                success = install_packages(
+                    packages.get("package", []),
+                    packages.get("command", "sudo pacman -S {package} --needed --noconfirm"),
+                    batch=packages.get("batch", batch)
+                ) and success
+
+        operations = []
+        owners = []
+        ready_specs = []
+        for service_name, service_config in services:
+            backend = service_backend(paths, service_config)
+            service_operations = backend.operations(service_name, service_config)
+            operations += service_operations
+            owners += [service_name] * len(service_operations)
+            spec = backend.ready_spec(service_name, service_config)
+            if spec:
+                ready_specs.append(spec)
+
+        if operations:
+            logger.info(f"Provisioning {len(services)} service(s) ({len(operations)} operations)")
+        if operations and not privileged_available():
+            script = "\n".join(["set -e", *operations_script(operations)])
+            success = execute_shell([f"sudo sh -c {shlex.quote(script)}"], retries=1) and success
+        elif operations:
+            results = privileged_call("batch", operations=operations)["results"]
+            for service_name, operation, result in zip(owners, operations, results):
+                if "error" in result:
+                    logger.error(f"Service {service_name}: {result['error']}")
+                    success = False
+                elif "returncode" in result and result["returncode"] != 0:
+                    logger.error(f"Service {service_name}: '{operation['command']}' exited with {result['returncode']}")
+                    success = False
+                elif "written" in result:
+                    count_file_write("written" if result["written"] else "unchanged")
+            if len(results) < len(operations):
+                logger.error(f"Skipped {len(operations) - len(results)} service operation(s) after the failure")
+
+        # Later steps and dependent tasks only run once the services are up
+        success = wait_for_services_privileged(ready_specs) and success
+        logger.info(f"Service setup completed: {', '.join(names)}")
+        return success
+
+# Services started with service_init are waited for up to this many seconds
+# unless their 'ready' key sets another timeout; 0 disables waiting.
+SERVICE_READY_TIMEOUT = 30
+# Interval for checks that can't be watched (dinit status queries, probe commands)
+READY_POLL_INTERVAL = 0.25
+# Upper bound on a single inotify wait, in case an event is missed
+READY_MAX_WAIT = 5
 
-# Configure logging
-logging_level = logging.DEBUG if args.debug else logging.INFO
-logging.basicConfig(level=logging_level)
-logger = logging.getLogger(__name__)
+class Inotify:
+    """
+    Minimal inotify wrapper over libc, used to wake up as soon as a watched
+    directory changes instead of polling it.
+    """
+    MASK = 0x2 | 0x8 | 0x80 | 0x100 | 0x200  # IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_DELETE
+    IN_IGNORED = 0x8000  # The watch went away with its directory
 
-import time  # Import the time module
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = {}  # path -> watch descriptor
 
-def execute_shell(commands, sudo=False, retries=3, delay=5):
-    logger.debug(f"Starting execute_shell with commands: {commands}, sudo: {sudo}, retries: {retries}, delay: {delay}")
-    for command in commands:
-        attempt = 0
+    def watch(self, path):
+        """
+        Watches a directory if it exists and isn't watched yet.
+        """
+        if path in self.watched or not os.path.isdir(path):
+            return
+        descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if descriptor >= 0:
+            self.watched[path] = descriptor
 
-        while attempt < retries:
+    def wait(self, timeout):
+        """
+        Blocks until a watched directory changes or timeout seconds have passed.
+        """
+        import select
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if readable:
             try:
-                if sudo:
-                    command = f"sudo {command}"
-                logger.info(f"Executing: {command}")
-                subprocess.run(command, shell=True, check=True, timeout=120)  # Adjust the timeout as needed
-                break
-            except subprocess.CalledProcessError as e:
-                attempt += 1
-                logger.error(f"Error executing command: {command}")
-                if attempt == retries:
-                    logger.error(f"Command failed after {retries} attempts: {command}")
-                    user_input = input(f"Command failed after {retries} attempts: {command}. Do you want to continue? (yes/no): ")
-                    if user_input.lower() == "yes":
-                        logger.info("User chose to continue.")
+                while True:
+                    data = os.read(self.fd, 65536)
+                    if not data:
                         break
-                    else:
-                        logger.info("User chose to stop execution.")
-                        return
-                logger.info(f"Retrying ({attempt}/{retries}): {command}")
-                time.sleep(delay)  # Add a delay before retrying
+                    self.handle_events(data)
+            except BlockingIOError:
+                pass
 
-def execute_python(script, *args, sudo=False):
+    def handle_events(self, data):
+        """
+        Reads a buffer of struct inotify_event. Watches whose directory went away
+        are forgotten, so the directory is watched again once it is recreated.
+        """
+        import struct
+        offset = 0
+        while offset + 16 <= len(data):
+            descriptor, mask, _, length = struct.unpack_from("iIII", data, offset)
+            offset += 16 + length
+            if mask & self.IN_IGNORED:
+                self.watched = {path: wd for path, wd in self.watched.items() if wd != descriptor}
+
+    def close(self):
+        os.close(self.fd)
+
+def capture_command(command, timeout=10):
     """
-    Executes a Python script with optional arguments.
-    :param script: Path to the Python script to execute.
-    :param args: Arguments to pass to the script.
-    :param sudo: Whether to run the command with sudo.
+    Runs a command quietly.
+    :return: Tuple of (exit code, stdout); exit code is None if it couldn't run in time.
     """
-    logger.debug(f"Starting execute_python with script: {script}, args: {args}, sudo: {sudo}")
-    command = "python3"
-    if sudo:
-        command = f"sudo {command}"
     try:
-        full_command = f"{command} {script} {' '.join(args)}"
-        logger.info(f"Executing Python script: {full_command}")
-        subprocess.run(full_command, shell=True, check=True)
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error executing Python script: {full_command}")
-        logger.error(e)
+        result = subprocess.run(command, shell=isinstance(command, str), capture_output=True, text=True, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired):
+        return None, ""
+    return result.returncode, result.stdout
 
-def install_packages(packages, command_template, sudo=False):
-    logger.debug(f"Starting install_packages with packages: {packages}, command_template: {command_template}, sudo: {sudo}")
-    for package in packages:
-        command = command_template.format(package=package)
-        execute_shell([command], sudo)
+def service_is_up(spec):
+    """
+    Checks one readiness spec: the init system reports the service as running and
+    every configured health probe passes.
+    """
+    if spec.get("stat"):
+        try:
+            with open(spec["stat"], "r") as stat_file:
+                if stat_file.read().strip() != "run":
+                    return False
+        except OSError:
+            return False
+    if spec.get("dinit"):
+        returncode, output = capture_command(["dinitctl", "status", spec["name"]])
+        if returncode != 0 or not re.search(r"State:\s*STARTED", output):
+            return False
+    if spec.get("socket"):
+        try:
+            if not stat.S_ISSOCK(os.stat(spec["socket"]).st_mode):
+                return False
+        except OSError:
+            return False
+    if spec.get("command"):
+        returncode, _ = capture_command(spec["command"])
+        if returncode != 0:
+            return False
+    return True
 
-def write_to_file(filepath, content, sudo=False, backup=False):
-    logger.debug(f"Starting write_to_file with filepath: {filepath}, sudo: {sudo}, backup: {backup}")
+def ready_watch_paths(spec):
+    """
+    Directories whose changes may make a spec ready. On Artix, supervise in a
+    service directory is a symlink to /run/runit/supervise.NAME, which runsv only
+    creates once the service is linked, so the directory it resolves to and that
+    directory's parent are watched too.
+    """
+    paths = []
+    if spec.get("stat"):
+        supervise = os.path.dirname(spec["stat"])
+        resolved = os.path.realpath(supervise)
+        paths += [os.path.dirname(supervise), supervise]
+        if resolved != supervise:
+            paths += [os.path.dirname(resolved), resolved]
+    if spec.get("socket"):
+        paths.append(os.path.dirname(spec["socket"]))
+    return paths
+
+def wait_for_services(specs):
+    """
+    Waits for several services at once. Runit status files and probe sockets are
+    watched with inotify; dinit status and probe commands are polled. Each service
+    has its own timeout, and the wait ends as soon as every service is up or has
+    timed out.
+    :param specs: List of readiness specs from ServiceBackend.ready_spec().
+    :return: Dictionary with the 'ready' and 'failed' service names.
+    """
+    start = time.monotonic()
+    pending = {spec["name"]: spec for spec in specs}
+    ready, failed = [], []
     try:
-        logger.info(f"Preparing to write to file: {filepath}")
-        dir_path = os.path.dirname(filepath)
-        if sudo:
-            execute_shell([f"sudo mkdir -p {dir_path}"])
-        else:
-            os.makedirs(dir_path, exist_ok=True)
-
-        # Check if the file exists
-        if os.path.exists(filepath) and backup:
-            # Create a backup
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            backup_filepath = f"{filepath}.{timestamp}"
-            logger.info(f"File exists. Creating backup: {backup_filepath}")
-            if sudo:
-                execute_shell([f"sudo cp {filepath} {backup_filepath}"])
+        inotify = Inotify()
+    except (OSError, AttributeError) as e:
+        logger.debug(f"inotify unavailable, polling service status: {e}")
+        inotify = None
+    try:
+        while pending:
+            now = time.monotonic()
+            for name, spec in list(pending.items()):
+                if inotify:
+                    for path in ready_watch_paths(spec):
+                        inotify.watch(path)
+                if service_is_up(spec):
+                    logger.info(f"Service {name} is up after {now - start:.2f}s")
+                    ready.append(name)
+                    del pending[name]
+                elif now - start >= spec["timeout"]:
+                    logger.error(f"Service {name} did not come up within {spec['timeout']}s")
+                    failed.append(name)
+                    del pending[name]
+            if not pending:
+                break
+            next_deadline = min(start + spec["timeout"] for spec in pending.values()) - time.monotonic()
+            polled = inotify is None or any(spec.get("dinit") or spec.get("command") for spec in pending.values())
+            timeout = min(next_deadline, READY_POLL_INTERVAL if polled else READY_MAX_WAIT)
+            if inotify:
+                # Wakes on IN_CREATE too; new directories are watched on the next pass
+                inotify.wait(timeout)
             else:
-                shutil.copy(filepath, backup_filepath)
-
-        # Write to a temporary file in /tmp if sudo is required
-        temp_path = f"/tmp/{os.path.basename(filepath)}"
-        with open(temp_path, "w") as temp_file:
-            temp_file.write(content)
+                time.sleep(max(timeout, 0))
+    finally:
+        if inotify:
+            inotify.close()
+    return {"ready": ready, "failed": failed}
 
-        # Move the temporary file to the final location
-        if sudo:
-            execute_shell([f"sudo mv {temp_path} {filepath}"])
+def wait_for_services_privileged(specs):
+    """
+    Runs wait_for_services() as root, where runit's supervise directories and the
+    dinit control socket are readable: in the privileged worker, or in a single
+    sudo'd copy of this script without it.
+    :return: True if every service came up.
+    """
+    if not specs:
+        return True
+    logger.info(f"Waiting for {len(specs)} service(s): {', '.join(spec['name'] for spec in specs)}")
+    with trace_span("service", "wait", services=len(specs)):
+        if privileged_available():
+            result = privileged_call("wait_ready", services=specs)
         else:
-            os.replace(temp_path, filepath)
+            command = ["sudo", sys.executable, os.path.abspath(__file__), "--wait-ready", json.dumps(specs)]
+            try:
+                result = json.loads(subprocess.run(command, stdout=subprocess.PIPE, text=True).stdout)
+            except ValueError:
+                logger.error("Waiting for services failed")
+                return False
+    return not result["failed"]
 
-        logger.info(f"Successfully wrote to file: {filepath}")
+MIRROR_CACHE_PATH = os.path.expanduser("~/.cache/artix-setup/mirrors.json")
+MIRROR_CACHE_TTL = 24 * 3600
+MIRROR_CONCURRENCY = 16
+MIRROR_TIMEOUT = 5
+MIRROR_KEEP = 10
+# At most this much of the sample file is downloaded to measure throughput
+MIRROR_SAMPLE_BYTES = 1024 * 1024
+# Mirrors are ranked by the estimated time to fetch a package of this size:
+# latency + MIRROR_REFERENCE_BYTES / throughput
+MIRROR_REFERENCE_BYTES = 4 * 1024 * 1024
+MIRROR_SERVER_PATTERN = re.compile(r"^\s*#?\s*Server\s*=\s*(\S+)", re.MULTILINE)
 
-    except Exception as e:
-        logger.error(f"Error writing to file: {filepath}")
-        logger.error(e)
+mirror_cache_lock = threading.Lock()
 
-def setup_service(service_name, service_config, paths):
+def read_mirror_sources(source, timeout=MIRROR_TIMEOUT):
     """
-    Dynamically handles the 'setup_service' section from the YAML file.
-    :param service_name: Name of the service (e.g., 'bluetoothd').
-    :param service_config: Dictionary containing the service configuration.
-    :param paths: Dictionary containing path placeholders (e.g., service_path, sv_path).
+    Returns the Server URLs listed in a mirrorlist, commented out or not.
+    :param source: URL or local path of the mirrorlist.
     """
-    logger.debug(f"Starting setup_service with service_name: {service_name}, service_config: {service_config}, paths: {paths}")
+    if re.match(r"^[a-z]+://", source):
+        import urllib.request
+        with urllib.request.urlopen(source, timeout=timeout) as response:
+            text = response.read().decode("utf-8", errors="replace")
+    else:
+        with open(os.path.expanduser(source), "r") as mirrorlist:
+            text = mirrorlist.read()
+    return list(dict.fromkeys(MIRROR_SERVER_PATTERN.findall(text)))
 
-    placeholders = {
-        "service_path": paths.get("service_path", "/run/runit/service/"),
-        "sv_path": paths.get("sv_path", "/etc/runit/sv/"),
-        "service_name": service_name,
-    }
+def mirror_sample_url(server, repo, sample):
+    """
+    Returns the URL of the sample file on a mirror, with $repo and $arch filled in.
+    """
+    import platform
+    base = server.replace("$repo", repo).replace("$arch", platform.machine())
+    return f"{base.rstrip('/')}/{sample.replace('$repo', repo)}"
 
-    # Handle packages installation
-    if "packages" in service_config:
-        packages = service_config["packages"]
-        package_command = packages.get("command", "sudo pacman -S {package} --needed --noconfirm")
-        for package in packages.get("package", []):
-            execute_shell([package_command.format(package=package)])
-
-    # Handle path initialization
-    if service_config.get("path_init", False):
-        path_init_commands = [
-            'sudo rm -f {service_path}{service_name}',
-            'sudo mkdir -p {sv_path}{service_name}',
-            'sudo mkdir -p {sv_path}{service_name}/log',
-            'sudo mkdir -p {sv_path}{service_name}/log/main',
-        ]
-        for cmd in path_init_commands:
-            execute_shell([cmd.format(**placeholders)])
-
-    # Handle run and log file creation
-    for file_type, file_config in [("run_file", "run"), ("log_file", "log/run")]:
-        if file_type in service_config:
-            file_path = f"{placeholders['sv_path']}{service_name}/{file_config}"
-            file_content = service_config[file_type]["content"]
-            write_to_file(file_path, file_content, sudo=True)
-            execute_shell([f"sudo chmod +x {file_path}"])
-
-    # Handle service initialization
-    if service_config.get("service_init", False):
-        service_init_commands = [
-            'sudo chmod +x {sv_path}{service_name}/run',
-            'sudo chmod +x {sv_path}{service_name}/log/run',
-            'sudo ln -s {sv_path}{service_name} {service_path}',
-            'sudo sv start {service_name}',
-        ]
-        for cmd in service_init_commands:
-            execute_shell([cmd.format(**placeholders)], sudo=True)
-
-    logger.info(f"Service {service_name} setup completed.")
-
-def parse_and_execute(yaml_content, debug=False):
+async def probe_mirror(url, sample_bytes):
     """
-    Parses the YAML content and executes tasks based on its structure with detailed debugging.
+    Requests a sample file from a mirror over a raw HTTP/1.1 connection.
+    :return: Tuple of (latency to the status line in seconds, throughput in bytes/s).
     """
-    logger.debug(f"Starting parse_and_execute with yaml_content: {yaml_content}")
-    for task_name, task_config in yaml_content.items():
-        logger.info(f"Processing task: {task_name}")
+    import asyncio
+    import urllib.parse
+    parts = urllib.parse.urlsplit(url)
+    secure = parts.scheme == "https"
+    port = parts.port or (443 if secure else 80)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=secure or None)
+    try:
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nUser-Agent: artix-setup\r\n"
+            "Connection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        status_line = await reader.readline()
+        latency = time.perf_counter() - start
+        fields = status_line.split()
+        if len(fields) < 2 or fields[1] != b"200":
+            raise OSError(f"unexpected response {status_line.decode(errors='replace').strip()!r}")
+        while (await reader.readline()).strip():
+            pass  # Headers
+
+        body_start = time.perf_counter()
+        received = 0
+        while received < sample_bytes:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            received += len(chunk)
+        elapsed = max(time.perf_counter() - body_start, 1e-6)
+        if not received:
+            raise OSError("empty response")
+        return latency, received / elapsed
+    finally:
+        writer.close()
+
+async def probe_mirrors(servers, repo, sample, concurrency, timeout, sample_bytes):
+    """
+    Probes every mirror concurrently, at most concurrency at a time.
+    :return: List of {"server", "latency", "throughput"} dicts for the mirrors that responded.
+    """
+    import asyncio
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(server):
+        async with semaphore:
+            url = mirror_sample_url(server, repo, sample)
+            try:
+                latency, throughput = await asyncio.wait_for(probe_mirror(url, sample_bytes), timeout)
+            except (OSError, asyncio.TimeoutError, ValueError) as e:
+                logger.debug(f"Mirror {server} failed: {e or type(e).__name__}")
+                return None
+            return {"server": server, "latency": round(latency, 4), "throughput": round(throughput)}
+
+    results = await asyncio.gather(*(probe(server) for server in servers))
+    return [result for result in results if result]
+
+def mirror_score(mirror):
+    """
+    Estimated seconds to fetch a typical package from a mirror; lower is better.
+    """
+    return mirror["latency"] + MIRROR_REFERENCE_BYTES / max(mirror["throughput"], 1)
+
+def mirror_cache_key(list_config):
+    """
+    Identifies a ranking by everything that affects it.
+    """
+    fields = [list_config.get(key) for key in ("source", "repo", "sample")]
+    return content_hash(json.dumps(fields))
+
+def load_mirror_cache():
+    try:
+        with open(MIRROR_CACHE_PATH, "r") as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+def save_mirror_ranking(key, ranking):
+    """
+    Stores one ranking in the mirror cache, keeping the others.
+    """
+    with mirror_cache_lock:
+        cache = load_mirror_cache()
+        cache[key] = ranking
+        try:
+            os.makedirs(os.path.dirname(MIRROR_CACHE_PATH), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(MIRROR_CACHE_PATH))
+            with os.fdopen(fd, "w") as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(temp_path, MIRROR_CACHE_PATH)
+        except OSError as e:
+            logger.warning(f"Could not save mirror rankings: {e}")
+
+def mirrorlist_content(name, ranking, keep):
+    """
+    Renders a ranked mirrorlist with the measurements as comments.
+    Depends only on the ranking, so rewriting from the cache leaves the file unchanged.
+    """
+    ranked_at = datetime.fromtimestamp(ranking["time"]).strftime("%Y-%m-%d %H:%M:%S")
+    mirrors = ranking["mirrors"][:keep]
+    lines = [
+        f"# {name} mirrors ranked by {os.path.basename(__file__)} on {ranked_at}",
+        f"# {len(ranking['mirrors'])} of {ranking['probed']} mirror(s) responded, best {len(mirrors)} kept",
+        "",
+    ]
+    for mirror in mirrors:
+        lines.append(f"# {mirror['latency'] * 1000:.0f} ms, {mirror['throughput'] / 1048576:.2f} MiB/s")
+        lines.append(f"Server = {mirror['server']}")
+    return "\n".join(lines) + "\n"
+
+def rank_mirror_list(list_config, defaults):
+    """
+    Ranks one mirrorlist, or reuses a ranking from the cache younger than the TTL.
+    :param list_config: The list's 'source', 'output', 'repo' and optional 'name',
+                        'sample' and 'keep'.
+    :param defaults: The 'mirrors' task's 'ttl', 'concurrency' and 'timeout'.
+    :return: Ranking dict with 'time', 'probed' and 'mirrors', or None if no mirror responded.
+    """
+    import asyncio
+    name = list_config.get("name", list_config["output"])
+    key = mirror_cache_key(list_config)
+    ttl = defaults.get("ttl", MIRROR_CACHE_TTL)
+    with mirror_cache_lock:
+        cached = load_mirror_cache().get(key)
+    if cached and time.time() - cached["time"] < ttl:
+        logger.info(f"Using {name} mirror ranking from {datetime.fromtimestamp(cached['time']):%Y-%m-%d %H:%M}")
+        return cached
 
-        if task_name == "service_paths":
-            logger.debug(f"Skipping 'service_paths' configuration.")
+    timeout = defaults.get("timeout", MIRROR_TIMEOUT)
+    servers = read_mirror_sources(list_config["source"], timeout)
+    logger.info(f"Probing {len(servers)} {name} mirror(s)")
+    with trace_span("mirrors", name, count=len(servers)):
+        mirrors = asyncio.run(probe_mirrors(
+            servers,
+            list_config.get("repo", "core"),
+            list_config.get("sample", "$repo.db"),
+            defaults.get("concurrency", MIRROR_CONCURRENCY),
+            timeout,
+            defaults.get("sample_bytes", MIRROR_SAMPLE_BYTES),
+        ))
+    if not mirrors:
+        logger.error(f"None of the {len(servers)} {name} mirror(s) responded")
+        return None
+    mirrors.sort(key=mirror_score)
+    ranking = {"time": time.time(), "probed": len(servers), "mirrors": mirrors}
+    save_mirror_ranking(key, ranking)
+    return ranking
+
+def rank_mirrors(mirrors_config):
+    """
+    Ranks every mirrorlist of a 'mirrors' task and writes the fastest mirrors to
+    each list's output file.
+    :param mirrors_config: Dictionary with 'lists' and optional 'ttl', 'concurrency',
+                           'timeout' and 'sample_bytes'.
+    :return: True if every list was ranked and written.
+    """
+    success = True
+    for list_config in mirrors_config.get("lists", []) or []:
+        name = list_config.get("name", list_config["output"])
+        try:
+            ranking = rank_mirror_list(list_config, mirrors_config)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not rank {name} mirrors: {e}")
+            ranking = None
+        if ranking is None:
+            success = False
             continue
+        content = mirrorlist_content(name, ranking, list_config.get("keep", MIRROR_KEEP))
+        if write_to_file(os.path.expanduser(list_config["output"]), content, sudo=True) is None:
+            success = False
+    return success
+
+ZRAM_SCRIPT_PATH = "/usr/local/bin/zram-setup"
+ZRAM_SYSCTL_PATH = "/etc/sysctl.d/99-zram.conf"
+# Compression algorithms tried in order; the first one the kernel offers is used
+ZRAM_ALGORITHMS = ["zstd", "lz4", "lzo-rle", "lzo"]
+ZRAM_DEFAULTS = {
+    "size": "50%",        # of MemTotal, or an absolute size such as 8GiB
+    "max_size": "16GiB",
+    "devices": 1,
+    "priority": 32767,    # above any disk swap
+    "swappiness": 180,    # swapping to compressed RAM is cheaper than dropping page cache
+    "page_cluster": 0,    # no readahead: zram has no seek cost to amortize
+}
+ZRAM_SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "KIB": 1024, "M": 1024 ** 2, "MIB": 1024 ** 2,
+                   "G": 1024 ** 3, "GIB": 1024 ** 3, "T": 1024 ** 4, "TIB": 1024 ** 4}
+
+def parse_byte_size(size):
+    """
+    Converts a size such as 512MiB, 8G or 1048576 to bytes.
+    """
+    match = re.match(r"^\s*([0-9.]+)\s*([A-Za-z]*)\s*$", str(size))
+    if not match or match.group(2).upper() not in ZRAM_SIZE_UNITS:
+        raise ValueError(f"Invalid size: {size}")
+    return int(float(match.group(1)) * ZRAM_SIZE_UNITS[match.group(2).upper()])
+
+def zram_script(zram_config):
+    """
+    Returns the boot script that sets up zram swap. The size is worked out from
+    MemTotal on the machine it runs on, so one plan fits every machine.
+    :param zram_config: Dictionary of a 'zram' task, see ZRAM_DEFAULTS and ZRAM_ALGORITHMS.
+    """
+    config = dict(ZRAM_DEFAULTS, **zram_config)
+    devices = int(config["devices"])
+    algorithms = config.get("algorithm", ZRAM_ALGORITHMS)
+    if isinstance(algorithms, str):
+        algorithms = [algorithms]
+    size = str(config["size"])
+    if size.endswith("%"):
+        size_kb = f"$((mem_kb * {int(float(size[:-1]))} / 100))"
+    else:
+        size_kb = str(parse_byte_size(size) // 1024)
+    max_kb = parse_byte_size(config["max_size"]) // 1024 if config.get("max_size") else 0
+    return "\n".join([
+        "#!/bin/sh",
+        f"# zram swap, written by {os.path.basename(__file__)}",
+        "grep -q '^/dev/zram' /proc/swaps && exit 0",
+        f"modprobe zram num_devices={devices} || exit 1",
+        "mem_kb=$(awk '/^MemTotal:/ {print $2}' /proc/meminfo)",
+        f"size_kb={size_kb}",
+        f"[ {max_kb} -gt 0 ] && [ \"$size_kb\" -gt {max_kb} ] && size_kb={max_kb}",
+        f"per_device_kb=$((size_kb / {devices}))",
+        "i=0",
+        f"while [ \"$i\" -lt {devices} ]; do",
+        "    dev=/sys/block/zram$i",
+        f"    for alg in {' '.join(shlex.quote(algorithm) for algorithm in algorithms)}; do",
+        "        if grep -qw -- \"$alg\" \"$dev/comp_algorithm\"; then echo \"$alg\" > \"$dev/comp_algorithm\"; break; fi",
+        "    done",
+        "    echo \"${per_device_kb}K\" > \"$dev/disksize\"",
+        "    mkswap \"/dev/zram$i\" > /dev/null",
+        f"    swapon -p {int(config['priority'])} \"/dev/zram$i\"",
+        "    i=$((i + 1))",
+        "done",
+        f"sysctl -q -w vm.swappiness={int(config['swappiness'])} vm.page-cluster={int(config['page_cluster'])}",
+    ]) + "\n"
+
+def zram_operations(zram_config, paths):
+    """
+    Returns the privileged operations that install the zram script, persist the
+    swappiness and page-cluster settings, hook the script into boot for the
+    init system and run it now.
+    runit runs it from /etc/runit/core-services during stage 1; dinit gets a
+    scripted 'zram' service linked into boot.d.
+    :param zram_config: Dictionary of a 'zram' task.
+    :param paths: service_paths of the plan (for 'init' and 'dinit_path').
+    """
+    config = dict(ZRAM_DEFAULTS, **zram_config)
+    init = zram_config.get("init") or paths.get("init") or detect_init_system()
+    operations = [
+        {"op": "write_file", "path": ZRAM_SCRIPT_PATH, "content": zram_script(zram_config), "mode": "+x"},
+        {"op": "write_file", "path": ZRAM_SYSCTL_PATH,
+         "content": f"vm.swappiness = {int(config['swappiness'])}\nvm.page-cluster = {int(config['page_cluster'])}\n"},
+    ]
+    if init == "runit":
+        operations.append({"op": "write_file", "path": "/etc/runit/core-services/90-zram.sh",
+                           "content": f"{ZRAM_SCRIPT_PATH}\n"})
+    elif init == "dinit":
+        dinit_path = paths.get("dinit_path", "/etc/dinit.d/")
+        operations.append({"op": "write_file", "path": f"{dinit_path}zram",
+                           "content": f"type = scripted\ncommand = {ZRAM_SCRIPT_PATH}\n"})
+        operations.append({"op": "mkdir", "path": f"{dinit_path}boot.d"})
+        operations.append({"op": "symlink", "path": f"{dinit_path}zram", "link": f"{dinit_path}boot.d"})
+    else:
+        raise ValueError(f"Unsupported init system: {init}")
+    if zram_config.get("apply", True):
+        operations.append({"op": "run", "command": ZRAM_SCRIPT_PATH, "timeout": 60})
+    return operations
+
+def setup_zram(zram_config, paths):
+    """
+    Applies a 'zram' task in one privileged batch.
+    :return: True if every operation succeeded.
+    """
+    try:
+        operations = zram_operations(zram_config, paths)
+    except ValueError as e:
+        logger.error(f"zram: {e}")
+        return False
+    if not privileged_available():
+        script = "\n".join(["set -e", *operations_script(operations)])
+        return execute_shell([f"sudo sh -c {shlex.quote(script)}"], retries=1)
+    success = True
+    for operation, result in zip(operations, privileged_call("batch", operations=operations)["results"]):
+        if "error" in result:
+            logger.error(f"zram: {result['error']}")
+            success = False
+        elif "returncode" in result and result["returncode"] != 0:
+            logger.error(f"zram: '{operation['command']}' exited with {result['returncode']}")
+            success = False
+        elif "written" in result:
+            count_file_write("written" if result["written"] else "unchanged")
+    return success
+
+JOURNAL_PATH = os.path.expanduser("~/.cache/artix-setup/journal.jsonl")
+
+# Open journal file and the hashes of steps that succeeded in an earlier run
+journal_file = None
+journal_lock = threading.Lock()
+completed_steps = set()
+
+def open_journal(path=JOURNAL_PATH, resume=False):
+    """
+    Opens the step journal. With resume, the hashes of steps recorded as successful
+    are loaded and new entries are appended; otherwise the journal starts empty.
+    :param path: Path of the journal file.
+    :param resume: Whether to skip steps already completed in an earlier run.
+    """
+    global journal_file
+    completed_steps.clear()
+    if resume:
+        try:
+            with open(path, "r") as existing:
+                for line in existing:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Partially written line from an interrupted run
+                    if entry.get("status") == "ok":
+                        completed_steps.add(entry["hash"])
+        except FileNotFoundError:
+            pass
+        logger.info(f"Resuming: {len(completed_steps)} step(s) already completed")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    journal_file = open(path, "a" if resume else "w")
+
+def close_journal():
+    global journal_file
+    if journal_file:
+        journal_file.close()
+        journal_file = None
+
+def step_hash(task_name, kind, data):
+    """
+    Returns a stable hash identifying a step by its task, kind and content.
+    """
+    return content_hash(json.dumps([task_name, kind, data], sort_keys=True, default=str))
+
+def run_step(task_name, kind, data, action):
+    """
+    Runs one step of a task and records it in the journal. Steps already recorded
+    as successful are skipped when resuming.
+    :param task_name: Name of the task.
+    :param kind: Step kind ('packages', 'mirrors', 'setup_service', 'shell', 'python', 'file').
+    :param data: Everything that defines the step, hashed to identify it.
+    :param action: Callable performing the step; returning False or None marks it failed.
+    :return: True if the step succeeded or had already completed.
+    """
+    key = step_hash(task_name, kind, data)
+    if key in completed_steps:
+        logger.info(f"Skipping completed {kind} step of task {task_name}")
+        return True
+    start = time.monotonic()
+    status = "failed"
+    try:
+        result = action()
+        status = "failed" if result is None or result is False else "ok"
+    finally:
+        if journal_file:
+            entry = {
+                "task": task_name,
+                "kind": kind,
+                "hash": key,
+                "status": status,
+                "duration": round(time.monotonic() - start, 3),
+                "time": datetime.now().isoformat(timespec="seconds"),
+            }
+            with journal_lock:
+                journal_file.write(json.dumps(entry) + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+    return status == "ok"
+
+def execute_shell_step(command):
+    """
+    Runs a shell command from a task's 'shell' list.
+    """
+    if "chmod +x" in command:
+        file_to_check = os.path.expanduser(command.split()[-1])
+        if not os.path.exists(file_to_check):
+            logger.warning(f"File {file_to_check} does not exist. Creating it before running chmod.")
+            try:
+                with open(file_to_check, 'w') as temp_file:
+                    temp_file.write("# Created by the script")
+            except Exception as e:
+                logger.error(f"Failed to create file {file_to_check}: {e}")
+    if uses_pacman_lock(command):
+        with pacman_lock:
+            return execute_shell([command])
+    return execute_shell([command])
+
+def write_file_step(file_path, content):
+    """
+    Writes a file from a task's 'file' or 'files' key.
+    :return: True if the file was written or already up to date.
+    """
+    try:
+        return write_to_file(file_path, content, sudo=True, backup=True) is not None
+    except Exception as e:
+        logger.error(f"Failed to create file {file_path}: {e}")
+        return False
+
+def task_services(task_name, task_config):
+    """
+    Returns the services a task sets up: its 'setup_service' (named by 'service_name'
+    or the task) and every entry of its 'services' mapping.
+    :return: List of (service name, service configuration) tuples.
+    """
+    services = []
+    if isinstance(task_config.get("setup_service"), dict):
+        services.append((task_config.get("service_name", task_name), task_config["setup_service"]))
+    for service_name, service_config in (task_config.get("services") or {}).items():
+        services.append((service_name, service_config or {}))
+    return services
+
+def execute_task(task_name, task_config, yaml_content, batch=False):
+    """
+    Executes a single top-level task from the YAML file. Each package list, service,
+    shell command, Python script and file is a separate step in the journal.
+    :param task_name: Name of the task.
+    :param task_config: Dictionary containing the task configuration.
+    :param yaml_content: Full parsed YAML dictionary (used for 'service_paths').
+    :param batch: Default for installing each package list in a single transaction.
+    :return: True if every step succeeded, so tasks depending on it may run.
+    """
+    with trace_span("task", task_name):
+        logger.info(f"Processing task: {task_name}")
 
         # Debugging full task structure
         logger.debug(f"Full task configuration for {task_name}: {task_config}")
+        success = True
 
         # Install Packages
         if "packages" in task_config:
             logger.info(f"Installing packages for task: {task_name}")
-            install_packages(
-                task_config["packages"].get("package", []),
-                task_config["packages"].get("command", "sudo pacman -S {package} --needed --noconfirm")
-            )
-
-        # Setup Service
-        if "setup_service" in task_config:
-            logger.info(f"Setting up service for task: {task_name}")
+            packages = task_config["packages"]
+            success = run_step(task_name, "packages", packages, lambda: install_packages(
+                packages.get("package", []),
+                packages.get("command", "sudo pacman -S {package} --needed --noconfirm"),
+                batch=packages.get("batch", batch)
+            )) and success
+
+        # Rank Mirrors
+        if "mirrors" in task_config:
+            logger.info(f"Ranking mirrors for task: {task_name}")
+            mirrors_config = task_config["mirrors"]
+            success = run_step(task_name, "mirrors", mirrors_config, lambda: rank_mirrors(mirrors_config)) and success
+
+        # Configure zram swap
+        if "zram" in task_config:
+            logger.info(f"Configuring zram swap for task: {task_name}")
+            zram_config = task_config["zram"] or {}
+            service_paths = yaml_content.get("service_paths", {})
+            success = run_step(task_name, "zram", zram_config, lambda: setup_zram(zram_config, service_paths)) and success
+
+        # Setup Services
+        services = task_services(task_name, task_config)
+        if services:
+            logger.info(f"Setting up {len(services)} service(s) for task: {task_name}")
             service_paths = yaml_content.get("service_paths", {})
-            service_name = task_config.get("service_name", task_name)
-            setup_service(service_name, task_config["setup_service"], service_paths)
+            success = run_step(
+                task_name, "setup_service", [services, service_paths],
+                lambda: setup_services(services, service_paths, batch=batch)
+            ) and success
 
         # Execute General Shell Commands
         if "shell" in task_config:
             logger.info(f"Executing shell commands for task: {task_name}")
             logger.debug(f"Shell commands: {task_config['shell']}")
-            for command in task_config["shell"]:
-                if "chmod +x" in command:
-                    file_to_check = os.path.expanduser(command.split()[-1])
-                    if not os.path.exists(file_to_check):
-                        logger.warning(f"File {file_to_check} does not exist. Creating it before running chmod.")
-                        try:
-                            with open(file_to_check, 'w') as temp_file:
-                                temp_file.write("# Created by the script")
-                        except Exception as e:
-                            logger.error(f"Failed to create file {file_to_check}: {e}")
-                execute_shell([command])
+            for index, command in enumerate(task_config["shell"]):
+                success = run_step(task_name, "shell", [index, command], lambda: execute_shell_step(command)) and success
 
         # Execute Python Scripts
         if "python" in task_config:
             logger.info(f"Executing Python script for task: {task_name}")
             logger.debug(f"Python config: {task_config['python']}")
             if isinstance(task_config["python"], dict):
-                execute_python(
-                    task_config["python"].get("script", ""),
-                    *task_config["python"].get("parameters", [])
-                )
+                python_config = task_config["python"]
+                success = run_step(task_name, "python", python_config, lambda: execute_python(
+                    python_config.get("script", ""),
+                    *python_config.get("parameters", [])
+                )) and success
 
         # Handle Single File Creation
         if "file" in task_config:
@@ -231,15 +2480,8 @@ def parse_and_execute(yaml_content, debug=False):
             if isinstance(file_config, dict) and "name" in file_config and "content" in file_config:
                 file_path = os.path.expanduser(file_config['name'])
                 logger.info(f"Attempting to write single file: {file_path}")
-                try:
-                    write_to_file(
-                        file_path,
-                        file_config["content"],
-                        sudo=True,
-                        backup=True
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to create file {file_path}: {e}")
+                success = run_step(task_name, "file", [file_path, file_config["content"]],
+                                   lambda: write_file_step(file_path, file_config["content"])) and success
 
         # Handle Multiple Files Creation using a list
         if "files" in task_config:
@@ -248,36 +2490,613 @@ def parse_and_execute(yaml_content, debug=False):
                 if isinstance(file_config, dict) and "name" in file_config and "content" in file_config:
                     file_path = os.path.expanduser(file_config['name'])
                     logger.info(f"Attempting to write file: {file_path}")
-                    try:
-                        write_to_file(
-                            file_path,
-                            file_config["content"],
-                            sudo=True,
-                            backup=True
-                        )
-                    except Exception as e:
-                        logger.error(f"Failed to create file {file_path}: {e}")
+                    success = run_step(task_name, "file", [file_path, file_config["content"]],
+                                       lambda: write_file_step(file_path, file_config["content"])) and success
                 else:
                     logger.error(f"Invalid file structure under 'files' key in task: {task_name}. Contents: {file_config}")
 
         logger.info(f"Finished task: {task_name}\n")
+        return success
 
-if __name__ == "__main__":
-    # Ensure a YAML file is provided
-    if not args.yaml_file:
-        logger.error("No YAML file provided. Use --help for usage information.")
-        sys.exit(1)
+def task_dependencies(task_name, task_config):
+    """
+    Returns the names listed under a task's optional 'after' and 'needs' keys.
+    """
+    dependencies = []
+    for key in ("after", "needs"):
+        value = task_config.get(key, []) if isinstance(task_config, dict) else []
+        if isinstance(value, str):
+            value = [value]
+        dependencies.extend(value)
+    return dependencies
+
+def build_task_graph(yaml_content):
+    """
+    Builds the dependency graph of the top-level tasks.
+    :param yaml_content: Parsed YAML dictionary.
+    :return: Tuple of (task order, dict of task name -> set of task names it depends on).
+    :raises ValueError: If the dependencies contain a cycle.
+    """
+    order = [name for name in yaml_content if name != "service_paths"]
+    graph = {}
+    for task_name in order:
+        graph[task_name] = set()
+        for dependency in task_dependencies(task_name, yaml_content[task_name]):
+            if dependency not in yaml_content or dependency == "service_paths":
+                logger.warning(f"Task {task_name} depends on unknown task {dependency}. Ignoring.")
+                continue
+            graph[task_name].add(dependency)
+
+    # Kahn's algorithm, only to detect cycles
+    remaining = {name: set(deps) for name, deps in graph.items()}
+    ready = [name for name in order if not remaining[name]]
+    visited = 0
+    while ready:
+        done = ready.pop()
+        visited += 1
+        for name in order:
+            if done in remaining[name]:
+                remaining[name].discard(done)
+                if not remaining[name]:
+                    ready.append(name)
+    if visited != len(order):
+        cycle = sorted(name for name, deps in remaining.items() if deps)
+        raise ValueError(f"Task dependencies contain a cycle involving: {', '.join(cycle)}")
+
+    return order, graph
+
+def run_task_graph(order, graph, run_task, jobs=1):
+    """
+    Runs tasks on a worker pool, starting each one as soon as everything it depends
+    on has finished. Ready tasks are started in YAML order, so jobs=1 keeps the
+    original sequential behaviour. Tasks depending on a failed task are skipped.
+    :param order: Task names in YAML order.
+    :param graph: Dict of task name -> set of task names it depends on.
+    :param run_task: Callable taking a task name; returning False or raising marks the task failed.
+    :param jobs: Number of worker threads.
+    """
+    remaining = {name: set(deps) for name, deps in graph.items()}
+    started = set()
+    failed = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        def submit_ready():
+            progressed = True
+            while progressed:
+                progressed = False
+                for name in order:
+                    if name in started or remaining[name]:
+                        continue
+                    if graph[name] & failed:
+                        logger.error(f"Skipping task {name} because a task it depends on failed.")
+                        started.add(name)
+                        failed.add(name)
+                        finish(name)
+                        progressed = True
+                        continue
+                    if len(running) >= max(1, jobs):
+                        return
+                    started.add(name)
+                    running[pool.submit(run_task, name)] = name
+
+        def finish(done):
+            for name in order:
+                remaining[name].discard(done)
+
+        submit_ready()
+        while running:
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                name = running.pop(future)
+                try:
+                    if future.result() is False:
+                        logger.error(f"Task {name} failed.")
+                        failed.add(name)
+                except Exception as e:
+                    logger.error(f"Task {name} failed: {e}")
+                    failed.add(name)
+                finish(name)
+            submit_ready()
+
+def load_yaml_documents(yaml_file_path, seen=None):
+    """
+    Loads a YAML file and, first, every file named by its optional top-level
+    'include' key. Included paths are relative to the including file, and a file
+    that has already been loaded is not loaded again.
+    :param yaml_file_path: Path to the YAML configuration file.
+    :param seen: Set of already loaded absolute paths.
+    :return: List of (path, parsed YAML dictionary) tuples in execution order.
+    """
+    seen = set() if seen is None else seen
+    real_path = os.path.realpath(yaml_file_path)
+    if real_path in seen:
+        logger.debug(f"Skipping already loaded YAML file: {yaml_file_path}")
+        return []
+    seen.add(real_path)
+
+    import yaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)  # libyaml when available
+    with open(yaml_file_path, "r") as file:
+        try:
+            yaml_content = yaml.load(file, Loader=loader) or {}
+        except yaml.YAMLError as e:
+            raise ValueError(f"Error parsing YAML file {yaml_file_path}: {e}")
+
+    documents = []
+    includes = yaml_content.pop("include", [])
+    if isinstance(includes, str):
+        includes = [includes]
+    for include in includes:
+        include_path = os.path.join(os.path.dirname(yaml_file_path), os.path.expanduser(include))
+        documents.extend(load_yaml_documents(include_path, seen))
+    documents.append((yaml_file_path, yaml_content))
+    return documents
+
+def task_body(task_config):
+    """
+    Returns a task configuration without its scheduling keys, for comparing tasks.
+    """
+    if not isinstance(task_config, dict):
+        return task_config
+    return {key: value for key, value in task_config.items() if key not in ("after", "needs")}
+
+def merge_package_tasks(existing, task_config):
+    """
+    Merges the package list of task_config into existing when both tasks only
+    differ in their packages and use the same install command.
+    :return: True if the tasks were merged.
+    """
+    if not isinstance(existing, dict) or not isinstance(task_config, dict):
+        return False
+    existing_body = task_body(existing)
+    new_body = task_body(task_config)
+    existing_packages = existing_body.pop("packages", None)
+    new_packages = new_body.pop("packages", None)
+    if existing_body != new_body or not isinstance(existing_packages, dict) or not isinstance(new_packages, dict):
+        return False
+    if existing_packages.get("command") != new_packages.get("command"):
+        return False
+
+    merged = list(existing_packages.get("package", []) or [])
+    for package in new_packages.get("package", []) or []:
+        if package not in merged:
+            merged.append(package)
+    existing["packages"] = dict(existing_packages, package=merged)
+    return True
+
+def merge_yaml_documents(documents):
+    """
+    Merges several parsed YAML files into a single plan.
+    - Identical tasks (ignoring 'after'/'needs') run only once, whatever their name.
+    - Same-named tasks that only differ in their package list are merged into one
+      task with a deduplicated package list.
+    - Other same-named tasks are kept, renamed to 'name (file)'.
+    Dependencies on dropped or renamed tasks are rewritten to the task that runs.
+    :param documents: List of (path, parsed YAML dictionary) tuples.
+    :return: Merged YAML dictionary.
+    """
+    plan = {}
+    service_paths = {}
+    for yaml_file_path, yaml_content in documents:
+        aliases = {}
+        pending = []
+        for task_name, task_config in yaml_content.items():
+            if task_name == "service_paths":
+                for key, value in (task_config or {}).items():
+                    service_paths.setdefault(key, value)
+                continue
+
+            duplicate = next((name for name, config in plan.items() if task_body(config) == task_body(task_config)), None)
+            if duplicate is not None:
+                logger.info(f"Task {task_name} in {yaml_file_path} is identical to {duplicate}. Running it once.")
+                aliases[task_name] = duplicate
+                pending.append((duplicate, task_config))
+                continue
+
+            if task_name in plan:
+                if merge_package_tasks(plan[task_name], task_config):
+                    logger.info(f"Merged packages of task {task_name} from {yaml_file_path}")
+                    pending.append((task_name, task_config))
+                    continue
+                unique_name = f"{task_name} ({os.path.basename(yaml_file_path)})"
+                logger.info(f"Task {task_name} in {yaml_file_path} differs from an earlier task. Running it as {unique_name}.")
+                aliases[task_name] = unique_name
+                task_name = unique_name
+
+            plan[task_name] = dict(task_config) if isinstance(task_config, dict) else task_config
+            pending.append((task_name, task_config))
+
+        # Carry the dependencies over, resolved against this file's task names
+        for task_name, task_config in pending:
+            dependencies = [aliases.get(name, name) for name in task_dependencies(task_name, task_config)]
+            if not isinstance(plan[task_name], dict):
+                continue
+            existing = [aliases.get(name, name) for name in task_dependencies(task_name, plan[task_name])]
+            plan[task_name].pop("needs", None)
+            combined = [name for name in dict.fromkeys(existing + dependencies) if name != task_name]
+            if combined:
+                plan[task_name]["after"] = combined
+            else:
+                plan[task_name].pop("after", None)
+
+    if service_paths:
+        plan = {"service_paths": service_paths, **plan}
+    return plan
+
+PLAN_CACHE_DIR = os.path.expanduser("~/.cache/artix-setup/plans")
+PLAN_CACHE_VERSION = 1
+
+def plan_cache_path(yaml_file_paths):
+    """
+    Returns the cache file for a list of root YAML files.
+    """
+    key = content_hash("\0".join(os.path.realpath(path) for path in yaml_file_paths))
+    return os.path.join(PLAN_CACHE_DIR, f"{key}.json")
+
+def file_fingerprint(path):
+    """
+    Returns the path, mtime, size and SHA-256 of a file.
+    """
+    stat = os.stat(path)
+    with open(path, "rb") as file:
+        digest = content_hash(file.read())
+    return {"path": os.path.realpath(path), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": digest}
 
-    # Parse and execute the provided YAML file
-    yaml_file_path = args.yaml_file
+def fingerprint_matches(fingerprint):
+    """
+    Returns True if a file still matches its fingerprint. The content is only
+    hashed when the mtime or size changed.
+    """
+    try:
+        stat = os.stat(fingerprint["path"])
+    except OSError:
+        return False
+    if stat.st_mtime_ns == fingerprint["mtime_ns"] and stat.st_size == fingerprint["size"]:
+        return True
+    return file_fingerprint(fingerprint["path"])["sha256"] == fingerprint["sha256"]
 
+def read_plan_cache(cache_path):
+    """
+    Returns the cached plan if every file it was built from is unchanged, else None.
+    """
     try:
-        with open(yaml_file_path, "r") as file:
-            yaml_content = yaml.safe_load(file)
-        parse_and_execute(yaml_content)
-    except FileNotFoundError:
-        logger.error(f"YAML file not found: {yaml_file_path}")
+        with open(cache_path, "r") as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    if cached.get("version") != PLAN_CACHE_VERSION:
+        return None
+    if not all(fingerprint_matches(fingerprint) for fingerprint in cached["files"]):
+        return None
+    return cached["plan"]
+
+def write_plan_cache(cache_path, file_paths, plan):
+    """
+    Stores a validated plan with the fingerprints of the files it was built from.
+    """
+    try:
+        entry = {
+            "version": PLAN_CACHE_VERSION,
+            "files": [file_fingerprint(path) for path in file_paths],
+            "plan": plan,
+        }
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, "w") as cache_file:
+            json.dump(entry, cache_file)
+        os.replace(temp_path, cache_path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug(f"Not caching plan: {e}")
+
+def load_plan(yaml_file_paths, use_cache=True):
+    """
+    Loads one or more YAML files (and their includes) into a single merged and
+    validated plan. The plan is cached, keyed by the files' paths, mtimes and
+    content hashes, so unchanged files are not parsed again.
+    :param yaml_file_paths: List of paths to YAML configuration files.
+    :param use_cache: Whether to read and write the plan cache.
+    :return: Merged YAML dictionary.
+    :raises ValueError: If a file can't be parsed or the task dependencies are invalid.
+    """
+    cache_path = plan_cache_path(yaml_file_paths)
+    if use_cache:
+        plan = read_plan_cache(cache_path)
+        if plan is not None:
+            logger.debug(f"Using cached plan {cache_path}")
+            return plan
+
+    documents = []
+    seen = set()
+    for yaml_file_path in yaml_file_paths:
+        documents.extend(load_yaml_documents(yaml_file_path, seen))
+    plan = merge_yaml_documents(documents)
+    build_task_graph(plan)  # Validate dependencies before caching
+
+    if use_cache:
+        write_plan_cache(cache_path, [path for path, _ in documents], plan)
+    return plan
+
+def parse_and_execute(yaml_content, debug=False, batch=False, jobs=1):
+    """
+    Parses the YAML content and executes tasks based on its structure with detailed debugging.
+    Tasks may list other tasks under 'after' or 'needs'; independent tasks run
+    concurrently when jobs > 1, while package installs still take the pacman lock
+    one at a time.
+    :param yaml_content: Parsed YAML dictionary.
+    :param debug: Unused, kept for compatibility.
+    :param batch: Default for installing each package list in a single transaction.
+                  A 'batch' key under a task's 'packages' overrides it.
+    :param jobs: Number of tasks to run concurrently.
+    """
+    logger.debug(f"Starting parse_and_execute with yaml_content: {yaml_content}")
+    if "service_paths" in yaml_content:
+        logger.debug(f"Skipping 'service_paths' configuration.")
+
+    order, graph = build_task_graph(yaml_content)
+    run_task_graph(
+        order,
+        graph,
+        lambda task_name: execute_task(task_name, yaml_content[task_name], yaml_content, batch=batch),
+        jobs=jobs
+    )
+
+def topological_order(order, graph):
+    """
+    Orders tasks so each comes after the tasks it depends on, otherwise keeping YAML order.
+    """
+    done = []
+    remaining = list(order)
+    while remaining:
+        name = next(name for name in remaining if graph[name] <= set(done))
+        remaining.remove(name)
+        done.append(name)
+    return done
+
+def shell_path(path):
+    """
+    Quotes a path for the compiled script. A leading '~' refers to the home of the
+    user running the script, even inside the root section.
+    """
+    path = path.replace("\\", "\\\\").replace('"', '\\"').replace("$", "\\$").replace("`", "\\`")
+    if path == "~" or path.startswith("~/"):
+        path = "${USER_HOME}" + path[1:]
+    return f'"{path}"'
+
+def heredoc(content, target):
+    """
+    Returns shell lines writing content to target exactly, using a heredoc whose
+    delimiter doesn't appear in the content.
+    """
+    if not content.endswith("\n"):
+        return [f"printf '%s' {shlex.quote(content)} > {target}"]
+    delimiter = "ARTIX_EOF"
+    while delimiter in content:
+        delimiter += "_"
+    return [f"cat > {target} <<'{delimiter}'", content[:-1], delimiter]
+
+def compile_file(path, content, mode=None, backup=False):
+    """
+    Returns root shell lines that write a file only if its content changed.
+    """
+    target = shell_path(path)
+    staged = target[:-1] + '.artix-new"'
+    lines = [f"mkdir -p \"$(dirname {target})\""]
+    lines += heredoc(content, staged)
+    replace = [f"mv {staged} {target}"]
+    if backup:
+        replace.insert(0, f"[ -e {target} ] && cp {target} {target[:-1]}.$(date +%Y%m%d%H%M%S)\"")
+    lines.append(f"if cmp -s {staged} {target}; then rm -f {staged}; else {'; '.join(replace)}; fi")
+    if mode:
+        lines.append(f"chmod {mode} {target}")
+    return lines
+
+def compile_task(task_name, task_config, yaml_content):
+    """
+    Lowers one task to a list of (privileged, lines) sections.
+    """
+    sections = []
+    if not isinstance(task_config, dict):
+        return sections
+
+    def install(packages_config):
+        packages = packages_config.get("package", []) or []
+        if packages:
+            command = packages_config.get("command", "sudo pacman -S {package} --needed --noconfirm")
+            sections.append((False, [command.format(package=" ".join(packages))]))
+
+    if "packages" in task_config:
+        install(task_config["packages"])
+
+    # Probing needs the runner, so the script gets the last cached ranking, if any
+    mirrors_config = task_config.get("mirrors")
+    if isinstance(mirrors_config, dict):
+        cache = load_mirror_cache()
+        for list_config in mirrors_config.get("lists", []) or []:
+            name = list_config.get("name", list_config["output"])
+            ranking = cache.get(mirror_cache_key(list_config))
+            if ranking:
+                content = mirrorlist_content(name, ranking, list_config.get("keep", MIRROR_KEEP))
+                sections.append((True, compile_file(list_config["output"], content)))
+            else:
+                sections.append((False, [f"echo {shlex.quote(f'No cached {name} mirror ranking; run the setup script once to rank mirrors')} >&2"]))
+
+    paths = yaml_content.get("service_paths", {})
+    if "zram" in task_config:
+        sections.append((True, operations_script(zram_operations(task_config["zram"] or {}, paths))))
+
+    services = task_services(task_name, task_config)
+    for _, service_config in services:
+        if "packages" in service_config:
+            install(service_config["packages"])
+    lines = []
+    for service_name, service_config in services:
+        lines += operations_script(service_backend(paths, service_config).operations(service_name, service_config))
+    if lines:
+        sections.append((True, lines))
+
+    for command in task_config.get("shell", []) or []:
+        sections.append((False, [command]))
+
+    python_config = task_config.get("python")
+    if isinstance(python_config, dict):
+        script = python_config.get("script", "")
+        sections.append((False, [f"python3 {script} {' '.join(python_config.get('parameters', []))}".rstrip()]))
+
+    file_configs = [task_config["file"]] if "file" in task_config else []
+    file_configs += task_config.get("files", []) or []
+    for file_config in file_configs:
+        if isinstance(file_config, dict) and "name" in file_config and "content" in file_config:
+            sections.append((True, compile_file(file_config["name"], file_config["content"], backup=True)))
+    return sections
+
+def compile_plan(yaml_content):
+    """
+    Compiles a plan into a self-contained shell script. Package lists become one
+    install command each, files become heredocs, and privileged work is grouped into
+    'sudo sh' sections after a single up-front sudo authentication.
+    :param yaml_content: Parsed (merged) YAML dictionary.
+    :return: Script text.
+    """
+    order, graph = build_task_graph(yaml_content)
+    lines = [
+        "#!/bin/bash",
+        f"# Generated by {os.path.basename(__file__)} on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+        "",
+        "# Authenticate once and keep the sudo timestamp fresh for the whole run",
+        "sudo -v || exit 1",
+        "while true; do sudo -n true; sleep 50; kill -0 \"$$\" 2>/dev/null || exit; done &",
+        "SUDO_KEEPALIVE=$!",
+        "trap 'kill $SUDO_KEEPALIVE 2>/dev/null' EXIT",
+        "USER_HOME=\"$HOME\"",
+        "",
+    ]
+    for task_name in topological_order(order, graph):
+        lines.append(f"# --- {task_name} ---")
+        lines.append(f"echo '==> {task_name}'")
+        sections = compile_task(task_name, yaml_content[task_name], yaml_content)
+        # Merge consecutive privileged sections into one sudo invocation
+        merged = []
+        for privileged, section_lines in sections:
+            if merged and privileged and merged[-1][0]:
+                merged[-1][1].extend(section_lines)
+            else:
+                merged.append((privileged, list(section_lines)))
+        for privileged, section_lines in merged:
+            if privileged:
+                delimiter = "ARTIX_ROOT"
+                while any(delimiter in line for line in section_lines):
+                    delimiter += "_"
+                lines.append(f"sudo USER_HOME=\"$USER_HOME\" sh -s <<'{delimiter}'")
+                lines.extend(section_lines)
+                lines.append(delimiter)
+            else:
+                lines.extend(section_lines)
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line.
+    :param argv: Arguments, defaulting to sys.argv[1:].
+    """
+    parser = argparse.ArgumentParser(
+        description="Artix setup script. This script requires one or more YAML configuration files to execute the specified tasks.",
+        epilog="Use the --debug flag to enable verbose logging for debugging purposes."
+    )
+    parser.add_argument("yaml_files", nargs="*", metavar="yaml_file", help="Path(s) to the YAML configuration file(s), merged into one plan")
+    parser.add_argument("--debug", action="store_true", help="Enable verbose logging")
+    parser.add_argument("--batch", action="store_true", help="Install each task's package list in a single transaction")
+    parser.add_argument("--no-package-index", action="store_true", help="Do not skip packages that are already installed")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of independent tasks to run concurrently (default: 1)")
+    parser.add_argument("--prefetch", action="store_true", help="Download all packages into the pacman cache in the background while tasks run")
+    parser.add_argument("--parallel-downloads", type=int, default=5, help="Parallel downloads used by --prefetch (default: 5)")
+    parser.add_argument("--no-privileged-worker", action="store_true", help="Run every privileged operation through its own sudo command")
+    parser.add_argument("--resume", action="store_true", help="Skip steps recorded as completed in the journal of an earlier run")
+    parser.add_argument("--journal", help="Path of the step journal (default: ~/.cache/artix-setup/journal.jsonl)")
+    parser.add_argument("--compile", metavar="SCRIPT", help="Write the plan as a standalone shell script instead of executing it")
+    parser.add_argument("--trace-jsonl", metavar="PATH", help="Write the timing of every task and command as JSON lines")
+    parser.add_argument("--trace-chrome", metavar="PATH", help="Write the timing of every task and command as a Chrome/Perfetto trace")
+    parser.add_argument("--slowest", type=int, default=10, metavar="N", help="Number of slowest steps to list at the end of the run (default: 10)")
+    parser.add_argument("--no-plan-cache", action="store_true", help="Always parse the YAML files instead of using the cached plan")
+    parser.add_argument("--fleet-repo", metavar="URL_OR_DIR", help="Install packages from a fleet repository written by --export-repo before using the mirrors and AUR")
+    parser.add_argument("--export-repo", metavar="DIR", help="After the run, export the installed packages into a repository in DIR")
+    parser.add_argument("--serve-repo", metavar="DIR", help="Serve a fleet repository over HTTP (after the run, if YAML files are given)")
+    parser.add_argument("--serve-port", type=int, default=8080, help="Port used by --serve-repo (default: 8080)")
+    parser.add_argument("--aur-cache-size", type=float, default=10, metavar="GIB", help="Size limit of the cache of built AUR packages, 0 to disable (default: 10)")
+    parser.add_argument("--privileged-worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--wait-ready", metavar="SPECS", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    global aur_cache_max_bytes
+    args = parse_arguments(argv)
+
+    # Configure logging
+    logging_level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(level=logging_level)
+
+    if args.privileged_worker:
+        serve_privileged_requests()
+        sys.exit(0)
+
+    if args.wait_ready:
+        result = wait_for_services(json.loads(args.wait_ready))
+        print(json.dumps(result))
+        sys.exit(1 if result["failed"] else 0)
+
+    # Ensure a YAML file is provided
+    if not args.yaml_files:
+        if not args.export_repo and not args.serve_repo:
+            logger.error("No YAML file provided. Use --help for usage information.")
+            sys.exit(1)
+        if args.export_repo and not export_fleet_repo(args.export_repo):
+            sys.exit(1)
+        if args.serve_repo:
+            serve_fleet_repo(args.serve_repo, args.serve_port)
+        sys.exit(0)
+
+    # Parse, merge and execute the provided YAML files
+    try:
+        yaml_content = load_plan(args.yaml_files, use_cache=not args.no_plan_cache)
+        if args.compile:
+            with open(args.compile, "w") as script_file:
+                script_file.write(compile_plan(yaml_content))
+            os.chmod(args.compile, 0o755)
+            logger.info(f"Shell script '{args.compile}' has been created.")
+            sys.exit(0)
+        if not args.no_package_index:
+            load_installed_packages()
+        aur_cache_max_bytes = int(args.aur_cache_size * 1024 ** 3)
+        if args.fleet_repo:
+            load_fleet_index(args.fleet_repo)
+        if not args.no_privileged_worker:
+            start_privileged_worker()
+        # After the worker, so the prefetch thread never races it for a sudo prompt
+        if args.prefetch:
+            start_prefetch(yaml_content, args.parallel_downloads)
+        open_journal(args.journal or JOURNAL_PATH, resume=args.resume)
+        parse_and_execute(yaml_content, batch=args.batch, jobs=args.jobs)
+        close_journal()
+        if privileged_worker:
+            privileged_worker.stop()
+        save_command_history()
+        logger.info(f"Files written: {file_write_stats['written']}, unchanged: {file_write_stats['unchanged']}")
+        if args.trace_jsonl:
+            export_trace_jsonl(args.trace_jsonl)
+        if args.trace_chrome:
+            export_chrome_trace(args.trace_chrome)
+        log_slowest_steps(args.slowest)
+        if args.export_repo:
+            export_fleet_repo(args.export_repo)
+        if args.serve_repo:
+            serve_fleet_repo(args.serve_repo, args.serve_port)
+    except FileNotFoundError as e:
+        logger.error(f"YAML file not found: {e.filename}")
         sys.exit(1)
-    except yaml.YAMLError as e:
-        logger.error(f"Error parsing YAML file: {e}")
+    except ValueError as e:
+        logger.error(f"Invalid configuration: {e}")
         sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import functools
+import http.server
+import importlib.util
+import os
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_script(filename):
+    """
+    Imports one of the numbered scripts as a module, like 998-benchmark.py does.
+    """
+    name = filename.replace("-", "_").replace(".py", "")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+    """
+    A fresh 999-artix-setup.py with its caches and journal under tmp_path.
+    """
+    module = load_script("999-artix-setup.py")
+    monkeypatch.setattr(module, "COMMAND_HISTORY_PATH", str(tmp_path / "command-durations.json"))
+    monkeypatch.setattr(module, "MIRROR_CACHE_PATH", str(tmp_path / "mirrors.json"))
+    monkeypatch.setattr(module, "aur_cache_max_bytes", 0)
+    return module
+
+@pytest.fixture
+def partitions(tmp_path, monkeypatch):
+    """
+    A fresh 002-setup-partitions.py with a fixed cipher choice, so nothing runs cryptsetup.
+    """
+    module = load_script("002-setup-partitions.py")
+    monkeypatch.setattr(module, "cipher_choice", dict(module.DEFAULT_CIPHER))
+    monkeypatch.setattr(module, "CIPHER_BENCHMARK_CACHE", str(tmp_path / "cryptsetup-benchmark.json"))
+    return module
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def http_root(tmp_path):
+    """
+    Serves a directory over HTTP on 127.0.0.1. Yields (directory, base URL).
+    """
+    root = tmp_path / "www"
+    root.mkdir()
+    handler = functools.partial(QuietHandler, directory=str(root))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield root, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,37 @@
+import time
+
+def test_pipeline_times_out_within_bounds(setup):
+    start = time.monotonic()
+    result = setup.run_command("sleep 6 | cat", timeout=1)
+    assert result["timed_out"]
+    assert result["returncode"] is None
+    assert time.monotonic() - start < 3
+
+def test_background_grandchild_is_killed(setup, tmp_path):
+    marker = tmp_path / "marker"
+    result = setup.run_command(f"(sleep 2; touch {marker}) & sleep 6", timeout=1)
+    assert result["timed_out"]
+    time.sleep(2.5)
+    assert not marker.exists()
+
+def test_completed_command(setup):
+    result = setup.run_command("echo out; echo err >&2; exit 3", timeout=5)
+    assert result["returncode"] == 3
+    assert not result["timed_out"]
+    assert "err" in result["stderr"]
+
+def test_only_transient_failures_are_retried(setup, monkeypatch):
+    ran = []
+
+    def fake_run_command(command, timeout=None, env=None, stdin=None):
+        ran.append(command)
+        stderr = "error: failed retrieving file" if command == "fetch" else "==> ERROR: A failure occurred in build()."
+        return {"returncode": 1, "timed_out": False, "stderr": stderr, "duration": 0.0, "output_bytes": 0}
+
+    monkeypatch.setattr(setup, "run_command", fake_run_command)
+    monkeypatch.setattr(setup, "retry_delay", lambda attempt, delay: 0)
+    outcome = {}
+    assert not setup.execute_shell(["makepkg"], retries=3, prompt=False, outcome=outcome)
+    assert ran == ["makepkg"] and outcome["failure"] == "unknown"
+    assert not setup.execute_shell(["fetch"], retries=3, prompt=False, outcome=outcome)
+    assert ran[1:] == ["fetch"] * 3 and outcome["failure"] == "transient"
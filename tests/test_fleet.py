@@ -0,0 +1,85 @@
+import os
+import sys
+import tarfile
+
+import pytest
+
+FAKE_REPO_ADD = f"""#!{sys.executable}
+# repo-add stand-in: one NAME/FILENAME desc per package, in a gzip'd tar
+import os, sys, tarfile, io
+args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+database, packages = args[0], args[1:]
+with tarfile.open(database, "w:gz") as db:
+    for path in packages:
+        filename = os.path.basename(path)
+        stem = filename.split(".pkg.tar")[0]
+        name = stem.rsplit("-", 3)[0]
+        desc = f"%FILENAME%\\n{{filename}}\\n\\n%NAME%\\n{{name}}\\n".encode()
+        info = tarfile.TarInfo(f"{{stem}}/desc")
+        info.size = len(desc)
+        db.addfile(info, io.BytesIO(desc))
+os.symlink(os.path.basename(database), database.replace(".db.tar.gz", ".db"))
+"""
+
+PACKAGE = "foo-1.0-1-x86_64.pkg.tar.zst"
+
+@pytest.fixture
+def fleet(setup, tmp_path, monkeypatch):
+    """
+    A machine with 'foo' installed and its package in the pacman cache, and a
+    repo-add on PATH. Returns the cache directory.
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "repo-add").write_text(FAKE_REPO_ADD)
+    os.chmod(bin_dir / "repo-add", 0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+
+    local = tmp_path / "local" / "foo-1.0-1"
+    local.mkdir(parents=True)
+    (local / "desc").write_text("%NAME%\nfoo\n\n%VERSION%\n1.0-1\n\n%ARCH%\nx86_64\n")
+    stems = setup.installed_package_stems
+    monkeypatch.setattr(setup, "installed_package_stems", lambda: stems(str(tmp_path / "local")))
+
+    cache = tmp_path / "cache"
+    cache.mkdir()
+    (cache / PACKAGE).write_bytes(b"foo package")
+    (cache / "bar-2.0-1-x86_64.pkg.tar.zst").write_bytes(b"not installed")
+    monkeypatch.setattr(setup, "PACMAN_CACHE_DIR", str(cache))
+    monkeypatch.setattr(setup, "AUR_BUILD_DIRS", [])
+    monkeypatch.setattr(setup, "AUR_CACHE_DIR", str(tmp_path / "aur"))
+    return cache
+
+def test_export_adds_installed_packages_only(setup, fleet, tmp_path):
+    repo = tmp_path / "repo"
+    assert setup.export_fleet_repo(str(repo))
+    assert sorted(os.listdir(repo)) == ["artix-fleet.db", "artix-fleet.db.tar.gz", PACKAGE]
+    with tarfile.open(repo / "artix-fleet.db.tar.gz") as database:
+        assert database.getnames() == ["foo-1.0-1-x86_64/desc"]
+
+def test_install_from_fleet_over_http(setup, fleet, http_root, tmp_path, monkeypatch):
+    root, base = http_root
+    assert setup.export_fleet_repo(str(root))
+    setup.load_fleet_index(base)
+    assert setup.fleet_packages == {"foo": PACKAGE}
+
+    # A second machine with an empty cache, where foo is an AUR package
+    target_cache = tmp_path / "target-cache"
+    target_cache.mkdir()
+    monkeypatch.setattr(setup, "PACMAN_CACHE_DIR", str(target_cache))
+    monkeypatch.setattr(setup, "sync_package_names", lambda: set())
+    ran, installed = [], []
+    monkeypatch.setattr(setup, "run_command", lambda command, timeout=None, env=None, stdin=None: ran.append(command) or
+                        {"returncode": 0, "timed_out": False, "stderr": "", "duration": 0.0, "output_bytes": 0})
+    monkeypatch.setattr(setup, "mark_installed", installed.extend)
+
+    assert setup.install_from_fleet(["foo", "baz"]) == ["baz"]
+    assert (target_cache / PACKAGE).read_bytes() == b"foo package"
+    assert len(ran) == 1 and ran[0].endswith(f"pacman -U --needed --noconfirm {target_cache / PACKAGE}")
+    assert installed == ["foo"]
+
+def test_unreachable_fleet_repo_is_ignored(setup, http_root):
+    _, base = http_root
+    setup.load_fleet_index(base)
+    assert setup.fleet_packages == {}
+    assert setup.install_from_fleet(["foo"]) == ["foo"]
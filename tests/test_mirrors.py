@@ -0,0 +1,46 @@
+import platform
+
+def test_rank_mirrors_writes_responding_mirrors(setup, http_root, tmp_path):
+    root, base = http_root
+    sample = root / "good" / "core" / "os" / platform.machine() / "core.db"
+    sample.parent.mkdir(parents=True)
+    sample.write_bytes(b"x" * 65536)
+    mirrorlist = tmp_path / "mirrorlist.source"
+    mirrorlist.write_text(
+        f"Server = {base}/missing/$repo/os/$arch\n"
+        f"#Server = {base}/good/$repo/os/$arch\n"
+        "Server = http://127.0.0.1:1/$repo/os/$arch\n"
+    )
+    output = tmp_path / "mirrorlist"
+    config = {"timeout": 2, "lists": [{"name": "test", "source": str(mirrorlist), "output": str(output), "repo": "core"}]}
+
+    assert setup.rank_mirrors(config)
+    servers = [line.split(" = ", 1)[1] for line in output.read_text().splitlines() if line.startswith("Server = ")]
+    assert servers == [f"{base}/good/$repo/os/$arch"]
+    assert "# 1 of 3 mirror(s) responded, best 1 kept" in output.read_text()
+
+def test_rank_mirrors_reuses_the_cached_ranking(setup, http_root, tmp_path, monkeypatch):
+    root, base = http_root
+    sample = root / "core" / "os" / platform.machine() / "core.db"
+    sample.parent.mkdir(parents=True)
+    sample.write_bytes(b"x" * 4096)
+    mirrorlist = tmp_path / "mirrorlist.source"
+    mirrorlist.write_text(f"Server = {base}/$repo/os/$arch\n")
+    list_config = {"source": str(mirrorlist), "output": str(tmp_path / "mirrorlist"), "repo": "core"}
+
+    first = setup.rank_mirror_list(list_config, {"timeout": 2})
+    assert [mirror["server"] for mirror in first["mirrors"]] == [f"{base}/$repo/os/$arch"]
+
+    def no_probing(*args):
+        raise AssertionError("probed a cached list")
+
+    monkeypatch.setattr(setup, "probe_mirrors", no_probing)
+    assert setup.rank_mirror_list(list_config, {"timeout": 2}) == first
+
+def test_rank_mirrors_fails_when_nothing_responds(setup, tmp_path):
+    mirrorlist = tmp_path / "mirrorlist.source"
+    mirrorlist.write_text("Server = http://127.0.0.1:1/$repo/os/$arch\n")
+    output = tmp_path / "mirrorlist"
+    config = {"timeout": 1, "lists": [{"source": str(mirrorlist), "output": str(output)}]}
+    assert not setup.rank_mirrors(config)
+    assert not output.exists()
@@ -0,0 +1,82 @@
+import pytest
+
+
+@pytest.fixture
+def commands(setup, monkeypatch):
+    """
+    Records the commands execute_shell runs and answers them from a queue of
+    (returncode, stderr) results; an empty queue means success.
+    """
+    ran = []
+    results = []
+
+    def fake_run_command(command, timeout=None, env=None, stdin=None):
+        ran.append(command)
+        returncode, stderr = results.pop(0) if results else (0, "")
+        return {"returncode": returncode, "timed_out": False, "stderr": stderr, "duration": 0.0, "output_bytes": 0}
+
+    monkeypatch.setattr(setup, "run_command", fake_run_command)
+    monkeypatch.setattr(setup, "retry_delay", lambda attempt, delay: 0)
+    monkeypatch.setattr(setup, "privileged_available", lambda: False)
+    monkeypatch.setattr(setup, "mark_installed", lambda packages: None)
+    return ran, results
+
+def test_transient_batch_failure_retries_whole_batch(setup, commands):
+    ran, results = commands
+    results.append((1, "error: failed retrieving file 'a.pkg.tar.zst': Could not resolve host"))
+    assert setup.install_package_batch(["a", "b", "c", "d"], "pacman -S {package}")
+    assert ran == ["pacman -S a b c d", "pacman -S a b c d"]
+
+def test_transient_batch_failure_does_not_bisect(setup, commands):
+    ran, results = commands
+    results.extend([(1, "error: failed retrieving file")] * 3)
+    assert not setup.install_package_batch(["a", "b", "c", "d"], "pacman -S {package}")
+    assert ran == ["pacman -S a b c d"] * 3
+
+def test_permanent_batch_failure_bisects(setup, commands):
+    ran, results = commands
+    results.append((1, "error: target not found: d"))
+    assert setup.install_package_batch(["a", "b", "c", "d"], "pacman -S {package}")
+    assert ran == ["pacman -S a b c d", "pacman -S a b", "pacman -S c d"]
+
+def test_unknown_batch_failure_bisects(setup, commands, monkeypatch):
+    ran, results = commands
+    monkeypatch.setattr("builtins.input", lambda prompt: "yes")  # A single package still asks
+    results.extend([(1, "==> ERROR: A failure occurred in build()."), (0, ""), (1, "==> ERROR: A failure occurred in build()."),
+                    (0, ""), (1, "==> ERROR: A failure occurred in build().")])
+    assert not setup.install_package_batch(["a", "b", "c", "d"], "yay -S {package}")
+    assert ran == ["yay -S a b c d", "yay -S a b", "yay -S c d", "yay -S c", "yay -S d"]
+
+def test_network_lookups_run_without_the_pacman_lock(setup, commands, monkeypatch):
+    import threading
+    free = []
+
+    def lock_is_free():
+        result = []
+
+        def try_lock():
+            result.append(setup.pacman_lock.acquire(blocking=False))
+            if result[0]:
+                setup.pacman_lock.release()
+
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def fake_fetch(packages):
+        free.append(("fleet", lock_is_free()))
+        return {}
+
+    def fake_lookup(packages):
+        free.append(("aur", lock_is_free()))
+        return {}, {"b": "key"}
+
+    monkeypatch.setattr(setup, "fetch_from_fleet", fake_fetch)
+    monkeypatch.setattr(setup, "lookup_aur_cache", fake_lookup)
+    monkeypatch.setattr(setup, "aur_cache_max_bytes", 1)
+    stored = []
+    monkeypatch.setattr(setup, "store_aur_artifacts", stored.append)
+    assert setup.install_packages(["a", "b"], "yay -S {package}", batch=True)
+    assert free == [("fleet", True), ("aur", True)]
+    assert stored == [{"b": "key"}]
@@ -0,0 +1,215 @@
+import json
+
+import pytest
+
+
+def test_empty_disk_fallback_keeps_sector_sizes(partitions, monkeypatch):
+    def no_table(disk_path):
+        raise ValueError("unrecognised disk label")
+
+    monkeypatch.setattr(partitions, "get_parted_json", no_table)
+    inventory = {"nvme0n1": {"size": 512110190592, "log-sec": 512, "phy-sec": 4096, "rota": 0}}
+    disk = partitions.merge_parted_and_lsblk(["/dev/nvme0n1"], inventory)[0]["disk"]
+    assert disk["size"] == "512110190592B"
+    assert disk["logical-sector-size"] == 512
+    assert disk["physical-sector-size"] == 4096
+    assert disk["partitions"] == []
+
+DISK_SIZE = 1024**4
+
+def empty_disk(path="/dev/sda", label="gpt"):
+    return {"disk": {"path": path, "size": f"{DISK_SIZE}B", "label": label, "logical-sector-size": 512,
+                     "physical-sector-size": 512, "rotational": False, "partitions": []}}
+
+def plan_disk(partitions, tmp_path, monkeypatch, desired, swap_policy="zram+disk"):
+    monkeypatch.setattr(partitions, "read_mem_total", lambda meminfo_path="/proc/meminfo": 8 * 1024**3)
+    devices = [{"device": "/dev/sda", "use_device": True, "partition_location": "system", "device_type": "ssd"}]
+    return partitions.assign_partitions(
+        devices, [empty_disk()], mount_point_prefix="/mnt", desired_partitions=desired,
+        script_path=str(tmp_path / "partition_script.sh"), fstab_path=str(tmp_path / "fstab"),
+        crypttab_path=str(tmp_path / "crypttab"), swap_policy=swap_policy,
+    )
+
+SWAP = {"swap": {"size": "auto", "type": "linuxswap", "encrypt": True, "file_system_type": "mkswap",
+                 "partition_location": "system"}}
+
+def test_swap_uses_random_key_by_default(partitions, tmp_path, monkeypatch):
+    plan = plan_disk(partitions, tmp_path, monkeypatch, SWAP)
+    assert plan["crypttab"][0]["key"] == "/dev/urandom"
+    assert plan["fstab"][0]["source"] == "/dev/mapper/swap"
+    assert "resume" not in plan
+
+def test_hibernate_swap_is_luks_with_resume_hint(partitions, tmp_path, monkeypatch):
+    plan = plan_disk(partitions, tmp_path, monkeypatch, SWAP, swap_policy="hibernate")
+    commands = [step["command"] for step in plan["disks"][0]["steps"]]
+    assert not any("/dev/urandom" in command for command in commands)
+    assert any(command.startswith("cryptsetup luksFormat ") for command in commands)
+    crypttab = plan["crypttab"][0]
+    assert crypttab["options"].startswith("luks") and crypttab["source"].startswith("UUID=")
+    swap_source = plan["fstab"][0]["source"]
+    assert swap_source.startswith("UUID=")
+    assert plan["resume"] == f"resume={swap_source}"
+
+OPT = {"opt": {"size": "16GiB", "type": "ext4", "format": False, "encrypt": True,
+               "file_system_type": "mkfs.ext4", "mount": "/opt", "partition_location": "system"}}
+
+def test_luks_without_key_file_encrypts_in_the_foreground(partitions, tmp_path, monkeypatch):
+    plan = plan_disk(partitions, tmp_path, monkeypatch, OPT)
+    assert plan["interactive"]
+    lines = (tmp_path / "partition_script.sh").read_text().splitlines()
+    wait = 'for pid in "${pids[@]}"; do wait "$pid"; done'
+    luks = [index for index, line in enumerate(lines) if line.startswith("cryptsetup ")]
+    waits = [index for index, line in enumerate(lines) if line == wait]
+    assert len(luks) == 2 and len(waits) == 2
+    assert waits[0] < luks[0] and luks[-1] < waits[1]
+    assert "disk_sda_format &" in lines
+
+def test_interactive_plan_runs_encryption_serially(partitions, tmp_path, monkeypatch):
+    plan = plan_disk(partitions, tmp_path, monkeypatch, OPT)
+    plan["fstab_path"] = None
+    calls = []
+
+    def fake_run(command, shell=True, capture_output=False, text=True):
+        calls.append((command, capture_output))
+        return partitions.subprocess.CompletedProcess(command, 0, "", "")
+
+    monkeypatch.setattr(partitions.subprocess, "run", fake_run)
+    monkeypatch.setattr(partitions, "root_command", lambda command: command)
+    success, results = partitions.execute_plan(plan)
+    assert success
+    kinds = [result["kind"] for result in results]
+    assert kinds == ["create", "settle", "encrypt", "encrypt", "format", "mount"]
+    assert [capture for command, capture in calls if command.startswith("cryptsetup ")] == [False, False]
+    assert all(capture for command, capture in calls if not command.startswith("cryptsetup "))
+
+def test_key_file_keeps_disks_fully_parallel(partitions, tmp_path, monkeypatch):
+    monkeypatch.setattr(partitions, "read_mem_total", lambda meminfo_path="/proc/meminfo": 8 * 1024**3)
+    devices = [{"device": "/dev/sda", "use_device": True, "partition_location": "system", "device_type": "ssd"}]
+    plan = partitions.assign_partitions(
+        devices, [empty_disk()], mount_point_prefix="/mnt", desired_partitions=OPT,
+        script_path=str(tmp_path / "partition_script.sh"), luks_key_file="/root/luks.key",
+        fstab_path=str(tmp_path / "fstab"), crypttab_path=str(tmp_path / "crypttab"),
+    )
+    assert not plan["interactive"]
+    assert "disk_sda &" in (tmp_path / "partition_script.sh").read_text().splitlines()
+
+MIB = 1024**2
+
+def sized_disk(size, label="unknown", sector=512, partitions=()):
+    return {"disk": {"path": "/dev/nvme0n1", "size": f"{size}B", "label": label, "logical-sector-size": sector,
+                     "partitions": list(partitions)}}
+
+def test_layout_partitions_exact_offsets(partitions):
+    wanted = [("efi", {"size": "512MiB", "type": "fat32"}), ("boot", {"size": "1GiB", "type": "ext4"}),
+              ("root", {"type": "ext4"}), ("home", {"type": "ext4"})]
+    placed = partitions.layout_partitions(sized_disk(10 * 1024 * MIB), wanted)
+    assert [(part["label"], part["number"], part["start"] // MIB, part["size"] // MIB) for part in placed] == [
+        ("efi", 1, 1, 512),
+        ("boot", 2, 513, 1024),
+        ("root", 3, 1537, 4351),
+        ("home", 4, 5888, 4351),
+    ]
+    # The last MiB stays free for the GPT backup header
+    assert placed[-1]["start"] + placed[-1]["size"] == 10 * 1024 * MIB - MIB
+
+def test_layout_partitions_fills_gaps_around_existing_ones(partitions):
+    existing = [{"number": 2, "start": f"{101 * MIB}B", "end": f"{201 * MIB - 1}B"}]
+    wanted = [("efi", {"size": "100MiB", "type": "fat32"}), ("data", {"size": "300MiB", "type": "ext4"})]
+    placed = partitions.layout_partitions(sized_disk(1024 * MIB, "gpt", partitions=existing), wanted)
+    assert [(part["label"], part["number"], part["start"] // MIB, part["size"] // MIB) for part in placed] == [
+        ("efi", 1, 1, 100),
+        ("data", 3, 201, 300),
+    ]
+
+def test_layout_partitions_rejects_what_does_not_fit(partitions):
+    with pytest.raises(SystemExit):
+        partitions.layout_partitions(sized_disk(1024 * MIB), [("root", {"size": "2GiB", "type": "ext4"})])
+
+def test_sfdisk_command_new_gpt_in_sectors(partitions):
+    disk = sized_disk(10 * 1024 * MIB, sector=4096)
+    placed = partitions.layout_partitions(disk, [("efi", {"size": "512MiB", "type": "fat32"}),
+                                                 ("swap", {"size": "1GiB", "type": "linuxswap"})])
+    for index, part in enumerate(placed):
+        part["partuuid"] = f"00000000-0000-0000-0000-00000000000{index}"
+    assert partitions.sfdisk_command(disk, placed) == (
+        "printf '%s\\n' 'label: gpt' "
+        "'/dev/nvme0n1p1 : start=256, size=131072, type=U, name=\"efi\", uuid=00000000-0000-0000-0000-000000000000' "
+        "'/dev/nvme0n1p2 : start=131328, size=262144, type=S, name=\"swap\", uuid=00000000-0000-0000-0000-000000000001' "
+        "| sfdisk /dev/nvme0n1"
+    )
+
+def test_sfdisk_command_appends_to_msdos_without_names(partitions):
+    disk = sized_disk(1024 * MIB, "msdos")
+    placed = partitions.layout_partitions(disk, [("root", {"size": "256MiB", "type": "ext4"})])
+    assert partitions.sfdisk_command(disk, placed) == (
+        "printf '%s\\n' '/dev/nvme0n1p1 : start=2048, size=524288, type=L' | sfdisk --append /dev/nvme0n1"
+    )
+
+def test_fstab_and_crypttab_lines(partitions, tmp_path, monkeypatch):
+    desired = {
+        "efi": {"size": "512MiB", "type": "fat32", "format": True, "file_system_type": "mkfs.fat -F32",
+                "mount": "/boot/efi", "partition_location": "system"},
+        "root": {"size": "32GiB", "type": "ext4", "format": True, "file_system_type": "mkfs.ext4",
+                 "mount": "/", "partition_location": "system"},
+        "data": {"size": "16GiB", "type": "btrfs", "format": True, "encrypt": True, "file_system_type": "mkfs.btrfs",
+                 "mount": "/data", "partition_location": "system"},
+    }
+    desired.update(SWAP)
+    uuids = iter(f"00000000-0000-0000-0000-{index:012d}" for index in range(100))
+    monkeypatch.setattr(partitions.uuid, "uuid4", lambda: next(uuids))
+    plan_disk(partitions, tmp_path, monkeypatch, desired)
+
+    fstab = (tmp_path / "fstab").read_text().splitlines()
+    assert fstab[2:] == [
+        "# Flash-backed: /boot/efi, /. Run fstrim periodically (e.g. 'fstrim -av' weekly).",
+        "UUID=00000000-0000-0000-0000-000000000005\t/\text4\tdefaults,noatime,commit=30\t0\t1",
+        "UUID=00000000-0000-0000-0000-000000000007\t/data\tbtrfs\tdefaults,noatime,ssd,discard=async\t0\t2",
+        "UUID=0000-0000\t/boot/efi\tvfat\tdefaults,noatime,umask=0077\t0\t2",
+        "/dev/mapper/swap\tnone\tswap\tdefaults,pri=50,discard\t0\t0",
+    ]
+    crypttab = (tmp_path / "crypttab").read_text().splitlines()
+    assert crypttab[2:] == [
+        "data\tUUID=00000000-0000-0000-0000-000000000006\tnone\tluks,discard",
+        "swap\tPARTUUID=00000000-0000-0000-0000-000000000003\t/dev/urandom\tswap,cipher=aes-xts-plain64,size=512",
+    ]
+
+def test_fstab_entries_per_device_class(partitions):
+    assert partitions.fstab_entry("UUID=a", "/srv", "ext4", "hdd")["options"] == "defaults,noatime,commit=60"
+    assert partitions.fstab_entry("UUID=a", "/srv", "btrfs", "hdd")["options"] == "defaults,noatime,autodefrag"
+    assert partitions.fstab_entry("UUID=a", None, "swap", "hdd")["options"] == "defaults,pri=10"
+    assert partitions.fstab_entry("UUID=a", None, "swap", "nvme")["options"] == "defaults,pri=100,discard"
+
+def fake_sysfs(root, name, files, under=None):
+    device = root / "devices" / (under or "") / name
+    device.mkdir(parents=True)
+    for path, content in files.items():
+        (device / path).parent.mkdir(parents=True, exist_ok=True)
+        (device / path).write_text(content)
+    (root / "block").mkdir(exist_ok=True)
+    (root / "block" / name).symlink_to(device)
+    return device
+
+def test_inventory_keys_on_kname_and_keeps_dm_out_of_disks(partitions, tmp_path, monkeypatch):
+    fake_sysfs(tmp_path, "nvme0n1", {"dev": "259:0", "size": "2000", "queue/rotational": "0"})
+    fake_sysfs(tmp_path, "nvme0n1p2", {"dev": "259:2", "size": "1000", "partition": "2"}, under="nvme0n1")
+    dm = fake_sysfs(tmp_path, "dm-0", {"dev": "254:0", "size": "990", "dm/uuid": "CRYPT-LUKS2-abc-cryptroot"})
+    (dm / "slaves").mkdir()
+    (dm / "slaves" / "nvme0n1p2").write_text("")
+    lsblk = {"blockdevices": [{"name": "nvme0n1", "kname": "nvme0n1", "type": "disk", "children": [
+        {"name": "nvme0n1p2", "kname": "nvme0n1p2", "type": "part", "children": [
+            {"name": "cryptroot", "kname": "dm-0", "type": "crypt", "path": "/dev/mapper/cryptroot",
+             "mountpoints": ["/"]}]}]}]}
+    monkeypatch.setattr(partitions, "SYS_CLASS_BLOCK", str(tmp_path / "block"))
+    monkeypatch.setattr(partitions, "run_cmd", lambda command: json.dumps(lsblk))
+    inventory = partitions.load_inventory()
+    assert sorted(inventory) == ["dm-0", "nvme0n1", "nvme0n1p2"]
+    assert inventory["dm-0"]["type"] == "crypt"
+    assert inventory["dm-0"]["path"] == "/dev/mapper/cryptroot"
+    assert inventory["nvme0n1p2"]["children"] == ["dm-0"]
+    assert partitions.list_all_block_devices(inventory) == ["/dev/nvme0n1"]
+
+    monkeypatch.setattr(partitions, "run_cmd", lambda command: "not json")
+    inventory = partitions.load_inventory()
+    assert inventory["dm-0"]["type"] == "crypt"
+    assert inventory["dm-0"]["pkname"] == "nvme0n1p2"
+    assert partitions.list_all_block_devices(inventory) == ["/dev/nvme0n1"]
@@ -0,0 +1,15 @@
+def test_prefetch_runs_pacman_through_privileged_call(setup, monkeypatch, tmp_path):
+    calls = []
+    monkeypatch.setattr(setup, "sync_package_names", lambda: {"vim", "git"})
+    monkeypatch.setattr(setup, "filter_installed_packages", lambda packages: packages)
+    monkeypatch.setattr(setup, "prepare_prefetch_root",
+                        lambda parallel: (str(tmp_path), str(tmp_path / "db"), str(tmp_path / "pacman.conf")))
+    monkeypatch.setattr(setup, "privileged_available", lambda: True)
+    monkeypatch.setattr(setup, "privileged_call",
+                        lambda op, **params: calls.append((op, params)) or {"returncode": 0, "stderr": ""})
+    setup.prefetch_packages([("editors", ["vim", "git"])])
+    assert len(calls) == 1
+    op, params = calls[0]
+    assert op == "run"
+    assert params["command"].startswith("pacman -Sw ")
+    assert params["command"].endswith(" vim git > /dev/null")
@@ -0,0 +1,107 @@
+import os
+import time
+
+import pytest
+
+def test_worker_commands_do_not_read_the_request_pipe(setup):
+    start = time.monotonic()
+    result = setup.handle_privileged_operation({"op": "run", "command": "read line", "timeout": 5})
+    assert time.monotonic() - start < 3
+    assert result["returncode"] != 0
+    assert not result["timed_out"]
+
+def test_write_file_keeps_owner_and_mode_of_existing_file(setup, tmp_path):
+    path = tmp_path / "xinitrc"
+    path.write_text("old\n")
+    os.chmod(path, 0o600)
+    if os.geteuid() == 0:
+        os.chown(path, 65534, 65534)
+
+    assert setup.handle_privileged_operation({"op": "write_file", "path": str(path), "content": "new\n", "backup": True})["written"]
+
+    info = os.stat(path)
+    assert path.read_text() == "new\n"
+    assert info.st_mode & 0o777 == 0o600
+    backups = [name for name in os.listdir(tmp_path) if name.startswith("xinitrc.")]
+    assert len(backups) == 1
+    if os.geteuid() == 0:
+        assert (info.st_uid, info.st_gid) == (65534, 65534)
+        assert os.stat(tmp_path / backups[0]).st_uid == 65534
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="needs root")
+def test_write_file_gives_new_files_and_directories_to_owner(setup, tmp_path):
+    path = tmp_path / "home" / "user" / ".config" / "app.conf"
+    (tmp_path / "home").mkdir()
+    setup.handle_privileged_operation({"op": "write_file", "path": str(path), "content": "x\n", "owner": [65534, 65534]})
+    assert os.stat(path).st_uid == 65534
+    assert os.stat(path.parent).st_uid == 65534
+    assert os.stat(tmp_path / "home" / "user").st_uid == 65534
+    assert os.stat(tmp_path / "home").st_uid == 0
+
+def test_write_to_file_expands_variables(setup, tmp_path, monkeypatch):
+    monkeypatch.setenv("ARTIX_TEST_DIR", str(tmp_path))
+    assert setup.write_to_file("$ARTIX_TEST_DIR/conf/file.txt", "x\n", sudo=True)
+    assert (tmp_path / "conf" / "file.txt").read_text() == "x\n"
+    assert not os.path.exists("$ARTIX_TEST_DIR")
+
+def test_batch_stops_at_first_failure(setup, tmp_path):
+    result = setup.handle_privileged_operation({"op": "batch", "operations": [
+        {"op": "mkdir", "path": str(tmp_path / "first")},
+        {"op": "run", "command": "exit 1"},
+        {"op": "mkdir", "path": str(tmp_path / "second")},
+    ]})
+    assert len(result["results"]) == 2
+    assert result["results"][1]["returncode"] == 1
+    assert (tmp_path / "first").is_dir()
+    assert not (tmp_path / "second").exists()
+
+def test_runit_log_run_only_touched_with_log_file(setup):
+    backend = setup.RunitBackend({"sv_path": "/sv/", "service_path": "/service/"})
+    paths = [operation.get("path") for operation in backend.operations("foo", {"service_init": True})]
+    assert "/sv/foo/log/run" not in paths
+    config = {"service_init": True, "log_file": {"content": "#!/bin/sh\nexec svlogd -tt /var/log/foo\n"}}
+    paths = [operation.get("path") for operation in backend.operations("foo", config)]
+    assert paths.count("/sv/foo/log/run") == 2
+
+def test_runit_leaves_starting_to_runsvdir(setup):
+    backend = setup.RunitBackend({"sv_path": "/sv/", "service_path": "/service/"})
+    operations = backend.operations("foo", {"service_init": True})
+    assert operations[-1] == {"op": "symlink", "path": "/sv/foo", "link": "/service/"}
+    assert not any(operation["op"] == "run" for operation in operations)
+    assert backend.ready_spec("foo", {"service_init": True})["stat"] == "/sv/foo/supervise/stat"
+
+def test_dinit_enable_failure_is_not_hidden(setup):
+    backend = setup.DinitBackend({"dinit_path": "/etc/dinit.d/"})
+    commands = [operation["command"] for operation in backend.operations("foo", {"service_init": True})]
+    assert commands == ["dinitctl enable foo", "dinitctl start foo"]
+
+def test_incomplete_backend_fails_when_created(setup):
+    class NoStatus(setup.ServiceBackend):
+        name = "broken"
+
+        def operations(self, service_name, service_config):
+            return []
+
+    with pytest.raises(TypeError):
+        NoStatus({})
+
+@pytest.mark.parametrize("command", ["sudo a && b", "sudo a | b", "sudo a; b", "sudo a > f", "sudo a &",
+                                     "sudo cp $(which a) b", "sudo echo `id`", "sudo a\nb", "sudo -u nobody a"])
+def test_compound_sudo_commands_keep_plain_sudo(setup, command):
+    assert setup.strip_sudo(command) is None
+
+def test_simple_sudo_commands_go_to_the_worker(setup):
+    assert setup.strip_sudo("sudo sudo pacman -S foo") == "pacman -S foo"
+    assert setup.strip_sudo("sudo sh -c 'a && b > c'") == "sh -c 'a && b > c'"
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="needs root")
+def test_worker_expands_with_caller_home_but_runs_with_root_home(setup, tmp_path, monkeypatch):
+    import pwd
+    home = tmp_path / "home"
+    home.mkdir()
+    monkeypatch.setenv("HOME", str(home))
+    assert setup.execute_shell(["sudo touch ~/expanded"], prompt=False)
+    assert (home / "expanded").exists()
+    assert setup.execute_shell([f"sudo sh -c 'echo $HOME $USER > {tmp_path}/env'"], prompt=False)
+    root = pwd.getpwuid(0)
+    assert (tmp_path / "env").read_text() == f"{root.pw_dir} {root.pw_name}\n"
@@ -0,0 +1,41 @@
+import os
+import threading
+import time
+
+def test_wait_wakes_when_runsv_creates_the_supervise_directory(setup, tmp_path):
+    # Artix layout: sv/NAME/supervise -> run/supervise.NAME, created by runsv
+    run = tmp_path / "run"
+    run.mkdir()
+    service_dir = tmp_path / "sv" / "foo"
+    service_dir.mkdir(parents=True)
+    os.symlink(run / "supervise.foo", service_dir / "supervise")
+    spec = {"name": "foo", "timeout": 10, "stat": str(service_dir / "supervise" / "stat")}
+    assert str(run) in setup.ready_watch_paths(spec)
+
+    def runsv():
+        time.sleep(0.5)
+        (run / "supervise.foo").mkdir()
+        (run / "supervise.foo" / "stat").write_text("run\n")
+
+    thread = threading.Thread(target=runsv)
+    start = time.monotonic()
+    thread.start()
+    result = setup.wait_for_services([spec])
+    thread.join()
+    assert result == {"ready": ["foo"], "failed": []}
+    assert time.monotonic() - start < setup.READY_MAX_WAIT - 2
+
+def test_wait_rewatches_a_recreated_directory(setup, tmp_path):
+    inotify = setup.Inotify()
+    try:
+        watched = tmp_path / "supervise"
+        watched.mkdir()
+        inotify.watch(str(watched))
+        watched.rmdir()
+        inotify.wait(1)
+        assert str(watched) not in inotify.watched
+        watched.mkdir()
+        inotify.watch(str(watched))
+        assert str(watched) in inotify.watched
+    finally:
+        inotify.close()
@@ -0,0 +1,21 @@
+def test_dependent_task_skipped_when_step_fails(setup, monkeypatch):
+    ran = []
+
+    def fake_shell_step(command):
+        ran.append(command)
+        return command != "false"
+
+    monkeypatch.setattr(setup, "execute_shell_step", fake_shell_step)
+    yaml_content = {
+        "a": {"shell": ["false", "true"]},
+        "b": {"after": "a", "shell": ["echo b"]},
+        "c": {"shell": ["echo c"]},
+    }
+    setup.parse_and_execute(yaml_content, jobs=2)
+    assert "false" in ran and "true" in ran
+    assert "echo c" in ran
+    assert "echo b" not in ran
+
+def test_execute_task_reports_success(setup, monkeypatch):
+    monkeypatch.setattr(setup, "execute_shell_step", lambda command: True)
+    assert setup.execute_task("a", {"shell": ["true"]}, {}) is True